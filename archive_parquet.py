@@ -0,0 +1,325 @@
+import os
+import sys
+import time
+import argparse
+import traceback
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import quote
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+from db_writer import _conn_params
+
+# ─────────────────────────────────────────────────────────
+# Archivo en Parquet de los datos crudos antes de la retención
+# ─────────────────────────────────────────────────────────
+# La política de retención borra los chunks diarios de raw.fs_realtime_plants y
+# raw.fs_meter_realtime a los 180 días. Este script (cron diario) saca antes
+# cada día UTC (= un chunk) con un cursor del lado del servidor, de a
+# ARCHIVE_BATCH_ROWS filas, y lo escribe en Parquet comprimido (zstd) con
+# particiones al estilo Hive por planta y mes:
+#
+#   <ARCHIVE_URI>/fs_realtime_plants/plant=NE%3D123/month=2026-04/2026-04-17.parquet
+#
+# En memoria nunca hay más de un lote, sea cual sea el tamaño del chunk. Cuando
+# un mes queda archivado completo, los archivos diarios de cada planta se juntan
+# en uno solo (month.parquet). Cada día archivado queda en ops.archive_log y no
+# se vuelve a leer.
+#
+# ARCHIVE_URI puede ser una carpeta local o un URI de pyarrow para
+# almacenamiento de objetos, p. ej.
+#   s3://bucket/fusion?endpoint_override=fsn1.your-objectstorage.com
+# (credenciales en AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY).
+#
+# Para leer: read_archive(tabla, plantas, desde, hasta) → pyarrow.Table.
+
+DEFAULT_URI = "archive"
+MONTH_FILE = "month.parquet"
+
+# Columnas de cada tabla, con el cast al tipo compacto de db_init.sql (así
+# también sirve en tablas que todavía no pasaron por migrate_compact.py)
+TABLES = {
+    "raw.fs_realtime_plants": [
+        ("ts_utc", "ts_utc", pa.timestamp("us", tz="UTC")),
+        ("plant_code", "plant_code", pa.string()),
+        ("power_kw", "power_kw::real", pa.float32()),
+        ("day_power_kwh", "day_power_kwh::real", pa.float32()),
+        ("month_power_kwh", "month_power_kwh::float8", pa.float64()),
+        ("total_power_kwh", "total_power_kwh::float8", pa.float64()),
+        ("health", "health::smallint", pa.int16()),
+        ("source", "source", pa.string()),
+    ],
+    "raw.fs_meter_realtime": [
+        ("ts_utc", "ts_utc", pa.timestamp("us", tz="UTC")),
+        ("plant_code", "plant_code", pa.string()),
+        ("import_kw", "import_kw::real", pa.float32()),
+        ("export_kw", "export_kw::real", pa.float32()),
+        ("load_kw", "load_kw::real", pa.float32()),
+        ("self_use_kw", "self_use_kw::real", pa.float32()),
+    ],
+}
+
+DAY_SQL = """
+    SELECT {columns}
+    FROM {table}
+    WHERE ts_utc >= %(start)s AND ts_utc < %(end)s
+    ORDER BY plant_code, ts_utc
+"""
+
+LOG_SQL = """
+    INSERT INTO ops.archive_log (table_name, day, rows, files, bytes, uri)
+    VALUES (%(table)s, %(day)s, %(rows)s, %(files)s, %(bytes)s, %(uri)s)
+    ON CONFLICT (table_name, day) DO UPDATE SET
+      rows         = EXCLUDED.rows,
+      files        = EXCLUDED.files,
+      bytes        = EXCLUDED.bytes,
+      uri          = EXCLUDED.uri,
+      archived_utc = now()
+"""
+
+def schema(table):
+    return pa.schema([(name, typ) for name, _, typ in TABLES[table]])
+
+def open_root(uri=None):
+    """(filesystem de pyarrow, ruta base) de ARCHIVE_URI."""
+    uri = uri or os.getenv("ARCHIVE_URI", DEFAULT_URI)
+    if "://" not in uri:
+        return pafs.LocalFileSystem(), os.path.abspath(uri)
+    fs, path = pafs.FileSystem.from_uri(uri)
+    return fs, path.rstrip("/")
+
+def table_dir(root, table):
+    return f"{root}/{table.split('.', 1)[1]}"
+
+def partition_dir(root, table, code, month):
+    """Carpeta plant=…/month=YYYY-MM (el código va codificado: "NE=1" → "NE%3D1")."""
+    return f"{table_dir(root, table)}/plant={quote(code, safe='')}/month={month}"
+
+def _month(day):
+    return f"{day.year:04d}-{day.month:02d}"
+
+def _last_day(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+# ─────────────────────────────────────────────────────────
+# Escritura
+# ─────────────────────────────────────────────────────────
+class _DayWriter:
+    """Un ParquetWriter abierto a la vez: las filas llegan ordenadas por planta."""
+
+    def __init__(self, fs, root, table, day, compression):
+        self.fs, self.root, self.table, self.day = fs, root, table, day
+        self.schema = schema(table)
+        self.compression = compression
+        self.code, self.writer = None, None
+        self.paths = []
+
+    def write(self, code, columns):
+        if code != self.code:
+            self.close()
+            folder = partition_dir(self.root, self.table, code, _month(self.day))
+            self.fs.create_dir(folder, recursive=True)
+            path = f"{folder}/{self.day.isoformat()}.parquet"
+            self.writer = pq.ParquetWriter(path, self.schema, filesystem=self.fs,
+                                           compression=self.compression)
+            self.code = code
+            self.paths.append(path)
+        arrays = [pa.array(col, type=f.type) for col, f in zip(columns, self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.code, self.writer = None, None
+
+def _runs(rows):
+    """Tramos consecutivos de filas de una misma planta (columna 1)."""
+    start = 0
+    for i in range(1, len(rows) + 1):
+        if i == len(rows) or rows[i][1] != rows[start][1]:
+            yield rows[start][1], list(zip(*rows[start:i]))
+            start = i
+
+def archive_day(conn, fs, root, table, day, batch_rows=None, compression=None):
+    """Escribe el día UTC `day` de `table` (un Parquet por planta) y lo anota en
+    ops.archive_log. Devuelve (filas, archivos, bytes)."""
+    batch_rows = batch_rows or int(os.getenv("ARCHIVE_BATCH_ROWS", "50000"))
+    compression = compression or os.getenv("ARCHIVE_COMPRESSION", "zstd")
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    sql = DAY_SQL.format(columns=", ".join(expr for _, expr, _ in TABLES[table]), table=table)
+    out = _DayWriter(fs, root, table, day, compression)
+    rows = 0
+    try:
+        with conn.cursor(name=f"archive_{table.split('.', 1)[1]}") as cur:
+            cur.itersize = batch_rows
+            cur.execute(sql, {"start": start, "end": start + timedelta(days=1)})
+            while True:
+                batch = cur.fetchmany(batch_rows)
+                if not batch:
+                    break
+                for code, columns in _runs(batch):
+                    out.write(code, columns)
+                rows += len(batch)
+    finally:
+        out.close()
+    size = sum(i.size or 0 for i in fs.get_file_info(out.paths)) if out.paths else 0
+    with conn.cursor() as cur:
+        cur.execute(LOG_SQL, {"table": table, "day": day, "rows": rows, "files": len(out.paths),
+                              "bytes": size, "uri": table_dir(root, table)})
+    conn.commit()
+    return rows, len(out.paths), size
+
+def compact_month(fs, root, table, month):
+    """Junta los diarios de cada planta del mes en month.parquet. Si ya había
+    un month.parquet (un día vuelto a archivar) los días nuevos reemplazan a
+    los suyos. En memoria: el mes de una planta."""
+    base = table_dir(root, table)
+    merged = 0
+    for plant in fs.get_file_info(pafs.FileSelector(base, allow_not_found=True)):
+        folder = f"{plant.path}/month={month}"
+        files = [i.path for i in fs.get_file_info(pafs.FileSelector(folder, allow_not_found=True))
+                 if i.path.endswith(".parquet")]
+        days = sorted(p for p in files if not p.endswith("/" + MONTH_FILE))
+        if not days:
+            continue
+        parts = [pq.read_table(p, filesystem=fs, schema=schema(table)) for p in days]
+        if len(days) < len(files):
+            prev = pq.read_table(f"{folder}/{MONTH_FILE}", filesystem=fs, schema=schema(table))
+            redone = pa.array([os.path.basename(p)[:-len(".parquet")] for p in days])
+            keep = pc.invert(pc.is_in(pc.strftime(prev["ts_utc"], format="%Y-%m-%d"), value_set=redone))
+            parts.insert(0, prev.filter(keep))
+        data = pa.concat_tables(parts).sort_by("ts_utc")
+        tmp = f"{folder}/{MONTH_FILE}.tmp"
+        pq.write_table(data, tmp, filesystem=fs,
+                       compression=os.getenv("ARCHIVE_COMPRESSION", "zstd"))
+        fs.move(tmp, f"{folder}/{MONTH_FILE}")
+        for p in days:
+            fs.delete_file(p)
+        merged += 1
+    return merged
+
+# ─────────────────────────────────────────────────────────
+# Días pendientes
+# ─────────────────────────────────────────────────────────
+def due_days(cur, table, after_days):
+    """Días UTC completos más viejos que `after_days` sin archivar todavía."""
+    cur.execute(f"SELECT min(ts_utc) FROM {table}")
+    oldest = cur.fetchone()[0]
+    if oldest is None:
+        return []
+    last = (datetime.now(timezone.utc) - timedelta(days=after_days)).date() - timedelta(days=1)
+    cur.execute("SELECT day FROM ops.archive_log WHERE table_name = %s AND day >= %s",
+                (table, oldest.astimezone(timezone.utc).date()))
+    done = {r[0] for r in cur.fetchall()}
+    day, days = oldest.astimezone(timezone.utc).date(), []
+    while day <= last:
+        if day not in done:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+def months_to_compact(cur, table, days):
+    """Meses de `days` cuyo último día ya está archivado."""
+    months = sorted({_month(d) for d in days})
+    if not months:
+        return []
+    cur.execute("SELECT day FROM ops.archive_log WHERE table_name = %s AND day = ANY(%s)",
+                (table, [_last_day(date.fromisoformat(m + "-01")) for m in months]))
+    complete = {_month(r[0]) for r in cur.fetchall()}
+    return [m for m in months if m in complete]
+
+# ─────────────────────────────────────────────────────────
+# Lectura
+# ─────────────────────────────────────────────────────────
+def read_archive(table, plants=None, start=None, end=None, columns=None, uri=None):
+    """Filas archivadas de `table` (p. ej. "raw.fs_realtime_plants") como
+    pyarrow.Table, ordenadas por planta y ts_utc. Sólo se abren las carpetas de
+    las plantas y meses pedidos; `start`/`end` son datetimes con zona ([start, end))."""
+    fs, root = open_root(uri)
+    data = ds.dataset(table_dir(root, table), filesystem=fs, format="parquet",
+                      schema=schema(table).append(pa.field("plant", pa.string())).append(pa.field("month", pa.string())),
+                      partitioning="hive", exclude_invalid_files=True)
+    cond = []
+    if plants:
+        cond.append(ds.field("plant").isin(list(plants)))
+    if start is not None:
+        cond.append(ds.field("month") >= _month(start.astimezone(timezone.utc)))
+        cond.append(ds.field("ts_utc") >= pa.scalar(start, type=pa.timestamp("us", tz="UTC")))
+    if end is not None:
+        cond.append(ds.field("month") <= _month(end.astimezone(timezone.utc)))
+        cond.append(ds.field("ts_utc") < pa.scalar(end, type=pa.timestamp("us", tz="UTC")))
+    filt = None
+    for c in cond:
+        filt = c if filt is None else filt & c
+    names = columns or [name for name, _, _ in TABLES[table]]
+    out = data.to_table(columns=names, filter=filt)
+    keys = [k for k in ("plant_code", "ts_utc") if k in names]
+    return out.sort_by([(k, "ascending") for k in keys]) if keys else out
+
+# ─────────────────────────────────────────────────────────
+# Script
+# ─────────────────────────────────────────────────────────
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Archiva en Parquet los días de raw.* que van a vencer")
+    parser.add_argument("--table", choices=sorted(TABLES), action="append",
+                        help="sólo esta tabla (se puede repetir; por defecto las dos)")
+    parser.add_argument("--after-days", type=float, default=float(os.getenv("ARCHIVE_AFTER_DAYS", "170")),
+                        help="archivar los días más viejos que esto (la retención borra a los 180)")
+    parser.add_argument("--day", type=date.fromisoformat, action="append",
+                        help="archivar (o volver a archivar) este día UTC YYYY-MM-DD")
+    parser.add_argument("--max-days", type=int, default=None, help="tope de días por tabla en esta corrida")
+    parser.add_argument("--dry-run", action="store_true", help="sólo listar los días pendientes")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    load_dotenv(".env")
+    args = parse_args(argv)
+    fs, root = open_root()
+    print(f"\n{'='*60}")
+    print("ARCHIVO PARQUET DE DATOS CRUDOS")
+    print(f"{'='*60}")
+    print(f"📦 Destino: {os.getenv('ARCHIVE_URI', DEFAULT_URI)}")
+    total_rows = total_bytes = 0
+    try:
+        with closing(psycopg2.connect(**_conn_params())) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SET TIME ZONE 'UTC'")
+            for table in args.table or list(TABLES):
+                with conn.cursor() as cur:
+                    days = sorted(set(args.day)) if args.day else due_days(cur, table, args.after_days)
+                conn.commit()
+                if args.max_days is not None:
+                    days = days[:args.max_days]
+                print(f"\n🗓️ {table}: {len(days)} días por archivar"
+                      + (f" ({days[0]} → {days[-1]})" if days else ""))
+                if args.dry_run or not days:
+                    continue
+                for day in days:
+                    t0 = time.perf_counter()
+                    rows, files, size = archive_day(conn, fs, root, table, day)
+                    total_rows += rows
+                    total_bytes += size
+                    print(f"   ✅ {day}: {rows} filas → {files} archivos, "
+                          f"{size / 1024:.0f} KiB ({time.perf_counter() - t0:.1f}s)")
+                with conn.cursor() as cur:
+                    months = months_to_compact(cur, table, days)
+                conn.commit()
+                for month in months:
+                    print(f"   🗜️ {month}: {compact_month(fs, root, table, month)} plantas en {MONTH_FILE}")
+    except Exception as e:
+        print(f"❌ Error Crítico: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+    print(f"\n{'='*60}")
+    print(f"✅ Archivo completado: {total_rows} filas, {total_bytes / 1024 / 1024:.1f} MiB")
+    print(f"{'='*60}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import sys
+import json
+import math
+import time
+import copy
+import random
+import secrets
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ─────────────────────────────────────────────────────────
+# Servidor falso de la API Northbound de FusionSolar
+# ─────────────────────────────────────────────────────────
+# Responde /thirdData/login, stations, getStationRealKpi, getKpiStationDay,
+# getKpiStationHour, getDevList y getDevRealKpi con la forma de las respuestas
+# reales, para plantas sintéticas NE=9000000.. con curva solar determinista.
+# Simula:
+#   - latencia (--latency-ms ± --jitter-ms)
+#   - XSRF-TOKEN: sin token o vencido (--token-ttl) → failCode 305
+#   - cuotas por endpoint (--quota getStationRealKpi=60/60 → 60 llamadas por
+#     ventana deslizante de 60 s; al pasarse → failCode 407)
+#   - formas grabadas (--shapes archivo.json: {endpoint: item de ejemplo}); los
+#     campos generados se escriben encima del item grabado y el resto se conserva
+# GET /_stats devuelve los contadores en JSON; POST /_reset los pone a cero.
+
+LOCAL_OFFSET = timedelta(hours=-5)      # America/Bogota, sin horario de verano
+BASE_CODE = 9000000
+METER_EVERY = 3                         # una de cada 3 plantas tiene medidor (tipo 47)
+
+def plant_codes(n):
+    return [f"NE={BASE_CODE + i}" for i in range(n)]
+
+class Plant:
+    def __init__(self, i):
+        rnd = random.Random(i)
+        self.code = f"NE={BASE_CODE + i}"
+        self.name = f"Bench {i:04d}"
+        self.kwp = round(rnd.uniform(40, 160), 2)
+        self.base_kwh = round(rnd.uniform(1e4, 5e5), 1)
+        self.meter_id = 10_000_000 + i if i % METER_EVERY == 0 else None
+        self.lat = round(rnd.uniform(2.0, 8.0), 4)
+        self.lon = round(rnd.uniform(-77.0, -73.0), 4)
+
+    # Curva: seno entre 06:00 y 18:00 locales, pico 0.8 × kWp
+    DAY_KWH_PER_KWP = 0.8 * 12 * 2 / math.pi
+
+    def power_kw(self, ts):
+        h = ((ts + LOCAL_OFFSET.total_seconds()) % 86400) / 3600.0
+        return round(max(0.0, 0.8 * self.kwp * math.sin(math.pi * (h - 6) / 12)), 3) if 6 <= h <= 18 else 0.0
+
+    def day_kwh(self, ts):
+        h = ((ts + LOCAL_OFFSET.total_seconds()) % 86400) / 3600.0
+        frac = 0.0 if h < 6 else 1.0 if h > 18 else (1 - math.cos(math.pi * (h - 6) / 12)) / 2
+        return round(self.kwp * self.DAY_KWH_PER_KWP * frac, 3)
+
+    def total_kwh(self, ts):
+        days = math.floor((ts + LOCAL_OFFSET.total_seconds()) / 86400)
+        return round(self.base_kwh + days * self.kwp * self.DAY_KWH_PER_KWP + self.day_kwh(ts), 3)
+
+class State:
+    def __init__(self, args):
+        self.args = args
+        self.plants = {p.code: p for p in (Plant(i) for i in range(args.plants))}
+        self.meters = {p.meter_id: p for p in self.plants.values() if p.meter_id}
+        self.tokens = {}                # token → vence (epoch)
+        self.windows = {}               # endpoint → deque de marcas de tiempo
+        self.quotas = dict(args.quota)
+        self.shapes = json.load(open(args.shapes)) if args.shapes else {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = {}
+            self.expired = 0
+            self.logins = 0
+            self.stations_returned = 0
+
+    def count(self, endpoint):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def over_quota(self, endpoint):
+        q = self.quotas.get(endpoint)
+        if not q:
+            return False
+        limit, window = q
+        now = time.time()
+        w = self.windows.setdefault(endpoint, deque())
+        while w and now - w[0] > window:
+            w.popleft()
+        if len(w) >= limit:
+            self.throttled[endpoint] = self.throttled.get(endpoint, 0) + 1
+            return True
+        w.append(now)
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "throttled": dict(self.throttled),
+                    "expired": self.expired, "logins": self.logins,
+                    "stations_returned": self.stations_returned, "plants": len(self.plants)}
+
+def _shape(state, endpoint, generated):
+    tpl = state.shapes.get(endpoint)
+    if not tpl:
+        return generated
+    item = copy.deepcopy(tpl)
+    dim = generated.pop("dataItemMap", None)
+    item.update(generated)
+    if dim is not None:
+        item["dataItemMap"] = dict(item.get("dataItemMap") or {}, **dim)
+    return item
+
+# ─────────────────────────────────────────────────────────
+# Endpoints
+# ─────────────────────────────────────────────────────────
+def _codes(body, state):
+    codes = [c.strip() for c in str(body.get("stationCodes", "")).split(",") if c.strip()]
+    return [c for c in codes if c in state.plants], len(codes)
+
+def station_real_kpi(state, body):
+    codes, asked = _codes(body, state)
+    if asked > 100:
+        return {"success": False, "failCode": 20004, "data": None, "message": "stationCodes exceeds 100"}
+    now = time.time()
+    data = []
+    for c in codes:
+        p = state.plants[c]
+        data.append(_shape(state, "getStationRealKpi", {
+            "stationCode": c,
+            "dataItemMap": {
+                "real_health_state": "3",
+                "day_power": p.day_kwh(now),
+                "month_power": round(p.day_kwh(now) + 20 * p.kwp * p.DAY_KWH_PER_KWP, 3),
+                "total_power": p.total_kwh(now),
+                "day_on_grid_energy": round(p.day_kwh(now) * 0.7, 3),
+                "day_income": 0.0,
+            },
+        }))
+    state.stations_returned += len(data)
+    return {"success": True, "failCode": 0, "data": data, "message": None}
+
+def kpi_station_day(state, body):
+    codes, _ = _codes(body, state)
+    ms = int(body.get("collectTime") or time.time() * 1000)
+    local = datetime.fromtimestamp(ms / 1000, timezone.utc) + LOCAL_OFFSET
+    first = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    today = datetime.now(timezone.utc) + LOCAL_OFFSET
+    data = []
+    d = first
+    while d.month == first.month and d.date() < today.date():
+        collect = int((d - LOCAL_OFFSET).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        for c in codes:
+            p = state.plants[c]
+            y = round(p.kwp * p.DAY_KWH_PER_KWP, 3)
+            data.append(_shape(state, "getKpiStationDay", {
+                "stationCode": c, "collectTime": collect,
+                "dataItemMap": {"inverter_power": y, "use_power": round(y * 0.6, 3),
+                                "on_grid_power": round(y * 0.5, 3), "buy_power": round(y * 0.1, 3),
+                                "self_use_power": round(y * 0.5, 3)},
+            }))
+        d += timedelta(days=1)
+    return {"success": True, "failCode": 0, "data": data, "message": None}
+
+def kpi_station_hour(state, body):
+    codes, _ = _codes(body, state)
+    ms = int(body.get("collectTime") or time.time() * 1000)
+    local = datetime.fromtimestamp(ms / 1000, timezone.utc) + LOCAL_OFFSET
+    midnight = (local.replace(hour=0, minute=0, second=0, microsecond=0) - LOCAL_OFFSET).replace(tzinfo=timezone.utc)
+    now = time.time()
+    data = []
+    for h in range(24):
+        start = midnight.timestamp() + h * 3600
+        if start + 3600 > now:      # sólo horas cerradas
+            break
+        for c in codes:
+            p = state.plants[c]
+            kwh = round(p.day_kwh(start + 3599) - p.day_kwh(start), 3)
+            data.append(_shape(state, "getKpiStationHour", {
+                "stationCode": c, "collectTime": int(start * 1000),
+                "dataItemMap": {"inverter_power": kwh, "radiation_intensity": None,
+                                "ongrid_power": round(kwh * 0.5, 3), "power_profit": 0.0},
+            }))
+    return {"success": True, "failCode": 0, "data": data, "message": None}
+
+def stations(state, body):
+    page = int(body.get("pageNo") or 1)
+    size = 100
+    plants = list(state.plants.values())
+    chunk = plants[(page - 1) * size: page * size]
+    items = [_shape(state, "stations", {"plantCode": p.code, "plantName": p.name, "capacity": p.kwp,
+                                        "latitude": p.lat, "longitude": p.lon}) for p in chunk]
+    return {"success": True, "failCode": 0, "message": None,
+            "data": {"list": items, "pageNo": page, "pageCount": max(1, math.ceil(len(plants) / size)),
+                     "total": len(plants)}}
+
+def dev_list(state, body):
+    codes, _ = _codes(body, state)
+    data = []
+    for c in codes:
+        p = state.plants[c]
+        data.append({"id": 20_000_000 + int(c[3:]) - BASE_CODE, "devTypeId": 1, "stationCode": c, "devName": "Inverter-1"})
+        if p.meter_id:
+            data.append({"id": p.meter_id, "devTypeId": 47, "stationCode": c, "devName": "Meter-1"})
+    return {"success": True, "failCode": 0, "data": data, "message": None}
+
+def dev_real_kpi(state, body):
+    ids = [int(x) for x in str(body.get("devIds", "")).split(",") if x.strip().isdigit()]
+    now = time.time()
+    data = []
+    for dev_id in ids:
+        p = state.meters.get(dev_id)
+        if p is None:
+            continue
+        # Exporta la mitad de la FV de día; de noche importa 5 kW (en W, tipo 47)
+        w = (p.power_kw(now) * 0.5 if p.power_kw(now) > 0 else -5.0) * 1000
+        data.append(_shape(state, "getDevRealKpi", {"devId": dev_id, "dataItemMap": {"active_power": round(w, 1)}}))
+    return {"success": True, "failCode": 0, "data": data, "message": None}
+
+ENDPOINTS = {
+    "getStationRealKpi": station_real_kpi,
+    "getKpiStationDay": kpi_station_day,
+    "getKpiStationHour": kpi_station_hour,
+    "stations": stations,
+    "getDevList": dev_list,
+    "getDevRealKpi": dev_real_kpi,
+}
+
+# ─────────────────────────────────────────────────────────
+# HTTP
+# ─────────────────────────────────────────────────────────
+def make_handler(state):
+    args = state.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, headers=None):
+            raw = json.dumps(body).encode() if not isinstance(body, bytes) else body
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json;charset=UTF-8")
+            self.send_header("Content-Length", str(len(raw)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _body(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            try:
+                return json.loads(self.rfile.read(n) or b"{}")
+            except ValueError:
+                return {}
+
+        def _latency(self):
+            if args.latency_ms or args.jitter_ms:
+                time.sleep(max(0.0, random.gauss(args.latency_ms, args.jitter_ms)) / 1000.0)
+
+        def do_GET(self):
+            if self.path.startswith("/_stats"):
+                return self._send(200, state.stats())
+            # preflight de la sesión
+            return self._send(200, b"<html></html>", {"Content-Type": "text/html"})
+
+        def do_POST(self):
+            body = self._body()
+            path = self.path.split("?", 1)[0]
+            if path == "/_reset":
+                state.reset()
+                return self._send(200, {"ok": True})
+            if not path.startswith("/thirdData/"):
+                return self._send(404, {"success": False})
+            endpoint = path[len("/thirdData/"):]
+            self._latency()
+            with state.lock:
+                state.count(endpoint)
+                if state.over_quota(endpoint):
+                    return self._send(200, {"success": False, "failCode": 407,
+                                            "data": "ACCESS_FREQUENCY_IS_TOO_HIGH", "message": None})
+                if endpoint == "login":
+                    if body.get("userName") is None:
+                        return self._send(200, {"success": False, "failCode": 20001, "data": None})
+                    token = "x-" + secrets.token_hex(16)
+                    state.tokens[token] = time.time() + args.token_ttl
+                    state.logins += 1
+                    return self._send(200, {"success": True, "failCode": 0, "data": None},
+                                      {"XSRF-TOKEN": token, "Set-Cookie": f"XSRF-TOKEN={token}; Path=/; HttpOnly"})
+                token = self.headers.get("XSRF-TOKEN")
+                if not token or state.tokens.get(token, 0) < time.time():
+                    state.tokens.pop(token, None)
+                    state.expired += 1
+                    return self._send(200, {"success": False, "failCode": 305,
+                                            "data": None, "message": "USER_MUST_RELOGIN"})
+                fn = ENDPOINTS.get(endpoint)
+                if fn is None:
+                    return self._send(200, {"success": False, "failCode": 404, "data": None,
+                                            "message": f"unknown interface {endpoint}"})
+                return self._send(200, fn(state, body))
+
+        def log_message(self, *a):
+            pass
+
+    return Handler
+
+def _quota(text):
+    endpoint, spec = text.split("=", 1)
+    limit, _, window = spec.partition("/")
+    return endpoint, (int(limit), float(window or 60))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor falso de la API Northbound de FusionSolar")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--plants", type=int, default=300, help="plantas sintéticas")
+    parser.add_argument("--latency-ms", type=float, default=120.0)
+    parser.add_argument("--jitter-ms", type=float, default=40.0)
+    parser.add_argument("--token-ttl", type=float, default=1800.0, help="segundos de vida del XSRF-TOKEN")
+    parser.add_argument("--quota", type=_quota, action="append", default=[],
+                        help="ENDPOINT=LLAMADAS/SEGUNDOS (repetible), p. ej. getStationRealKpi=60/60")
+    parser.add_argument("--shapes", default=None, help="JSON {endpoint: item grabado} a usar como plantilla")
+    return parser.parse_args(argv)
+
+def serve(args):
+    state = State(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"🧪 Northbound falso en http://{args.host}:{server.server_address[1]} ({args.plants} plantas)", flush=True)
+    return server, state
+
+def main(argv=None):
+    server, _ = serve(parse_args(argv))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    sys.exit(main())
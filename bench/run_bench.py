@@ -0,0 +1,334 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import urllib.request
+from pathlib import Path
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+from dotenv import load_dotenv
+
+# ─────────────────────────────────────────────────────────
+# Benchmark de punta a punta contra el Northbound falso
+# ─────────────────────────────────────────────────────────
+# Levanta bench/fake_northbound.py en un subproceso, registra N plantas
+# sintéticas en dim.fs_plants, siembra su histórico crudo y corre, midiendo
+# cada fase:
+#   1. collector   `python fusion_api.py` (subproceso) durante --duration segundos
+#   2. sync        sync_huawei_daily.sync_data sobre los días sembrados
+#   3. consolidate consolidate_daily.main sobre los mismos días
+# Reporta muestras/hora, llamadas API por muestra, viajes a la base
+# (transacciones de pg_stat_database y flushes del writer) y tiempo de pared.
+#
+# Usa la base de PG* (.env): apuntar a una base desechable. Todo lo sembrado
+# usa códigos NE=9000000.. y se borra al terminar salvo con --keep.
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+load_dotenv(ROOT / ".env")
+
+from fake_northbound import Plant, plant_codes
+
+# Curva idéntica a Plant.power_kw / day_kwh / total_kwh del servidor falso
+SEED_HISTORY_SQL = """
+    INSERT INTO raw.fs_realtime_plants
+    (ts_utc, plant_code, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
+    SELECT ts, p.code,
+           CASE WHEN h BETWEEN 6 AND 18 THEN 0.8 * p.kwp * sin(pi() * (h - 6) / 12) ELSE 0 END,
+           p.kwp * %(k)s * f,
+           0,
+           p.base + floor(el / 86400) * p.kwp * %(k)s + p.kwp * %(k)s * f,
+           3
+    FROM unnest(%(codes)s::text[], %(kwp)s::float8[], %(base)s::float8[])
+           AS p(code, kwp, base)
+    CROSS JOIN generate_series(%(start)s::timestamptz, %(end)s::timestamptz - %(step)s::interval,
+                               %(step)s::interval) AS ts
+    CROSS JOIN LATERAL (SELECT extract(epoch FROM ts) - 18000 AS el) e
+    CROSS JOIN LATERAL (SELECT (el::numeric %% 86400) / 3600 AS h) hh
+    CROSS JOIN LATERAL (SELECT CASE WHEN h < 6 THEN 0 WHEN h > 18 THEN 1
+                                    ELSE (1 - cos(pi() * (h - 6) / 12)) / 2 END AS f) ff
+    ON CONFLICT (ts_utc, plant_code) DO NOTHING
+"""
+
+CLEANUP_SQL = [
+    "DELETE FROM fs.plant_daily_metrics WHERE plant_code = ANY(%(codes)s)",
+    "DELETE FROM raw.fs_realtime_plants WHERE plant_code = ANY(%(codes)s)",
+    "DELETE FROM raw.fs_plants_last WHERE plant_code = ANY(%(codes)s)",
+    "DELETE FROM raw.fs_meter_realtime WHERE plant_code = ANY(%(codes)s)",
+    "DELETE FROM dim.fs_plants WHERE plant_code = ANY(%(codes)s)",
+]
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv("PGHOST"), port=os.getenv("PGPORT"), dbname=os.getenv("PGDATABASE"),
+        user=os.getenv("PGUSER"), password=os.getenv("PGPASSWORD"),
+        sslmode=os.getenv("PGSSLMODE", "require"),
+    )
+
+def db_xacts():
+    """Transacciones confirmadas + abortadas de la base (pg_stat_database)."""
+    time.sleep(1.2)   # las estadísticas de otros backends se publican con ~1 s de retraso
+    with contextlib.closing(connect()) as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_stat_clear_snapshot()")
+        cur.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()")
+        return cur.fetchone()[0]
+
+# ─────────────────────────────────────────────────────────
+# Servidor falso
+# ─────────────────────────────────────────────────────────
+def start_server(args, log):
+    cmd = [sys.executable, str(Path(__file__).with_name("fake_northbound.py")),
+           "--port", str(args.port), "--plants", str(args.plants),
+           "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+           "--token-ttl", str(args.token_ttl)]
+    for q in args.quota:
+        cmd += ["--quota", q]
+    if args.shapes:
+        cmd += ["--shapes", args.shapes]
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(50):
+        try:
+            server_stats(args)
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("❌ El Northbound falso no arrancó")
+
+def _server(args, path, method="GET"):
+    req = urllib.request.Request(f"http://127.0.0.1:{args.port}{path}", method=method,
+                                 data=b"{}" if method == "POST" else None)
+    with urllib.request.urlopen(req, timeout=5) as r:
+        return json.loads(r.read())
+
+def server_stats(args):
+    return _server(args, "/_stats")
+
+def server_reset(args):
+    _server(args, "/_reset", "POST")
+
+# ─────────────────────────────────────────────────────────
+# Preparación de la base
+# ─────────────────────────────────────────────────────────
+def seed(args, codes, first_day, last_day):
+    plants = [Plant(i) for i in range(args.plants)]
+    start = datetime.combine(first_day - timedelta(days=1), datetime.min.time(), timezone(timedelta(hours=-5)))
+    end = datetime.combine(last_day + timedelta(days=1), datetime.min.time(), timezone(timedelta(hours=-5)))
+    with contextlib.closing(connect()) as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO dim.fs_plants (plant_code, plant_name, capacity_kw, latitude, longitude)
+            SELECT * FROM unnest(%s::text[], %s::text[], %s::numeric[], %s::float8[], %s::float8[])
+            ON CONFLICT (plant_code) DO NOTHING
+        """, (codes, [p.name for p in plants], [p.kwp for p in plants],
+              [p.lat for p in plants], [p.lon for p in plants]))
+        cur.execute(SEED_HISTORY_SQL, {
+            "codes": codes, "kwp": [p.kwp for p in plants],
+            "base": [p.base_kwh for p in plants], "k": Plant.DAY_KWH_PER_KWP,
+            "start": start, "end": end, "step": f"{args.step_minutes} minutes",
+        })
+        rows = cur.rowcount
+        conn.commit()
+    return rows
+
+def cleanup(codes):
+    with contextlib.closing(connect()) as conn, conn.cursor() as cur:
+        for sql in CLEANUP_SQL:
+            try:
+                cur.execute(sql, {"codes": codes})
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                print(f"⚠️ Limpieza: {e}".strip())
+
+# ─────────────────────────────────────────────────────────
+# Fases
+# ─────────────────────────────────────────────────────────
+class Phase:
+    def __init__(self, name, args, log):
+        self.name, self.args, self.log = name, args, log
+        self.result = {"phase": name}
+
+    def __enter__(self):
+        server_reset(self.args)
+        self.x0 = db_xacts()
+        self.t0 = time.perf_counter()
+        self.redirect = contextlib.redirect_stdout(self.log)
+        self.redirect.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.redirect.__exit__(*exc)
+        wall = time.perf_counter() - self.t0
+        st = server_stats(self.args)
+        data_calls = sum(n for ep, n in st["calls"].items() if ep != "login")
+        self.result.update({
+            "wall_s": round(wall, 2),
+            "api_calls": data_calls,
+            "logins": st["logins"],
+            "throttled_407": sum(st["throttled"].values()),
+            "relogins_305": st["expired"],
+            "db_xacts": db_xacts() - self.x0,
+        })
+        if exc[0] is SystemExit:
+            if exc[1].code not in (None, 0):
+                self.result["error"] = f"exit {exc[1].code}"
+        elif exc[0] is not None:
+            self.result["error"] = repr(exc[1])
+        return True   # una fase fallida no corta las siguientes
+
+def scrape(port):
+    """{(métrica, etiquetas): valor} del /metrics del recolector."""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+        text = r.read().decode()
+    out = {}
+    for line in text.splitlines():
+        m = re.match(r"^(\w+)(\{[^}]*\})?\s+(\S+)$", line)
+        if m:
+            out[(m.group(1), m.group(2) or "")] = float(m.group(3))
+    return out
+
+def _total(values, name):
+    return sum(v for (n, _), v in values.items() if n == name)
+
+def run_collector(args, log, tmp):
+    metrics_port = args.port + 1
+    env = dict(os.environ, **{
+        "STATION_CODES": ",".join(plant_codes(args.plants)),
+        "ACCOUNTS_FILE": str(tmp / "accounts.none.json"),
+        "RATE_STATE_FILE": str(tmp / ".rate_state.json"),
+        "SPOOL_FILE": str(tmp / ".spool.sqlite3"),
+        "METRICS_PORT": str(metrics_port),
+        "STARTUP_COOLDOWN_SECONDS": "0",
+        "DEBUG_PAYLOAD": "0",
+        "PER_PLANT_DELAY_SECONDS": str(3600.0 / args.rate_per_hour),
+        "RATE_MAX_PER_HOUR": str(args.rate_per_hour * 4),
+        "BACKOFF_SECONDS": str(args.backoff_seconds),
+        "BACKOFF_MAX_SECONDS": str(args.backoff_seconds * 8),
+        "SOLAR_SCHEDULE": "1" if args.solar else "0",
+        "BATCH_MODE": "0" if args.no_batch else "1",
+    })
+    values = {}
+    with Phase("collector", args, log) as ph:
+        # `python fusion_api.py` corre Collector.run(); SIGINT hace el flush final y sale
+        proc = subprocess.Popen([sys.executable, str(ROOT / "fusion_api.py")], cwd=tmp, env=env,
+                                stdout=log, stderr=subprocess.STDOUT)
+        try:
+            proc.wait(timeout=args.duration)
+            ph.result["error"] = f"el recolector terminó antes de tiempo (exit {proc.returncode})"
+        except subprocess.TimeoutExpired:
+            with contextlib.suppress(OSError):
+                values = scrape(metrics_port)
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    st = server_stats(args)
+    samples = st["stations_returned"]
+    wall = ph.result["wall_s"]
+    ph.result.update({
+        "samples": samples,
+        "samples_per_hour": round(samples / wall * 3600) if wall else 0,
+        "calls_per_sample": round(ph.result["api_calls"] / samples, 4) if samples else None,
+        "rows_written": int(_total(values, "fusion_db_rows_written_total")),
+        "db_flushes": int(_total(values, "fusion_db_write_seconds_count")),
+    })
+    return ph.result
+
+def run_sync(args, log, first_day, last_day):
+    os.environ.setdefault("SYNC_CALL_INTERVAL_SECONDS", "0")
+    with Phase("sync", args, log) as ph:
+        import sync_huawei_daily
+        sync_huawei_daily.sync_data(first_day, last_day)
+    n = args.plants * ((last_day - first_day).days + 1)
+    ph.result.update({"plant_days": n,
+                      "calls_per_plant_day": round(ph.result["api_calls"] / n, 4) if n else None})
+    return ph.result
+
+def run_consolidate(args, log, first_day, last_day):
+    with Phase("consolidate", args, log) as ph:
+        import consolidate_daily
+        consolidate_daily.main(["--from", first_day.isoformat(), "--to", last_day.isoformat()])
+    ph.result["plant_days"] = args.plants * ((last_day - first_day).days + 1)
+    return ph.result
+
+# ─────────────────────────────────────────────────────────
+# Reporte
+# ─────────────────────────────────────────────────────────
+COLUMNS = ["phase", "wall_s", "api_calls", "logins", "throttled_407", "relogins_305", "db_xacts",
+           "samples", "samples_per_hour", "calls_per_sample", "rows_written", "db_flushes",
+           "plant_days", "calls_per_plant_day", "error"]
+
+def report(results):
+    cols = [c for c in COLUMNS if any(c in r for r in results)]
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in results)) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in results:
+        print("  ".join(str(r.get(c, "")).ljust(widths[c]) for c in cols))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de fusion_api / sync / consolidate contra el Northbound falso")
+    parser.add_argument("--plants", type=int, default=300)
+    parser.add_argument("--duration", type=float, default=60.0, help="segundos de recolección")
+    parser.add_argument("--rate-per-hour", type=float, default=720.0, help="ritmo inicial del scheduler")
+    parser.add_argument("--backoff-seconds", type=float, default=5.0)
+    parser.add_argument("--history-days", type=int, default=3, help="días de histórico para sync/consolidate")
+    parser.add_argument("--step-minutes", type=int, default=5, help="paso del histórico sembrado")
+    parser.add_argument("--phases", default="collector,sync,consolidate")
+    parser.add_argument("--solar", action="store_true", help="con horario solar (SOLAR_SCHEDULE=1)")
+    parser.add_argument("--no-batch", action="store_true", help="una llamada por planta (BATCH_MODE=0)")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency-ms", type=float, default=120.0)
+    parser.add_argument("--jitter-ms", type=float, default=40.0)
+    parser.add_argument("--token-ttl", type=float, default=1800.0)
+    parser.add_argument("--quota", action="append", default=[], help="igual que en fake_northbound.py")
+    parser.add_argument("--shapes", default=None)
+    parser.add_argument("--json", default=None, help="guardar resultados en este archivo")
+    parser.add_argument("--keep", action="store_true", help="no borrar las plantas sintéticas al terminar")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    phases = [p.strip() for p in args.phases.split(",") if p.strip()]
+    tmp = Path(tempfile.mkdtemp(prefix="fusion-bench-"))
+    log = open(tmp / "bench.log", "w")
+    os.environ.update({"FUSION_DOMAIN": f"http://127.0.0.1:{args.port}",
+                       "FS_USER": "bench", "FS_SYSCODE": "bench"})
+    codes = plant_codes(args.plants)
+    last_day = date.today() - timedelta(days=1)
+    first_day = last_day - timedelta(days=args.history_days - 1)
+
+    print(f"🧪 Bench: {args.plants} plantas, log en {tmp / 'bench.log'}")
+    server = start_server(args, log)
+    results = []
+    try:
+        t0 = time.perf_counter()
+        rows = seed(args, codes, first_day, last_day)
+        results.append({"phase": "seed", "wall_s": round(time.perf_counter() - t0, 2), "rows_written": rows,
+                        "plant_days": args.plants * args.history_days})
+        if "collector" in phases:
+            results.append(run_collector(args, log, tmp))
+        if "sync" in phases:
+            results.append(run_sync(args, log, first_day, last_day))
+        if "consolidate" in phases:
+            results.append(run_consolidate(args, log, first_day, last_day))
+    finally:
+        server.terminate()
+        if not args.keep:
+            cleanup(codes)
+        log.flush()
+
+    report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,170 +1,301 @@
 import psycopg2
+import psycopg2.extras
 import os
 import sys
+import argparse
 import traceback
-from datetime import datetime, timedelta
+from contextlib import closing
+from datetime import date, datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
+
+from plant_registry import PlantRegistry
+import quality
 
 # --- CONFIGURACIÓN ---
-DB_HOST = os.getenv('PGHOST')
-DB_NAME = os.getenv('PGDATABASE')
-DB_USER = os.getenv('PGUSER')
-DB_PASS = os.getenv('PGPASSWORD')
-
-# MAPEO DEFINITIVO (Validado)
-PLANT_MAP = {
-    "NE=33876570": 1,  # Cabañita
-    "NE=33801790": 2,  # Maracaibo
-    "NE=33745211": 3,  # Porvenir
-    "NE=33758743": 4,  # Pozo 2
-    "NE=33723010": 5,  # Pozo 1
-    "NE=33788377": 6   # Casa Trejo
-}
-
-PLANT_KWP = {
-    1: 116.0, 
-    2: 116.0, 
-    3: 143.0, 
-    4: 116.0, 
-    5: 119.56, 
-    6: 9.765
-}
+LOCAL_TZ = ZoneInfo('America/Bogota')
+
+# Origen de los máximos diarios: 'agg' (agregado continuo agg.fs_plants_daily,
+# ver db_init.sql) o 'raw' (hypertable cruda, p. ej. antes de crear el agregado)
+DAILY_SOURCE = os.getenv('DAILY_SOURCE', 'agg')
+
+# Etapa de calidad (quality.py): puntaje por planta-día y, ante un outlier,
+# energía reconstruida desde el contador limpio + integral de potencia en vez
+# de day_power_kwh a ciegas (si el puntaje llega a QUALITY_MIN_SCORE)
+QUALITY_ENABLED = int(os.getenv('QUALITY_ENABLED', '1'))
+QUALITY_MIN_SCORE = float(os.getenv('QUALITY_MIN_SCORE', '0.6'))
 
 def get_db_connection():
+    # Credenciales leídas en cada conexión: quien importa este módulo puede
+    # cargar .env después (sync_huawei_daily)
     return psycopg2.connect(
-        host=DB_HOST, 
-        database=DB_NAME, 
-        user=DB_USER, 
-        password=DB_PASS
+        host=os.getenv('PGHOST'),
+        database=os.getenv('PGDATABASE'),
+        user=os.getenv('PGUSER'),
+        password=os.getenv('PGPASSWORD')
     )
 
-def main():
-    # CRÍTICO: Procesar día AYER (completo), no HOY (incompleto)
+# Códigos NE, plant_id y kWp salen de dim.fs_plants (ver db_init.sql)
+registry = PlantRegistry(lambda: closing(get_db_connection()))
+
+CASA_TREJO_ID = 6
+CASA_TREJO_MAX_KWH = 60        # si dim.fs_plants no trae max_daily_kwh
+PEAK_SUN_HOURS = 6.5
+
+def local_day_range(first_day, last_day):
+    """Rango semiabierto [inicio, fin) en UTC que cubre los días locales dados.
+    Filtrar ts_utc por rango (y no por ::date) deja usar idx_fs_realtime_plants y
+    la exclusión de chunks de Timescale."""
+    start = datetime.combine(first_day, dt_time.min, tzinfo=LOCAL_TZ)
+    end = datetime.combine(last_day + timedelta(days=1), dt_time.min, tzinfo=LOCAL_TZ)
+    return start, end
+
+# Máximos diarios por planta y día local, desde el agregado continuo diario o
+# desde la hypertable cruda. Ambos filtran por rango sobre la columna de tiempo.
+DAILY_FROM_AGG = """
+        SELECT plant_code,
+               (day AT TIME ZONE 'America/Bogota')::date AS d,
+               total_power_kwh_max AS total_max,
+               day_power_kwh_max   AS day_max
+        FROM agg.fs_plants_daily
+        WHERE day >= %(start)s AND day < %(end)s
+"""
+
+DAILY_FROM_RAW = """
+        SELECT plant_code,
+               (ts_utc AT TIME ZONE 'America/Bogota')::date AS d,
+               MAX(total_power_kwh) AS total_max,
+               MAX(day_power_kwh)   AS day_max
+        FROM raw.fs_realtime_plants
+        WHERE ts_utc >= %(start)s AND ts_utc < %(end)s
+        GROUP BY 1, 2
+"""
+
+# Máximos diarios de todas las plantas para todo el rango en una sola pasada.
+# LAG trae el acumulado del día anterior (sólo si es exactamente d-1) y las
+# reglas de outliers se aplican en la misma consulta para todas las filas:
+#   - Casa Trejo: contra el acumulado oficial de ayer, máximo 60 kWh/día
+#   - Resto: contra el acumulado raw de ayer, máximo kWp × 6.5 h sol pico
+# Dentro del rango, el acumulado "oficial" de ayer es el que esta misma corrida
+# escribe (total_max de ayer); para el primer día se lee de fs.plant_daily_metrics.
+DAILY_YIELD_SQL = """
+    WITH plants AS (
+        SELECT * FROM unnest(%(codes)s::text[], %(ids)s::int[], %(caps)s::float8[])
+                   AS p(plant_code, plant_id, max_kwh)
+    ),
+    daily AS ({daily}    ),
+    seq AS (
+        SELECT plant_code, d, total_max, day_max,
+               CASE WHEN LAG(d) OVER w = d - 1 THEN LAG(total_max) OVER w END AS prev_raw
+        FROM daily
+        WINDOW w AS (PARTITION BY plant_code ORDER BY d)
+    ),
+    ref AS (
+        SELECT s.plant_code, s.d, s.total_max, COALESCE(s.day_max, 0) AS day_max,
+               p.plant_id, p.max_kwh,
+               CASE WHEN p.plant_id = %(casa_trejo)s
+                    THEN CASE WHEN s.d > %(first)s AND s.prev_raw IS NOT NULL
+                              THEN s.prev_raw ELSE m.cumulative_energy_kwh END
+                    ELSE s.prev_raw
+               END AS prev_accum
+        FROM seq s
+        JOIN plants p ON p.plant_code = s.plant_code
+        LEFT JOIN fs.plant_daily_metrics m
+               ON m.plant_code = s.plant_code AND m.date = s.d - 1
+        WHERE s.d BETWEEN %(first)s AND %(last)s
+          AND s.total_max IS NOT NULL
+    )
+    SELECT plant_id, plant_code, d, total_max,
+           total_max - prev_accum AS diff, max_kwh,
+           CASE WHEN COALESCE(prev_accum, 0) = 0 THEN day_max
+                WHEN total_max - prev_accum BETWEEN 0 AND max_kwh THEN total_max - prev_accum
+                ELSE day_max
+           END AS final_yield,
+           CASE WHEN COALESCE(prev_accum, 0) = 0 THEN 'raw_no_history'
+                WHEN total_max - prev_accum BETWEEN 0 AND max_kwh
+                     THEN CASE WHEN plant_id = %(casa_trejo)s THEN 'math_casa_trejo' ELSE 'math_calc' END
+                ELSE 'raw_fallback_outlier'
+           END AS method
+    FROM ref
+    ORDER BY d, plant_id
+"""
+
+# Filas parciales que el recolector fue escribiendo durante el día
+# (intraday.py, source = 'intraday_partial'), con las mismas columnas que
+# DAILY_YIELD_SQL: el método sale del acumulado al empezar el día y el tope
+PARTIAL_YIELD_SQL = """
+    WITH plants AS (
+        SELECT * FROM unnest(%(codes)s::text[], %(ids)s::int[], %(caps)s::float8[])
+                   AS p(plant_code, plant_id, max_kwh)
+    )
+    SELECT p.plant_id, m.plant_code, m.date, m.cumulative_energy_kwh AS total_max,
+           m.cumulative_energy_kwh - m.day_start_kwh AS diff, p.max_kwh,
+           m.fv_yield_kwh AS final_yield,
+           CASE WHEN COALESCE(m.day_start_kwh, 0) = 0 THEN 'raw_no_history'
+                WHEN m.cumulative_energy_kwh - m.day_start_kwh BETWEEN 0 AND p.max_kwh
+                     THEN CASE WHEN p.plant_id = %(casa_trejo)s THEN 'math_casa_trejo' ELSE 'math_calc' END
+                ELSE 'raw_fallback_outlier'
+           END AS method
+    FROM fs.plant_daily_metrics m
+    JOIN plants p ON p.plant_id = m.plant_id
+    WHERE m.source = 'intraday_partial'
+      AND m.date BETWEEN %(first)s AND %(last)s
+"""
+
+UPSERT_DAILY_SQL = """
+    INSERT INTO fs.plant_daily_metrics
+    (plant_id, plant_code, date, fv_yield_kwh, inverter_yield_kwh,
+     cumulative_energy_kwh, specific_yield_kwh_kwp, source, quality_score, created_at)
+    VALUES %s
+    ON CONFLICT (plant_id, date) DO UPDATE SET
+        fv_yield_kwh = EXCLUDED.fv_yield_kwh,
+        inverter_yield_kwh = EXCLUDED.inverter_yield_kwh,
+        cumulative_energy_kwh = EXCLUDED.cumulative_energy_kwh,
+        specific_yield_kwh_kwp = EXCLUDED.specific_yield_kwh_kwp,
+        source = EXCLUDED.source,
+        quality_score = EXCLUDED.quality_score,
+        updated_at = NOW()
+"""
+
+def plant_cap(p):
+    """Tope diario de una planta del registro: max_daily_kwh (60 kWh para Casa
+    Trejo) o kWp × 6.5 h. None si no hay con qué calcularlo."""
+    if p.max_daily_kwh is not None:
+        return p.max_daily_kwh
+    if p.plant_id == CASA_TREJO_ID:
+        return CASA_TREJO_MAX_KWH
+    if p.capacity_kw:
+        return p.capacity_kw * PEAK_SUN_HOURS
+    return None
+
+def _plant_caps():
+    """Topes diarios por planta (plant_cap). Incluye plantas dadas de baja para
+    poder reprocesar su histórico."""
+    codes, ids, caps = [], [], []
+    for p in registry.plants(active_only=False):
+        cap = plant_cap(p)
+        if cap is None:
+            print(f"⚠️ {p.plant_code}: sin capacity_kw en dim.fs_plants, se omite")
+            continue
+        codes.append(p.plant_code)
+        ids.append(p.plant_id)
+        caps.append(cap)
+    return codes, ids, caps
+
+def consolidate_range(cursor, first_day, last_day, verbose=True):
+    """Recalcula fs.plant_daily_metrics para [first_day, last_day] (días locales):
+    una consulta para leer y una sentencia para escribir. Devuelve filas escritas.
+
+    Las plantas que tienen fila parcial del recolector en todos los días del
+    rango no se recalculan: esas filas sólo se cierran."""
+    start, end = local_day_range(first_day - timedelta(days=1), last_day)
+    registry.refresh(cur=cursor, force=True)
+    codes, ids, caps = _plant_caps()
+    params = {"start": start, "end": end, "first": first_day, "last": last_day,
+              "codes": codes, "ids": ids, "caps": caps, "casa_trejo": CASA_TREJO_ID}
+    cursor.execute(PARTIAL_YIELD_SQL, params)
+    partial = cursor.fetchall()
+    n_days = (last_day - first_day).days + 1
+    per_code = {}
+    for r in partial:
+        per_code[r[1]] = per_code.get(r[1], 0) + 1
+    closed = {c for c, n in per_code.items() if n == n_days}
+    rows = [r for r in partial if r[1] in closed]
+    if closed:
+        print(f"⚡ {len(closed)} plantas se cierran desde la fila intradía del recolector")
+    rest = [i for i, c in enumerate(codes) if c not in closed]
+    if rest:
+        daily = DAILY_FROM_RAW if DAILY_SOURCE == 'raw' else DAILY_FROM_AGG
+        cursor.execute(DAILY_YIELD_SQL.format(daily=daily), dict(
+            params, codes=[codes[i] for i in rest], ids=[ids[i] for i in rest], caps=[caps[i] for i in rest]))
+        rows += cursor.fetchall()
+    rows.sort(key=lambda r: (r[2], r[0]))
+
+    # Calidad de todo el rango y todas las plantas en una sola pasada vectorizada
+    checks = {}
+    if QUALITY_ENABLED and rows:
+        kwp = {p.plant_code: p.capacity_kw for p in registry.plants(active_only=False)}
+        checks = quality.assess_range(cursor, codes, kwp, first_day, last_day, start, end)
+
+    upserts = []
+    methods = {}
+    for plant_id, p_code, day, total, diff, max_kwh, final_yield, method in rows:
+        final_yield = float(final_yield)
+        q = checks.get((p_code, day))
+        if method == "raw_fallback_outlier":
+            if plant_id == CASA_TREJO_ID:
+                print(f"⚠️ {day} Casa Trejo: Diferencia sospechosa ({diff:.2f}), usando raw")
+            else:
+                print(f"⚠️ {day} {p_code}: Diferencia {diff:.2f} > Máx {max_kwh:.2f}")
+            if q and q.score >= QUALITY_MIN_SCORE and 0 <= q.energy_kwh <= max_kwh:
+                print(f"   ↳ energía reconstruida {q.energy_kwh:.2f} kWh (calidad {q.score:.2f}, "
+                      f"huecos={q.gaps} picos={q.spikes} reinicios={q.resets})")
+                final_yield, method = q.energy_kwh, "quality_filled"
+        if final_yield < 0:
+            continue
+        kwp = registry.get_id(plant_id).capacity_kw or 1
+        spec = round(final_yield / kwp, 3)
+        score = q.score if q else None
+        upserts.append((plant_id, p_code, day, final_yield, final_yield, total, spec, f'fallback_{method}', score))
+        methods[method] = methods.get(method, 0) + 1
+        if verbose:
+            q_txt = f" calidad={score:.2f}" if score is not None else ""
+            print(f"✅ {day} ID={plant_id} ({p_code}): {final_yield:.2f} kWh [{method}]{q_txt}")
+
+    # INSERTAR / ACTUALIZAR (todas las filas en una sola sentencia)
+    if upserts:
+        psycopg2.extras.execute_values(
+            cursor, UPSERT_DAILY_SQL, upserts,
+            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())",
+            page_size=1000,
+        )
+    if not verbose and methods:
+        print("Métodos: " + ", ".join(f"{m}={n}" for m, n in sorted(methods.items())))
+    return len(upserts)
+
+def parse_args(argv=None):
+    # CRÍTICO: por defecto se procesa AYER (completo), no HOY (incompleto).
     # Si servidor está en UTC (01:00 AM), procesamos la fecha de ayer.
-    target_date = (datetime.now() - timedelta(days=1)).date()
-    yesterday = target_date - timedelta(days=1)
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+    parser = argparse.ArgumentParser(description="Consolida raw.fs_realtime_plants en fs.plant_daily_metrics")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, default=None,
+                        help="primer día a reprocesar (YYYY-MM-DD); por defecto ayer")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=None,
+                        help="último día a reprocesar (YYYY-MM-DD); por defecto ayer")
+    args = parser.parse_args(argv)
+    args.date_from = args.date_from or args.date_to or yesterday
+    args.date_to = args.date_to or (yesterday if args.date_from <= yesterday else args.date_from)
+    if args.date_to < args.date_from:
+        parser.error("--to debe ser igual o posterior a --from")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    first_day, last_day = args.date_from, args.date_to
+    n_days = (last_day - first_day).days + 1
     
     print(f"\n{'='*60}")
     print(f"CONSOLIDACIÓN FALLBACK MATEMÁTICO")
-    print(f"Fecha objetivo: {target_date}")
+    if n_days == 1:
+        print(f"Fecha objetivo: {first_day}")
+    else:
+        print(f"Rango: {first_day} → {last_day} ({n_days} días)")
     print(f"{'='*60}\n")
     
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Obtener acumulados de HOY desde raw
-        # CORRECCIÓN SQL: Usamos ::date en lugar de date()
-        cursor.execute("""
-            SELECT plant_code, MAX(total_power_kwh), MAX(day_power_kwh)
-            FROM raw.fs_realtime_plants
-            WHERE (ts_utc AT TIME ZONE 'America/Bogota')::date = %s
-            GROUP BY plant_code
-        """, (target_date,))
-        
-        rows_today = cursor.fetchall()
+        processed = consolidate_range(cursor, first_day, last_day, verbose=n_days <= 7)
         
-        if not rows_today:
-            print("⚠️ No hay datos en raw.fs_realtime_plants para", target_date)
+        if not processed:
+            print("⚠️ No hay datos en raw.fs_realtime_plants para", first_day if n_days == 1 else f"{first_day} → {last_day}")
             sys.exit(1)
-        
-        processed = 0
-        
-        for row in rows_today:
-            p_code, total_today, raw_day = row
-            plant_id = PLANT_MAP.get(p_code)
-            
-            if not plant_id or total_today is None:
-                continue
-            
-            final_yield = 0.0
-            method = "raw_unknown"
-            
-            # --- CASO ESPECIAL: CASA TREJO (ID 6) ---
-            if plant_id == 6:
-                # Buscar el acumulado FINAL OFICIAL de ayer en la tabla consolidada
-                cursor.execute("""
-                    SELECT cumulative_energy_kwh 
-                    FROM fs.plant_daily_metrics 
-                    WHERE plant_id = 6 AND date = %s
-                """, (yesterday,))
-                
-                row_prev = cursor.fetchone()
-                
-                if row_prev and row_prev[0]:
-                    prev_accum = float(row_prev[0])
-                    diff = float(total_today) - prev_accum
-                    
-                    # Filtro estricto: Máximo 60 kWh/día
-                    if 0 <= diff <= 60:
-                        final_yield = diff
-                        method = "math_casa_trejo"
-                    else:
-                        final_yield = float(raw_day or 0)
-                        method = "raw_fallback_outlier"
-                        print(f"⚠️ Casa Trejo: Diferencia sospechosa ({diff:.2f}), usando raw")
-                else:
-                    final_yield = float(raw_day or 0)
-                    method = "raw_no_history"
-            
-            # --- PLANTAS NORMALES (ID 1-5) ---
-            else:
-                # Buscamos el acumulado RAW de ayer
-                # CORRECCIÓN SQL: Usamos ::date
-                cursor.execute("""
-                    SELECT MAX(total_power_kwh) 
-                    FROM raw.fs_realtime_plants 
-                    WHERE plant_code = %s 
-                      AND (ts_utc AT TIME ZONE 'America/Bogota')::date = %s
-                """, (p_code, yesterday))
-                
-                row_raw_prev = cursor.fetchone()
-                
-                if row_raw_prev and row_raw_prev[0]:
-                    prev_accum = float(row_raw_prev[0])
-                    diff = float(total_today) - prev_accum
-                    
-                    # Filtro Dinámico: Capacidad * 6.5 Horas Sol Pico
-                    max_expected = PLANT_KWP[plant_id] * 6.5
-                    
-                    if 0 <= diff <= max_expected:
-                        final_yield = diff
-                        method = "math_calc"
-                    else:
-                        final_yield = float(raw_day or 0)
-                        method = "raw_fallback_outlier"
-                        print(f"⚠️ {p_code}: Diferencia {diff:.2f} > Máx {max_expected:.2f}")
-                else:
-                    final_yield = float(raw_day or 0)
-                    method = "raw_no_history"
-
-            # INSERTAR / ACTUALIZAR
-            if final_yield >= 0:
-                kwp = PLANT_KWP.get(plant_id, 1)
-                spec = round(final_yield / kwp, 3)
-                
-                cursor.execute("""
-                    INSERT INTO fs.plant_daily_metrics 
-                    (plant_id, plant_code, date, fv_yield_kwh, inverter_yield_kwh, 
-                     cumulative_energy_kwh, specific_yield_kwh_kwp, source, created_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
-                    ON CONFLICT (plant_id, date) DO UPDATE SET
-                        fv_yield_kwh = EXCLUDED.fv_yield_kwh,
-                        inverter_yield_kwh = EXCLUDED.inverter_yield_kwh,
-                        cumulative_energy_kwh = EXCLUDED.cumulative_energy_kwh,
-                        specific_yield_kwh_kwp = EXCLUDED.specific_yield_kwh_kwp,
-                        source = EXCLUDED.source,
-                        updated_at = NOW()
-                """, (plant_id, p_code, target_date, final_yield, final_yield, 
-                      total_today, spec, f'fallback_{method}'))
-                
-                print(f"✅ ID={plant_id} ({p_code}): {final_yield:.2f} kWh [{method}]")
-                processed += 1
 
         conn.commit()
         conn.close()
         
         print(f"\n{'='*60}")
-        print(f"✅ Completado: {processed} plantas procesadas")
+        print(f"✅ Completado: {processed} filas planta-día procesadas")
         print(f"{'='*60}\n")
         
     except Exception as e:
@@ -0,0 +1,212 @@
+import os
+import socket
+import hashlib
+import threading
+import time
+from contextlib import contextmanager, suppress
+import psycopg2
+import psycopg2.extras
+
+import metrics
+from db_writer import _conn_params
+
+# ─────────────────────────────────────────────────────────
+# Varias réplicas del recolector coordinadas por Postgres
+# ─────────────────────────────────────────────────────────
+# Con COORDINATION=1 cada réplica:
+#   - renueva su fila en ops.collector_replicas cada COORD_HEARTBEAT_SECONDS; las
+#     réplicas vivas son las que latieron en los últimos COORD_LEASE_SECONDS
+#   - reparte el trabajo con hashing de rendezvous (HRW) sobre las réplicas
+#     vivas: cada clave (un lote de hasta 100 plantas de una cuenta, o las
+#     tareas de cuenta: medidores, alta de plantas, huecos) es de la réplica con
+#     mayor hash(clave, réplica). Si una réplica muere o llega otra, sólo se
+#     mueven sus claves
+#   - comparte el rate-limit de cada usuario Northbound en ops.rate_ledger
+#     (una fila por endpoint, bloqueada con SELECT … FOR UPDATE en cada turno) en
+#     lugar del .rate_state.json local, así N réplicas nunca suman más llamadas
+#     que una sola
+# Si la base no responde, cada réplica sigue con el último reparto conocido y
+# con su copia local del rate-limit hasta que vuelva; cada turno decidido así
+# se avisa en el log y en fusion_rate_ledger_fallbacks_total.
+
+LEASE_SQL = """
+    INSERT INTO ops.collector_replicas (replica_id, host, shards)
+    VALUES (%(id)s, %(host)s, %(shards)s)
+    ON CONFLICT (replica_id) DO UPDATE SET
+      heartbeat_utc = now(),
+      host          = EXCLUDED.host,
+      shards        = EXCLUDED.shards
+"""
+
+LIVE_SQL = """
+    SELECT replica_id FROM ops.collector_replicas
+    WHERE heartbeat_utc > now() - make_interval(secs => %(lease)s)
+    ORDER BY replica_id
+"""
+
+PRUNE_SQL = "DELETE FROM ops.collector_replicas WHERE heartbeat_utc < now() - interval '1 day'"
+
+LEDGER_LOCK_SQL = [
+    """INSERT INTO ops.rate_ledger (account, endpoint) VALUES (%(account)s, %(endpoint)s)
+       ON CONFLICT (account, endpoint) DO NOTHING""",
+    """SELECT state FROM ops.rate_ledger
+       WHERE account = %(account)s AND endpoint = %(endpoint)s FOR UPDATE""",
+]
+
+LEDGER_SAVE_SQL = """
+    UPDATE ops.rate_ledger SET state = %(state)s, updated_utc = now()
+    WHERE account = %(account)s AND endpoint = %(endpoint)s
+"""
+
+LEDGER_LOAD_SQL = "SELECT endpoint, state FROM ops.rate_ledger WHERE account = %s AND state IS NOT NULL"
+
+def default_replica_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def _score(key, replica):
+    return hashlib.sha1(f"{key}|{replica}".encode()).digest()
+
+def owner(key, replicas):
+    """Réplica dueña de `key` entre `replicas` (hashing de rendezvous)."""
+    return max(replicas, key=lambda r: _score(key, r)) if replicas else None
+
+class Coordinator:
+    """Membresía y reparto de claves. `connect()` como en PlantRegistry."""
+
+    def __init__(self, connect, replica_id=None, lease_seconds=None, heartbeat_seconds=None):
+        self.connect = connect
+        self.replica_id = replica_id or default_replica_id()
+        self.host = socket.gethostname()
+        self.lease = lease_seconds if lease_seconds is not None else float(os.getenv("COORD_LEASE_SECONDS", "60"))
+        self.heartbeat_seconds = heartbeat_seconds if heartbeat_seconds is not None else float(os.getenv("COORD_HEARTBEAT_SECONDS", "15"))
+        self.lock = threading.Lock()
+        self.replicas = [self.replica_id]
+        self.owned = []             # claves propias en el último reparto (se publican en el latido)
+        self.last_beat = 0.0
+
+    def heartbeat(self):
+        """Renueva la fila propia y relee las réplicas vivas. Devuelve True si
+        cambió la membresía."""
+        try:
+            with self.connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(LEASE_SQL, {"id": self.replica_id, "host": self.host, "shards": list(self.owned)})
+                    cur.execute(LIVE_SQL, {"lease": self.lease})
+                    live = [r[0] for r in cur.fetchall()]
+                    cur.execute(PRUNE_SQL)
+                conn.commit()
+        except psycopg2.Error as e:
+            print(f"⚠️ Coordinación: sin latido ({e}); se mantiene el reparto anterior")
+            return False
+        if self.replica_id not in live:
+            live.append(self.replica_id)
+        live.sort()
+        with self.lock:
+            changed = live != self.replicas
+            self.replicas = live
+            self.last_beat = time.time()
+        return changed
+
+    def owns(self, key):
+        with self.lock:
+            return owner(key, self.replicas) == self.replica_id
+
+    def release(self):
+        """Borra la fila propia al salir: las demás réplicas toman sus claves en
+        su próximo latido en vez de esperar a que venza el lease."""
+        try:
+            with self.connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM ops.collector_replicas WHERE replica_id = %s", (self.replica_id,))
+                conn.commit()
+        except psycopg2.Error:
+            pass
+
+class LedgerRow:
+    state = None
+
+class RateLedger:
+    """Estado compartido del RateScheduler de un usuario Northbound
+    (ver rate_limit.RateScheduler, parámetro `ledger`). Usa una conexión propia,
+    fuera del pool de db_writer: un pool agotado por el writer no puede hacer que
+    los turnos se decidan en silencio con la copia local."""
+
+    def __init__(self, account, connect=None):
+        self.account = account
+        self.connect = connect or (lambda: psycopg2.connect(**_conn_params()))
+        self.conn = None
+        self.lock = threading.Lock()        # una operación a la vez sobre self.conn
+        self.fallbacks = 0
+
+    def _conn(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+        return self.conn
+
+    def _drop(self):
+        if self.conn is not None:
+            with suppress(psycopg2.Error):
+                self.conn.close()
+        self.conn = None
+
+    def _fallback(self, what, e):
+        self.fallbacks += 1
+        metrics.RATE_LEDGER_FALLBACKS.inc(account=self.account)
+        print(f"🚨 Rate-limit compartido NO disponible para {self.account} ({what}: {str(e).strip()}); "
+              f"se usa la copia local, sin límite entre réplicas (fallbacks={self.fallbacks})")
+
+    def load(self):
+        """{endpoint: estado} de todos los endpoints con estado guardado, sin
+        bloquear filas. None si la base no responde."""
+        with self.lock:
+            try:
+                conn = self._conn()
+                with conn.cursor() as cur:
+                    cur.execute(LEDGER_LOAD_SQL, (self.account,))
+                    data = dict(cur.fetchall())
+                conn.rollback()
+                return data
+            except psycopg2.Error as e:
+                self._drop()
+                self._fallback("lectura", e)
+                return None
+
+    @contextmanager
+    def locked(self, endpoint):
+        """Fila de `endpoint` bloqueada durante el bloque, con row.state cargado;
+        al salir sin error se guarda row.state y se libera. Si la base no
+        responde el bloque corre igual con row.state = None y no se guarda nada."""
+        row = LedgerRow()
+        params = {"account": self.account, "endpoint": endpoint}
+        with self.lock:
+            try:
+                conn = self._conn()
+                with conn.cursor() as cur:
+                    for sql in LEDGER_LOCK_SQL:
+                        cur.execute(sql, params)
+                    row.state = cur.fetchone()[0]
+            except psycopg2.Error as e:
+                self._drop()
+                self._fallback("bloqueo", e)
+                conn = None
+            if conn is None:
+                yield row
+                return
+            try:
+                yield row
+            except BaseException:
+                with suppress(psycopg2.Error):
+                    conn.rollback()
+                raise
+            try:
+                if row.state is not None:
+                    with conn.cursor() as cur:
+                        cur.execute(LEDGER_SAVE_SQL, dict(params, state=psycopg2.extras.Json(row.state)))
+                conn.commit()
+            except psycopg2.Error as e:
+                self._drop()
+                self._fallback("guardado", e)
+
+    def close(self):
+        with self.lock:
+            self._drop()
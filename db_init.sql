@@ -9,18 +9,49 @@ CREATE TABLE IF NOT EXISTS dim.fs_plants (
   capacity_kw numeric
 );
 
+-- Registro único de plantas (plant_registry.py): id de fs.plant_daily_metrics,
+-- tope diario opcional, coordenadas para el horario solar y baja lógica. Las
+-- plantas nuevas las agrega el recolector desde la lista de plantas de la API
+-- y reciben plant_id de la secuencia; lo cargado a mano no se sobrescribe.
+CREATE SEQUENCE IF NOT EXISTS dim.fs_plants_id_seq;
+ALTER TABLE dim.fs_plants
+  ADD COLUMN IF NOT EXISTS plant_id      int UNIQUE,
+  ADD COLUMN IF NOT EXISTS max_daily_kwh numeric,          -- NULL = capacity_kw × 6.5 h sol pico
+  ADD COLUMN IF NOT EXISTS latitude      double precision,
+  ADD COLUMN IF NOT EXISTS longitude     double precision,
+  ADD COLUMN IF NOT EXISTS active        boolean NOT NULL DEFAULT true,
+  ADD COLUMN IF NOT EXISTS updated_utc   timestamptz NOT NULL DEFAULT now();
+
+INSERT INTO dim.fs_plants (plant_code, plant_id, plant_name, capacity_kw, max_daily_kwh) VALUES
+  ('NE=33876570', 1, 'Cabañita',   116.0,   NULL),
+  ('NE=33801790', 2, 'Maracaibo',  116.0,   NULL),
+  ('NE=33745211', 3, 'Porvenir',   143.0,   NULL),
+  ('NE=33758743', 4, 'Pozo 2',     116.0,   NULL),
+  ('NE=33723010', 5, 'Pozo 1',     119.56,  NULL),
+  ('NE=33788377', 6, 'Casa Trejo', 9.765,   60)
+ON CONFLICT (plant_code) DO UPDATE SET
+  plant_id      = EXCLUDED.plant_id,
+  plant_name    = COALESCE(dim.fs_plants.plant_name, EXCLUDED.plant_name),
+  capacity_kw   = COALESCE(dim.fs_plants.capacity_kw, EXCLUDED.capacity_kw),
+  max_daily_kwh = COALESCE(dim.fs_plants.max_daily_kwh, EXCLUDED.max_daily_kwh);
+SELECT setval('dim.fs_plants_id_seq', GREATEST((SELECT MAX(plant_id) FROM dim.fs_plants), 1));
+ALTER SEQUENCE dim.fs_plants_id_seq OWNED BY dim.fs_plants.plant_id;
+ALTER TABLE dim.fs_plants ALTER COLUMN plant_id SET DEFAULT nextval('dim.fs_plants_id_seq');
+UPDATE dim.fs_plants SET plant_id = nextval('dim.fs_plants_id_seq') WHERE plant_id IS NULL;
+
 -- ===== Datos crudos (planta) =====
 CREATE SCHEMA IF NOT EXISTS raw;
 
+-- Columnas de ancho fijo (el nombre de la planta vive en dim.fs_plants); en
+-- despliegues con la versión numeric anterior ver migrate_compact.py
 CREATE TABLE IF NOT EXISTS raw.fs_realtime_plants (
   ts_utc           timestamptz NOT NULL,
   plant_code       text        NOT NULL,
-  plant_name       text,
-  power_kw         numeric,              -- potencia instantánea
-  day_power_kwh    numeric,
-  month_power_kwh  numeric,
-  total_power_kwh  numeric,
-  health           int,                  -- 1=OFF,2=FALLA,3=OK
+  power_kw         real,                 -- potencia instantánea
+  day_power_kwh    real,
+  month_power_kwh  double precision,
+  total_power_kwh  double precision,     -- contador de vida: necesita 15 dígitos
+  health           smallint,             -- 1=OFF,2=FALLA,3=OK
   PRIMARY KEY (ts_utc, plant_code)
 );
 SELECT create_hypertable('raw.fs_realtime_plants','ts_utc',
@@ -42,10 +73,10 @@ CREATE TABLE IF NOT EXISTS raw.fs_plants_last (
 CREATE TABLE IF NOT EXISTS raw.fs_meter_realtime (
   ts_utc     timestamptz NOT NULL,
   plant_code text        NOT NULL,
-  import_kw  numeric,
-  export_kw  numeric,
-  load_kw    numeric,
-  self_use_kw numeric,
+  import_kw  real,
+  export_kw  real,
+  load_kw    real,
+  self_use_kw real,
   PRIMARY KEY (ts_utc, plant_code)
 );
 SELECT create_hypertable('raw.fs_meter_realtime','ts_utc',
@@ -57,13 +88,17 @@ CREATE INDEX IF NOT EXISTS idx_fs_realtime_plants ON raw.fs_realtime_plants(plan
 CREATE INDEX IF NOT EXISTS idx_fs_meter_realtime   ON raw.fs_meter_realtime(plant_code, ts_utc DESC);
 
 -- ===== Políticas de compresión y retención =====
+-- Segmentos por planta ordenados por tiempo descendente: las lecturas "últimas
+-- N horas de una planta" descomprimen sólo el principio de cada segmento
 ALTER TABLE raw.fs_realtime_plants SET (
   timescaledb.compress,
-  timescaledb.compress_segmentby = 'plant_code'
+  timescaledb.compress_segmentby = 'plant_code',
+  timescaledb.compress_orderby   = 'ts_utc DESC'
 );
 ALTER TABLE raw.fs_meter_realtime SET (
   timescaledb.compress,
-  timescaledb.compress_segmentby = 'plant_code'
+  timescaledb.compress_segmentby = 'plant_code',
+  timescaledb.compress_orderby   = 'ts_utc DESC'
 );
 SELECT add_compression_policy('raw.fs_realtime_plants', INTERVAL '7 days');
 SELECT add_compression_policy('raw.fs_meter_realtime',  INTERVAL '7 days');
@@ -72,6 +107,115 @@ SELECT add_retention_policy('raw.fs_meter_realtime',   INTERVAL '180 days');
 
 -- Asegura columna de autoconsumo en despliegues existentes
 ALTER TABLE raw.fs_meter_realtime
-  ADD COLUMN IF NOT EXISTS self_use_kw numeric;
+  ADD COLUMN IF NOT EXISTS self_use_kw real;
+
+
+
+-- ===== Agregados continuos (hora y día) =====
+-- Curvas horarias y máximos diarios por planta sin escanear la hypertable cruda.
+-- materialized_only = false → agregación en tiempo real (lo aún no materializado
+-- se completa al vuelo desde raw). Las políticas de refresco sólo recalculan los
+-- últimos días, así que al borrar la retención los chunks crudos de >180 días el
+-- histórico agregado se conserva.
+CREATE SCHEMA IF NOT EXISTS agg;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS agg.fs_plants_hourly
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT plant_code,
+       time_bucket(INTERVAL '1 hour', ts_utc) AS bucket,
+       AVG(power_kw)                  AS power_kw_avg,
+       MAX(power_kw)                  AS power_kw_max,
+       last(total_power_kwh, ts_utc)  AS total_power_kwh_last,
+       MAX(total_power_kwh)           AS total_power_kwh_max,
+       MAX(day_power_kwh)             AS day_power_kwh_max,
+       COUNT(*)                       AS samples
+FROM raw.fs_realtime_plants
+GROUP BY plant_code, bucket
+WITH NO DATA;
+
+-- Día local (America/Bogota), encadenado sobre el agregado horario
+CREATE MATERIALIZED VIEW IF NOT EXISTS agg.fs_plants_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT plant_code,
+       time_bucket(INTERVAL '1 day', bucket, 'America/Bogota') AS day,
+       SUM(power_kw_avg * samples) / NULLIF(SUM(samples), 0)    AS power_kw_avg,
+       MAX(power_kw_max)                                         AS power_kw_max,
+       last(total_power_kwh_last, bucket)                        AS total_power_kwh_last,
+       MAX(total_power_kwh_max)                                  AS total_power_kwh_max,
+       MAX(day_power_kwh_max)                                    AS day_power_kwh_max,
+       SUM(samples)                                              AS samples
+FROM agg.fs_plants_hourly
+GROUP BY plant_code, day
+WITH NO DATA;
 
+SELECT add_continuous_aggregate_policy('agg.fs_plants_hourly',
+         start_offset => INTERVAL '3 days',
+         end_offset   => INTERVAL '1 hour',
+         schedule_interval => INTERVAL '30 minutes',
+         if_not_exists => TRUE);
+SELECT add_continuous_aggregate_policy('agg.fs_plants_daily',
+         start_offset => INTERVAL '7 days',
+         end_offset   => INTERVAL '1 day',
+         schedule_interval => INTERVAL '1 hour',
+         if_not_exists => TRUE);
+
+ALTER MATERIALIZED VIEW agg.fs_plants_hourly SET (timescaledb.compress = true);
+SELECT add_compression_policy('agg.fs_plants_hourly', compress_after => INTERVAL '30 days', if_not_exists => TRUE);
+
+-- Carga inicial del histórico (UNA sola vez y fuera de una transacción, mientras
+-- raw todavía tiene los 180 días; no repetir después: refrescar una ventana ya
+-- borrada por la retención vaciaría esos días del agregado):
+--   CALL refresh_continuous_aggregate('agg.fs_plants_hourly', NULL, now() - INTERVAL '1 hour');
+--   CALL refresh_continuous_aggregate('agg.fs_plants_daily',  NULL, date_trunc('day', now()));
+
+-- ===== Calidad de datos (quality.py / consolidate_daily.py) =====
+-- Puntaje 0..1 de las muestras crudas de cada planta-día (cobertura × contador válido)
+ALTER TABLE IF EXISTS fs.plant_daily_metrics
+  ADD COLUMN IF NOT EXISTS quality_score real;
+
+-- ===== Reparación de huecos (gap_repair.py) =====
+-- Origen de cada muestra: NULL = tiempo real (getStationRealKpi),
+-- 'kpi_hour' = recuperada de getKpiStationHour para tapar un hueco
+ALTER TABLE IF EXISTS raw.fs_realtime_plants
+  ADD COLUMN IF NOT EXISTS source text;
+
+-- ===== Varias réplicas del recolector (coordination.py) =====
+CREATE SCHEMA IF NOT EXISTS ops;
+
+-- Una fila por réplica viva; vence si no late en COORD_LEASE_SECONDS
+CREATE TABLE IF NOT EXISTS ops.collector_replicas (
+  replica_id    text PRIMARY KEY,
+  host          text,
+  started_utc   timestamptz NOT NULL DEFAULT now(),
+  heartbeat_utc timestamptz NOT NULL DEFAULT now(),
+  shards        text[]                           -- claves propias (informativo)
+);
+
+-- Estado del rate-limit por usuario Northbound y endpoint, compartido entre réplicas
+CREATE TABLE IF NOT EXISTS ops.rate_ledger (
+  account     text NOT NULL,                     -- usuario@dominio
+  endpoint    text NOT NULL,
+  state       jsonb,
+  updated_utc timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY (account, endpoint)
+);
+
+-- ===== Archivo Parquet de datos crudos (archive_parquet.py) =====
+-- Un registro por tabla y día UTC ya escrito en ARCHIVE_URI; esos días no se
+-- vuelven a leer aunque la retención todavía no los haya borrado
+CREATE TABLE IF NOT EXISTS ops.archive_log (
+  table_name   text   NOT NULL,                  -- raw.fs_realtime_plants / raw.fs_meter_realtime
+  day          date   NOT NULL,                  -- día UTC (= un chunk)
+  rows         bigint NOT NULL,
+  files        int    NOT NULL,
+  bytes        bigint NOT NULL,
+  uri          text,
+  archived_utc timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY (table_name, day)
+);
 
+-- ===== Rendimiento intradía (intraday.py / consolidate_daily.py) =====
+-- El recolector escribe la fila del día en curso con source = 'intraday_partial'
+-- y el acumulado con que empezó el día; la consolidación nocturna la cierra
+ALTER TABLE IF EXISTS fs.plant_daily_metrics
+  ADD COLUMN IF NOT EXISTS day_start_kwh double precision;
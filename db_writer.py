@@ -0,0 +1,417 @@
+import os
+import json
+import time
+import threading
+import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+
+import metrics
+
+# ─────────────────────────────────────────────────────────
+# Pool de conexiones (persistente, con reconexión)
+# ─────────────────────────────────────────────────────────
+_pool = None
+_pool_lock = threading.Lock()
+
+def _conn_params():
+    return dict(
+        host=os.getenv("PGHOST"),
+        port=os.getenv("PGPORT"),
+        dbname=os.getenv("PGDATABASE"),
+        user=os.getenv("PGUSER"),
+        password=os.getenv("PGPASSWORD"),
+        sslmode=os.getenv("PGSSLMODE", "require"),
+        connect_timeout=int(os.getenv("PGCONNECT_TIMEOUT", "10")),
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                1, int(os.getenv("DB_POOL_MAX", "4")), **_conn_params()
+            )
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+class pooled_conn:
+    """`with pooled_conn() as conn:` presta una conexión del pool. Si la conexión
+    falló (caída de red, reinicio de Postgres) se descarta en vez de devolverla,
+    así la siguiente vez el pool abre una nueva."""
+
+    def __enter__(self):
+        self.pool = get_pool()
+        self.conn = self.pool.getconn()
+        if self.conn.closed:
+            self.pool.putconn(self.conn, close=True)
+            self.conn = self.pool.getconn()
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        broken = self.conn.closed or isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not broken and not self.conn.closed:
+            try:
+                self.conn.rollback()  # nunca devolver al pool una transacción abierta
+            except psycopg2.Error:
+                broken = True
+        self.pool.putconn(self.conn, close=broken)
+        return False
+
+# ─────────────────────────────────────────────────────────
+# Escritura en bloque
+# ─────────────────────────────────────────────────────────
+# El nombre de la planta no se repite en cada muestra: sólo va a fs_plants_last
+# (y a dim.fs_plants desde el registro)
+INSERT_REALTIME_SQL = """
+    INSERT INTO raw.fs_realtime_plants
+    (plant_code, ts_utc, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
+    VALUES %s
+    ON CONFLICT (ts_utc, plant_code) DO NOTHING
+"""
+
+UPSERT_LAST_SQL = """
+    INSERT INTO raw.fs_plants_last AS l
+    (plant_code, updated_utc, plant_name, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
+    VALUES %s
+    ON CONFLICT (plant_code) DO UPDATE SET
+      updated_utc      = EXCLUDED.updated_utc,
+      plant_name       = EXCLUDED.plant_name,
+      power_kw         = EXCLUDED.power_kw,
+      day_power_kwh    = EXCLUDED.day_power_kwh,
+      month_power_kwh  = EXCLUDED.month_power_kwh,
+      total_power_kwh  = EXCLUDED.total_power_kwh,
+      health           = EXCLUDED.health
+    WHERE l.updated_utc <= EXCLUDED.updated_utc
+"""
+
+INSERT_METER_SQL = """
+    INSERT INTO raw.fs_meter_realtime
+    (ts_utc, plant_code, import_kw, export_kw, load_kw, self_use_kw)
+    VALUES %s
+    ON CONFLICT (ts_utc, plant_code) DO NOTHING
+"""
+
+# Puntos recuperados por gap_repair.py (getKpiStationHour); nunca pisan una
+# muestra de tiempo real y no tocan raw.fs_plants_last
+INSERT_REPAIR_SQL = """
+    INSERT INTO raw.fs_realtime_plants
+    (plant_code, ts_utc, power_kw, day_power_kwh, source)
+    VALUES %s
+    ON CONFLICT (ts_utc, plant_code) DO NOTHING
+"""
+
+# Aviso a read_api.py de cada fila nueva de raw.fs_plants_last: pg_notify en la
+# misma transacción (llega sólo si el commit se hace). El payload de NOTIFY tiene
+# un límite de 8000 bytes, así que las filas van en trozos JSON más chicos.
+# PLANTS_NOTIFY_CHANNEL vacío desactiva el aviso.
+NOTIFY_SQL = "SELECT pg_notify(%s, p) FROM unnest(%s::text[]) AS p"
+NOTIFY_MAX_BYTES = 7900
+
+def notify_channel():
+    return os.getenv("PLANTS_NOTIFY_CHANNEL", "fs_plants_last")
+
+def _json_value(v):
+    return v.isoformat() if hasattr(v, "isoformat") else float(v)
+
+def notify_payloads(rows, max_bytes=NOTIFY_MAX_BYTES):
+    """Filas de fs_plants_last (plant_code, updated_utc, plant_name, power_kw, day,
+    month, total, health) → payloads JSON "[[...],[...]]" de menos de `max_bytes`."""
+    payloads, parts, size = [], [], 2
+    for row in rows:
+        part = json.dumps(list(row), separators=(",", ":"), ensure_ascii=False, default=_json_value)
+        n = len(part.encode()) + 1
+        if parts and size + n > max_bytes:
+            payloads.append("[" + ",".join(parts) + "]")
+            parts, size = [], 2
+        parts.append(part)
+        size += n
+    if parts:
+        payloads.append("[" + ",".join(parts) + "]")
+    return payloads
+
+def latest_per_plant(rows):
+    """La fila más reciente de cada planta (filas: plant_code, ts_utc, ...)."""
+    last_rows = {}
+    for row in rows:
+        prev = last_rows.get(row[0])
+        if prev is None or row[1] >= prev[1]:
+            last_rows[row[0]] = row
+    return list(last_rows.values())
+
+def write_rows(rows, intraday=None):
+    """Un INSERT multi-fila en la hypertable + un UPSERT multi-fila en fs_plants_last
+    (+ su pg_notify), en una sola transacción. Con `intraday`
+    (intraday.IntradayYield) también las filas parciales del día en
+    fs.plant_daily_metrics."""
+    latest = latest_per_plant(rows)
+    channel = notify_channel()
+    pending = []
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, INSERT_REALTIME_SQL, [(r[0], r[1], *r[3:]) for r in rows],
+                                           page_size=1000)
+            psycopg2.extras.execute_values(cur, UPSERT_LAST_SQL, latest)
+            if channel:
+                cur.execute(NOTIFY_SQL, (channel, notify_payloads(latest)))
+            if intraday is not None:
+                pending = intraday.apply(cur, rows)
+        conn.commit()
+    if pending:
+        intraday.written(pending)
+
+def write_meter_rows(rows):
+    """Un INSERT multi-fila en raw.fs_meter_realtime (ts_utc, plant_code, import_kw,
+    export_kw, load_kw, self_use_kw)."""
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, INSERT_METER_SQL, rows, page_size=1000)
+        conn.commit()
+
+def write_repair_rows(rows, intraday=None):
+    """Un INSERT multi-fila de puntos recuperados (plant_code, ts_utc, power_kw,
+    day_power_kwh, source). Su day_power_kwh también cuenta para `intraday`."""
+    pending = []
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, INSERT_REPAIR_SQL, rows, page_size=1000)
+            if intraday is not None:
+                pending = intraday.apply(cur, [(c, ts, None, kw, day, None, None, None)
+                                               for c, ts, kw, day, _ in rows])
+        conn.commit()
+    if pending:
+        intraday.written(pending)
+
+# Escritor en bloque por tipo de fila
+WRITERS = {"plant": write_rows, "meter": write_meter_rows, "repair": write_repair_rows}
+
+# ─────────────────────────────────────────────────────────
+# Detección de cambios (no reinsertar muestras idénticas)
+# ─────────────────────────────────────────────────────────
+class ChangeFilter:
+    """Último valor escrito por planta. Una muestra igual a la anterior (potencia,
+    acumulados, salud y nombre) se descarta salvo que hayan pasado
+    `heartbeat_seconds` desde la última escrita, que queda como latido periódico.
+    Con heartbeat_seconds = 0 no se filtra nada."""
+
+    def __init__(self, heartbeat_seconds=None):
+        self.heartbeat_seconds = heartbeat_seconds if heartbeat_seconds is not None else float(os.getenv("DEDUP_HEARTBEAT_SECONDS", "900"))
+        self.last = {}      # plant_code → (ts_utc, valores)
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def seed(self):
+        """Carga el último estado de raw.fs_plants_last (si la base responde)."""
+        if self.heartbeat_seconds <= 0:
+            return 0
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT plant_code, updated_utc, plant_name, power_kw, day_power_kwh,
+                               month_power_kwh, total_power_kwh, health
+                        FROM raw.fs_plants_last
+                    """)
+                    rows = cur.fetchall()
+        except psycopg2.Error as e:
+            print(f"⚠️ No se pudo leer raw.fs_plants_last para deduplicar: {e}")
+            return 0
+        with self.lock:
+            for row in rows:
+                self.last[row[0]] = (row[1], self._values(row))
+        return len(rows)
+
+    @staticmethod
+    def _values(row):
+        # plant_name, power_kw, day, month, total, health (numeric → float para comparar)
+        name, *nums, health = row[2:]
+        return (name, *(None if v is None else float(v) for v in nums), str(health or 0))
+
+    def filter(self, rows):
+        if self.heartbeat_seconds <= 0:
+            return rows
+        out = []
+        with self.lock:
+            for row in rows:
+                prev = self.last.get(row[0])
+                values = self._values(row)
+                if prev is not None:
+                    prev_ts, prev_values = prev
+                    fresh = (row[1] - prev_ts).total_seconds() < self.heartbeat_seconds
+                    if fresh and values == prev_values:
+                        self.skipped += 1
+                        metrics.SAMPLES_SKIPPED.inc(plant_code=row[0])
+                        continue
+                self.last[row[0]] = (row[1], values)
+                out.append(row)
+        return out
+
+class DbWriter:
+    """Buffer de escritura: acumula filas y las vacía por cantidad o por antigüedad.
+    Si la base no responde, las filas se quedan en el buffer para el próximo intento.
+    Cada tipo de fila ("plant", "meter", "repair") va a su propia tabla (ver WRITERS).
+
+    Con `spool` (ver spool.Spool) el buffer vive en disco: cada fila se guarda
+    primero en el spool y el flush lo drena en bloques, así que un corte de la
+    base o un reinicio del contenedor no pierden muestras. Con `intraday` las
+    filas de planta actualizan además el rendimiento del día (ver write_rows).
+
+    Tras un error de escritura, maybe_flush() no reintenta hasta que pase una
+    espera exponencial (DB_RETRY_MIN_SECONDS … DB_RETRY_MAX_SECONDS), así una base
+    caída cuesta un intento y una línea de log por ventana y no uno por muestra.
+    flush() explícito (arranque, cierre) intenta siempre."""
+
+    def __init__(self, flush_rows=None, flush_seconds=None, max_rows=None, spool=None, intraday=None):
+        self.flush_rows = flush_rows if flush_rows is not None else int(os.getenv("DB_FLUSH_ROWS", "200"))
+        self.flush_seconds = flush_seconds if flush_seconds is not None else float(os.getenv("DB_FLUSH_SECONDS", "0"))
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv("DB_BUFFER_MAX_ROWS", "100000"))
+        self.drain_batch = int(os.getenv("SPOOL_DRAIN_BATCH", "5000"))
+        self.spool = spool
+        self.intraday = intraday
+        self.buffers = {kind: [] for kind in WRITERS}
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.retry_min = float(os.getenv("DB_RETRY_MIN_SECONDS", "5"))
+        self.retry_max = float(os.getenv("DB_RETRY_MAX_SECONDS", "300"))
+        self.retry_delay = 0.0
+        self.retry_at = 0.0
+
+    def add(self, rows, kind="plant"):
+        if not rows:
+            return
+        if self.spool is not None:
+            self.spool.append(rows, kind=kind)
+        else:
+            with self.lock:
+                if self.oldest is None:
+                    self.oldest = time.monotonic()
+                buf = self.buffers[kind]
+                buf.extend(rows)
+                overflow = len(buf) - self.max_rows
+                if overflow > 0:
+                    del buf[:overflow]
+                    print(f"⚠️ Buffer DB lleno: descartadas {overflow} filas antiguas ({kind})")
+        self.maybe_flush()
+
+    def pending(self):
+        if self.spool is not None:
+            return self.spool.count()
+        return sum(len(b) for b in self.buffers.values())
+
+    def due(self):
+        if time.monotonic() < self.retry_at:
+            return False
+        n = self.pending()
+        if not n:
+            return False
+        if n >= self.flush_rows:
+            return True
+        age = self.spool.oldest_age() if self.spool is not None else time.monotonic() - self.oldest
+        return age >= self.flush_seconds
+
+    def maybe_flush(self):
+        if self.due():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        with self.lock:
+            if self.spool is not None:
+                written = 0
+                for kind in WRITERS:
+                    n, ok = self._drain_spool(kind)
+                    written += n
+                    if not ok:
+                        break
+                return written
+            written = 0
+            for kind, rows in self.buffers.items():
+                if not rows:
+                    continue
+                try:
+                    self._write(kind, rows)
+                except psycopg2.Error as e:
+                    self._failed(e, f"{self.pending()} filas quedan en buffer")
+                    break
+                self._recovered()
+                self.buffers[kind] = []
+                self.flushes += 1
+                written += len(rows)
+            if not any(self.buffers.values()):
+                self.oldest = None
+            self.rows_written += written
+            return written
+
+    def _failed(self, e, detail):
+        """Cuenta el error y programa el próximo intento de maybe_flush()."""
+        self.errors += 1
+        self.retry_delay = min(self.retry_max, self.retry_delay * 2 or self.retry_min)
+        self.retry_at = time.monotonic() + self.retry_delay
+        print(f"❌ Error al guardar en la base de datos ({detail}): {str(e).strip()}; "
+              f"próximo intento en {self.retry_delay:.0f}s")
+
+    def _recovered(self):
+        if self.retry_delay:
+            print("✅ Base de datos disponible de nuevo: se reanudan las escrituras")
+        self.retry_delay = 0.0
+        self.retry_at = 0.0
+
+    def _write(self, kind, rows):
+        try:
+            with metrics.DB_WRITE_SECONDS.time(kind=kind):
+                if kind == "meter":
+                    WRITERS[kind](rows)
+                else:
+                    WRITERS[kind](rows, self.intraday)
+        except psycopg2.Error:
+            metrics.DB_ERRORS.inc(kind=kind)
+            raise
+        metrics.DB_ROWS.inc(len(rows), kind=kind)
+        if kind == "plant":
+            for row in latest_per_plant(rows):
+                metrics.PLANT_LAST_WRITE.set(row[1].timestamp(), plant_code=row[0])
+
+    def oldest_age(self):
+        if self.spool is not None:
+            return self.spool.oldest_age() if self.spool.count() else 0.0
+        return time.monotonic() - self.oldest if self.oldest is not None else 0.0
+
+    def _drain_spool(self, kind):
+        written = 0
+        while True:
+            last_id, rows = self.spool.peek(self.drain_batch, kind=kind)
+            if not rows:
+                break
+            try:
+                self._write(kind, rows)
+            except psycopg2.Error as e:
+                self._failed(e, f"{self.spool.count()} filas quedan en spool")
+                self.rows_written += written
+                return written, False
+            self._recovered()
+            self.spool.ack(last_id, kind=kind)
+            self.flushes += 1
+            written += len(rows)
+        self.rows_written += written
+        return written, True
+
+    def stats(self):
+        return {
+            "buffered": self.pending(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+        }
@@ -1,34 +1,40 @@
 import os
 import time
 import re
-import random
 import json
+import signal
+import asyncio
+import argparse
 import requests
 import psycopg2
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from dotenv import load_dotenv
+from db_writer import DbWriter, ChangeFilter, close_pool, pooled_conn
+from plant_registry import PlantRegistry
+from spool import Spool
+from rate_limit import RateScheduler, SchedulerStopped
+from coordination import Coordinator, RateLedger
+from intraday import IntradayYield
+import metrics
+import solar
+import gap_repair
 
 # ─────────────────────────────────────────────────────────
-# Carga .env
+# Recolector FusionSolar (librería + script)
 # ─────────────────────────────────────────────────────────
-load_dotenv(".env")
+# Importar este módulo no lee .env, no abre archivos ni conexiones y no imprime
+# nada: todo eso pasa al crear/arrancar un Collector. Uso embebido:
+#
+#     collector = Collector(Config(station_codes=["NE=123"], metrics_port=0))
+#     await collector.run()            # hasta collector.stop()
+#     collector.close()
+#
+# `python fusion_api.py` carga .env y corre el mismo Collector; con --once hace
+# un solo ciclo por cuenta y termina (para cron).
 
-DOMAIN   = os.getenv("FUSION_DOMAIN")              # p.ej. la5.fusionsolar.huawei.com
-USER     = os.getenv("FS_USER")
-SYSCODE  = os.getenv("FS_SYSCODE")
-
-# Timings desde .env (editables sin tocar código)
-PER_PLANT_DELAY_SECONDS  = float(os.getenv("PER_PLANT_DELAY_SECONDS", "180"))
-BACKOFF_SECONDS          = int(os.getenv("BACKOFF_SECONDS", "480"))
-STARTUP_COOLDOWN_SECONDS = int(os.getenv("STARTUP_COOLDOWN_SECONDS", "60"))
-DEBUG_PAYLOAD            = int(os.getenv("DEBUG_PAYLOAD", "1"))
-
-LAST_CALL_FILE = Path(".last_call_ts")
-
-# ─────────────────────────────────────────────────────────
-# Utilidades
-# ─────────────────────────────────────────────────────────
 def _normalize_codes(raw: str):
     out = []
     for token in (raw or "").split(","):
@@ -43,113 +49,386 @@ def _normalize_codes(raw: str):
         out.append(t)
     return out
 
+def _parse_coords(raw: str):
+    """PLANT_COORDS="NE=123:4.60:-74.08,NE=456:6.25:-75.56" → {código: (lat, lon)}.
+    Tiene prioridad sobre latitude/longitude de dim.fs_plants."""
+    out = {}
+    for token in (raw or "").split(","):
+        parts = token.strip().split(":")
+        if len(parts) != 3:
+            continue
+        code = _normalize_codes(parts[0])
+        try:
+            out[code[0]] = (float(parts[1]), float(parts[2]))
+        except (ValueError, IndexError):
+            print(f"⚠️ PLANT_COORDS inválido: {token!r}")
+    return out
+
+# ─────────────────────────────────────────────────────────
+# Configuración (se lee al crear Config, no al importar)
+# ─────────────────────────────────────────────────────────
+# (atributo, variable de entorno, conversión, valor por defecto)
+SETTINGS = (
+    ("domain",   "FUSION_DOMAIN", str, None),    # p.ej. la5.fusionsolar.huawei.com (o http://host:puerto)
+    ("user",     "FS_USER",       str, None),
+    ("syscode",  "FS_SYSCODE",    str, None),
+    ("station_codes", "STATION_CODES", _normalize_codes, ""),
+
+    # Timings (editables sin tocar código). PER_PLANT_DELAY_SECONDS (ritmo
+    # inicial), BACKOFF_SECONDS y RATE_* los lee el scheduler (rate_limit.py)
+    ("startup_cooldown_seconds", "STARTUP_COOLDOWN_SECONDS", int, "60"),
+    ("debug_payload",            "DEBUG_PAYLOAD",            int, "1"),
+    ("metrics_port",             "METRICS_PORT",             int, "9108"),   # 0 = sin /metrics ni /healthz
+
+    # Modo lote: todas las plantas en una sola llamada getStationRealKpi por ciclo
+    ("batch_mode",            "BATCH_MODE",            int, "1"),
+    ("max_stations_per_call", "MAX_STATIONS_PER_CALL", int, "100"),  # límite de la API
+
+    # Medidores → raw.fs_meter_realtime (getDevList una vez + getDevRealKpi por lotes)
+    ("meters_enabled",            "METERS_ENABLED",            int,   "1"),
+    ("max_devices_per_call",      "MAX_DEVICES_PER_CALL",      int,   "100"),
+    ("meter_discovery_ttl_hours", "METER_DISCOVERY_TTL_HOURS", float, "24"),
+    ("meter_export_positive",     "METER_EXPORT_POSITIVE",     int,   "1"),  # signo de active_power
+
+    # Plantas: STATION_CODES / accounts.json y, además, dim.fs_plants (registro) y
+    # la lista de plantas de cada cuenta en la API (endpoint `stations`), que da de
+    # alta sola cualquier planta nueva. STATION_DISCOVERY=0 la desactiva.
+    ("station_discovery",           "STATION_DISCOVERY",           int,   "1"),
+    ("station_discovery_ttl_hours", "STATION_DISCOVERY_TTL_HOURS", float, "24"),
+
+    # Horario solar: de noche cada planta se consulta sólo como latido cada
+    # NIGHT_POLL_SECONDS y la cuota que se ahorra se reparte en las horas de sol
+    # (hasta DAYLIGHT_BOOST_MAX veces el ritmo aprendido de getStationRealKpi).
+    ("solar_schedule",          "SOLAR_SCHEDULE",          int,   "1"),
+    ("night_poll_seconds",      "NIGHT_POLL_SECONDS",      float, "900"),
+    ("daylight_margin_minutes", "DAYLIGHT_MARGIN_MINUTES", float, "20"),
+    ("daylight_boost_max",      "DAYLIGHT_BOOST_MAX",      float, "2.0"),
+    ("site_lat",                "SITE_LAT",                float, "4.711"),     # Bogotá por defecto
+    ("site_lon",                "SITE_LON",                float, "-74.072"),
+    ("plant_coords",            "PLANT_COORDS",            _parse_coords, ""),
+
+    # Reparación de huecos (gap_repair.py): cada GAP_REPAIR_SCAN_SECONDS busca
+    # huecos con sol de más de GAP_REPAIR_MIN_SECONDS en las últimas
+    # GAP_REPAIR_LOOKBACK_HOURS (sin los últimos GAP_REPAIR_SETTLE_MINUTES) y los
+    # tapa con getKpiStationHour en turnos libres. Un día que no se pudo tapar se
+    # vuelve a pedir tras GAP_REPAIR_RETRY_HOURS.
+    ("gap_repair",                "GAP_REPAIR",                int,   "1"),
+    ("gap_repair_scan_seconds",   "GAP_REPAIR_SCAN_SECONDS",   float, "600"),
+    ("gap_repair_min_seconds",    "GAP_REPAIR_MIN_SECONDS",    float, "1800"),
+    ("gap_repair_lookback_hours", "GAP_REPAIR_LOOKBACK_HOURS", float, "48"),
+    ("gap_repair_settle_minutes", "GAP_REPAIR_SETTLE_MINUTES", float, "90"),
+    ("gap_repair_retry_hours",    "GAP_REPAIR_RETRY_HOURS",    float, "6"),
+
+    # Varias réplicas (coordination.py): con COORDINATION=1 las réplicas vivas se
+    # reparten los lotes de plantas y comparten el rate-limit de cada cuenta en
+    # Postgres (ops.*) en lugar de RATE_STATE_FILE. REPLICA_ID por defecto es
+    # host-pid.
+    ("coordination",            "COORDINATION",            int,   "0"),
+    ("replica_id",              "REPLICA_ID",              str,   None),
+    ("coord_heartbeat_seconds", "COORD_HEARTBEAT_SECONDS", float, "15"),
+    ("coord_lease_seconds",     "COORD_LEASE_SECONDS",     float, "60"),
+
+    # Rendimiento del día en curso (intraday.py): fila parcial en
+    # fs.plant_daily_metrics con cada escritura; la consolidación la cierra
+    ("intraday_yield", "INTRADAY_YIELD", int, "1"),
+
+    ("rate_state_file", "RATE_STATE_FILE", Path, ".rate_state.json"),
+    ("accounts_file",   "ACCOUNTS_FILE",   Path, "accounts.json"),
+    ("spool_file",      "SPOOL_FILE",      Path, None),   # por defecto junto a RATE_STATE_FILE
+)
+
+class Config:
+    """Configuración del recolector, leída del entorno al crear el objeto.
+    Cualquier opción de SETTINGS se puede pasar como argumento y tiene prioridad
+    sobre el entorno: Config(batch_mode=0, station_codes=["NE=123"])."""
+
+    def __init__(self, **overrides):
+        unknown = set(overrides) - {attr for attr, *_ in SETTINGS}
+        if unknown:
+            raise TypeError(f"Config: opciones desconocidas {sorted(unknown)}")
+        for attr, env, cast, default in SETTINGS:
+            if attr in overrides:
+                value = overrides[attr]
+            else:
+                raw = os.getenv(env, default)
+                value = cast(raw) if raw is not None else None
+            setattr(self, attr, value)
+        if self.spool_file is None:
+            self.spool_file = Path(self.rate_state_file).parent / ".spool.sqlite3"
+
+# ─────────────────────────────────────────────────────────
+# Utilidades
+# ─────────────────────────────────────────────────────────
+def _base_url(domain):
+    # Sin esquema se asume https; con esquema (p. ej. http://127.0.0.1:8088, el
+    # servidor falso de bench/) se usa tal cual
+    domain = (domain or "").rstrip("/")
+    return domain if "://" in domain else f"https://{domain}"
+
 def nz(x):
     try:
         return float(x) if x is not None else 0.0
     except Exception:
         return 0.0
 
-RAW_CODES = os.getenv("STATION_CODES", "")
-print("RAW STATION_CODES =", repr(RAW_CODES))
-STATIONS = _normalize_codes(RAW_CODES)
-if not STATIONS:
-    raise SystemExit("No hay STATION_CODES en .env")
-print("STATIONS normalizados:", STATIONS)
-
 # ─────────────────────────────────────────────────────────
-# Sesión HTTP Huawei
+# Sesión HTTP Huawei (larga, con reutilización del XSRF-TOKEN)
 # ─────────────────────────────────────────────────────────
-session: requests.Session = None
-xsrf_token = None
-
-def _new_session():
-    s = requests.Session()
-    s.headers.update({
-        "Accept": "application/json",
-        "Content-Type": "application/json;charset=UTF-8",
-        "User-Agent": "Mozilla/5.0"
-    })
-    return s
-
-def preflight():
-    url = f"https://{DOMAIN}/thirdData/"
-    try:
-        session.get(
-            url,
-            headers={"Accept": "text/html,application/json", "Referer": f"https://{DOMAIN}/"},
-            timeout=20,
-        )
-    except Exception:
-        pass
-
-def login():
-    global xsrf_token
-    preflight()
-    url = f"https://{DOMAIN}/thirdData/login"
-    r1 = session.post(
-        url,
-        headers={"Origin": f"https://{DOMAIN}", "Referer": f"https://{DOMAIN}/"},
-        json={"userName": USER, "systemCode": SYSCODE},
-        timeout=20,
-    )
-    r1.raise_for_status()
-
-    xsrf = (
-        r1.headers.get("XSRF-TOKEN")
-        or r1.headers.get("xsrf-token")
-        or r1.headers.get("X-XSRF-TOKEN")
-        or session.cookies.get("XSRF-TOKEN")
-        or session.cookies.get("xsrf-token")
+RELOGIN_FAIL_CODES = {305, 306}   # 305 = USER_MUST_RELOGIN (token vencido / inválido)
+
+class SessionExpired(Exception):
+    pass
+
+def _is_rate_limited(data):
+    return isinstance(data, dict) and (
+        data.get("data") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
+        or data.get("failCode") == 407
+        or data.get("message") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
     )
-    if not xsrf:
-        m = re.search(r"XSRF-TOKEN=([^;]+)", r1.headers.get("Set-Cookie", ""))
-        if m:
-            xsrf = m.group(1)
-    if not xsrf:
-        xsrf = session.cookies.get("XSRF-TOKEN") or session.cookies.get("xsrf-token")
-
-    if not xsrf:
-        raise RuntimeError("No llegó XSRF-TOKEN en el login")
-
-    xsrf_token = xsrf
-    session.headers.update({"XSRF-TOKEN": xsrf_token})
-    print("✅ Login OK. XSRF-TOKEN obtenido.")
-
-def get_station_kpi(station_code_ne: str):
-    url = f"https://{DOMAIN}/thirdData/getStationRealKpi"
-    payload = {"stationCodes": station_code_ne}
-    r = session.post(url, json=payload, timeout=20)
-    if r.status_code != 200:
-        raise requests.HTTPError(f"{r.status_code} {r.reason} → {r.text[:600]}")
-    return r.json()
-
-def safe_logout():
-    try:
-        session.close()
-    except Exception:
-        pass
+
+class HuaweiSession:
+    """Una sola requests.Session keep-alive por cuenta. Hace login sólo cuando no
+    hay token o cuando la API indica que expiró, y cuenta logins y llamadas de
+    datos por separado. Cada llamada pide turno al `scheduler` y le informa si
+    fue aceptada o rechazada por 407."""
+
+    def __init__(self, domain, user, syscode, scheduler=None, name="principal"):
+        self.domain = domain
+        self.base_url = _base_url(domain)
+        self.user = user
+        self.syscode = syscode
+        self.scheduler = scheduler
+        self.name = name
+        self.session = None
+        self.xsrf_token = None
+        self.logins = 0
+        self.relogins = 0
+        self.data_calls = 0
+
+    def _new_session(self):
+        s = requests.Session()
+        s.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json;charset=UTF-8",
+            "User-Agent": "Mozilla/5.0"
+        })
+        return s
+
+    def preflight(self):
+        url = f"{self.base_url}/thirdData/"
+        try:
+            self.session.get(
+                url,
+                headers={"Accept": "text/html,application/json", "Referer": f"{self.base_url}/"},
+                timeout=20,
+            )
+        except Exception:
+            pass
+
+    def login(self):
+        if self.session is None:
+            self.session = self._new_session()
+            self.preflight()
+        self.session.headers.pop("XSRF-TOKEN", None)
+        self.xsrf_token = None
+
+        url = f"{self.base_url}/thirdData/login"
+        self._wait_turn("login")
+        self.logins += 1
+        try:
+            with metrics.API_SECONDS.time(account=self.name, endpoint="login"):
+                r1 = self.session.post(
+                    url,
+                    headers={"Origin": self.base_url, "Referer": f"{self.base_url}/"},
+                    json={"userName": self.user, "systemCode": self.syscode},
+                    timeout=20,
+                )
+            r1.raise_for_status()
+        except Exception:
+            metrics.API_CALLS.inc(account=self.name, endpoint="login", result="error")
+            raise
+        try:
+            body = r1.json()
+        except ValueError:
+            body = None
+        if _is_rate_limited(body):
+            metrics.API_CALLS.inc(account=self.name, endpoint="login", result="throttled")
+            if self.scheduler:
+                self.scheduler.on_throttle("login")
+            raise RuntimeError("login rechazado: ACCESS_FREQUENCY_IS_TOO_HIGH")
+        metrics.API_CALLS.inc(account=self.name, endpoint="login", result="ok")
+        if self.scheduler:
+            self.scheduler.on_success("login")
+
+        session = self.session
+        xsrf = (
+            r1.headers.get("XSRF-TOKEN")
+            or r1.headers.get("xsrf-token")
+            or r1.headers.get("X-XSRF-TOKEN")
+            or session.cookies.get("XSRF-TOKEN")
+            or session.cookies.get("xsrf-token")
+        )
+        if not xsrf:
+            m = re.search(r"XSRF-TOKEN=([^;]+)", r1.headers.get("Set-Cookie", ""))
+            if m:
+                xsrf = m.group(1)
+
+        if not xsrf:
+            raise RuntimeError("No llegó XSRF-TOKEN en el login")
+
+        self.xsrf_token = xsrf
+        session.headers.update({"XSRF-TOKEN": xsrf})
+        print(f"✅ Login OK ({self.user}@{self.domain}). XSRF-TOKEN obtenido. logins={self.logins}")
+
+    def ensure_login(self):
+        if self.session is None or not self.xsrf_token:
+            self.login()
+
+    def _wait_turn(self, endpoint):
+        if self.scheduler:
+            waited = self.scheduler.acquire(endpoint)
+            metrics.RATE_WAIT_SECONDS.observe(waited, account=self.name, endpoint=endpoint)
+            metrics.SLEEP_SECONDS.inc(waited, account=self.name)
+
+    def _post_once(self, endpoint, payload):
+        url = f"{self.base_url}/thirdData/{endpoint}"
+        self.data_calls += 1
+        try:
+            with metrics.API_SECONDS.time(account=self.name, endpoint=endpoint):
+                r = self.session.post(url, json=payload, timeout=20)
+        except requests.RequestException:
+            metrics.API_CALLS.inc(account=self.name, endpoint=endpoint, result="error")
+            raise
+        if r.status_code in (401, 403) or "login" in r.url.rsplit("/", 1)[-1].lower():
+            raise SessionExpired(f"{r.status_code} {r.url}")
+        if r.status_code != 200:
+            raise requests.HTTPError(f"{r.status_code} {r.reason} → {r.text[:600]}")
+        try:
+            data = r.json()
+        except ValueError:
+            # Una página HTML en vez de JSON = redirección al login
+            raise SessionExpired(f"respuesta no JSON → {r.text[:200]}")
+        if isinstance(data, dict) and data.get("failCode") in RELOGIN_FAIL_CODES:
+            raise SessionExpired(f"failCode={data.get('failCode')}")
+        return data
+
+    def post(self, endpoint, payload, wait=True):
+        """POST a /thirdData/<endpoint>; re-login una sola vez si el token venció.
+        Con wait=False devuelve None si el scheduler no tiene turno disponible."""
+        if wait:
+            self._wait_turn(endpoint)
+        elif self.scheduler and not self.scheduler.try_acquire(endpoint):
+            return None
+        self.ensure_login()
+        try:
+            data = self._post_once(endpoint, payload)
+        except SessionExpired as e:
+            print(f"🔑 Sesión vencida ({e}) → re-login")
+            metrics.API_CALLS.inc(account=self.name, endpoint=endpoint, result="expired")
+            self.relogins += 1
+            self.login()
+            data = self._post_once(endpoint, payload)
+        if _is_rate_limited(data):
+            metrics.API_CALLS.inc(account=self.name, endpoint=endpoint, result="throttled")
+            if self.scheduler:
+                self.scheduler.on_throttle(endpoint)
+        elif isinstance(data, dict) and data.get("success", False):
+            metrics.API_CALLS.inc(account=self.name, endpoint=endpoint, result="ok")
+            if self.scheduler:
+                self.scheduler.on_success(endpoint)
+        else:
+            metrics.API_CALLS.inc(account=self.name, endpoint=endpoint, result="failed")
+        return data
+
+    def reset(self):
+        """Descarta la sesión (p. ej. tras un error de red); el próximo post hace login."""
+        self.close()
+        self.session = None
+        self.xsrf_token = None
+
+    def close(self):
+        try:
+            if self.session is not None:
+                self.session.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {"logins": self.logins, "relogins": self.relogins, "data_calls": self.data_calls}
+
+def get_station_kpi(api, station_codes, wait=True):
+    # Acepta un código "NE=..." o una lista; la API recibe los códigos separados por coma
+    if not isinstance(station_codes, str):
+        station_codes = ",".join(station_codes)
+    return api.post("getStationRealKpi", {"stationCodes": station_codes}, wait=wait)
 
 # ─────────────────────────────────────────────────────────
-# Rate-limit helpers
+# Cuentas Northbound (cada una con su sesión, cuota y backoff)
 # ─────────────────────────────────────────────────────────
-def _now_s(): return int(time.time())
-def _load_last_call_ts():
-    try: return int(LAST_CALL_FILE.read_text().strip())
-    except Exception: return 0
-def _save_last_call_ts(ts: int):
-    try: LAST_CALL_FILE.write_text(str(ts))
-    except: pass
-def _respect_rate_limit():
-    last = _load_last_call_ts()
-    elapsed = _now_s() - last
-    wait = PER_PLANT_DELAY_SECONDS - elapsed
-    if wait > 0:
-        print(f"RATE: esperando {wait:.1f}s para cumplir {PER_PLANT_DELAY_SECONDS:.0f}s…", flush=True)
-        time.sleep(wait)
-def _ensure_cool_start():
-    if not LAST_CALL_FILE.exists():
-        print(f"START: esperando {STARTUP_COOLDOWN_SECONDS}s (cooldown de arranque)…", flush=True)
-        time.sleep(STARTUP_COOLDOWN_SECONDS)
+class Account:
+    def __init__(self, name, domain, user, syscode, stations, state_file, registry=None, ledger=None):
+        self.name = name
+        self.configured = stations   # STATION_CODES / accounts.json
+        self.from_registry = False  # configured = plantas activas de dim.fs_plants
+        self.discovered = []        # lista de plantas de la API (discover_stations)
+        self.stations_ts = 0.0
+        self.registry = registry
+        # Con ledger (varias réplicas) el estado del rate-limit vive en ops.rate_ledger
+        self.scheduler = RateScheduler(None if ledger else state_file, ledger=ledger)
+        self.api = HuaweiSession(domain, user, syscode, scheduler=self.scheduler, name=name)
+        self.cool_start_done = False
+        self.meters_file = Path(state_file).parent / f".meter_devices.{name}.json"
+        self.meters = None          # {stationCode: [[devId, devTypeId], ...]}
+        self.meters_ts = 0.0
+        self.last_power = {}        # última potencia FV por planta, para load/self-use
+        self.meter_read_ts = {}     # (devTypeId, lote) → última lectura (el más atrasado va primero)
+        self.last_poll = {}         # código NE → última muestra guardada (epoch)
+        self.daylight = None        # último modo del horario solar (True = día)
+        self.repair_scan_ts = 0.0   # última búsqueda de huecos
+        self.repair_plan = {}       # día local → {código NE: [(inicio, fin), ...]}
+        self.repair_tried = {}      # (código NE, día local) → último pedido a getKpiStationHour
+
+    @property
+    def stations(self):
+        """Plantas a consultar: configuradas + descubiertas, sin las dadas de baja
+        en dim.fs_plants (active = false)."""
+        codes = list(dict.fromkeys(self.configured + self.discovered))
+        if self.registry is None:
+            return codes
+        return [c for c in codes if self.registry.is_active(c)]
+
+def load_accounts(config, registry=None):
+    """Cuentas desde config.accounts_file (lista JSON) o, si no existe, la cuenta
+    única de FUSION_DOMAIN/FS_USER/FS_SYSCODE/STATION_CODES.
+
+    Formato: [{"name": "norte", "domain": "...", "user": "...", "syscode": "...",
+               "stations": ["NE=...", ...]}]. En lugar de "syscode" se puede dar
+    "syscode_env" con el nombre de la variable de entorno que lo contiene.
+    Con config.coordination el rate-limit de cada usuario se comparte en Postgres."""
+    state_dir = Path(config.rate_state_file).parent
+
+    def ledger(domain, user):
+        return RateLedger(f"{user}@{domain}") if config.coordination else None
+
+    if Path(config.accounts_file).exists():
+        accounts = []
+        for i, cfg in enumerate(json.loads(Path(config.accounts_file).read_text())):
+            name = cfg.get("name") or f"cuenta{i + 1}"
+            syscode = cfg.get("syscode") or os.getenv(cfg.get("syscode_env", ""), "")
+            stations = cfg.get("stations", [])
+            if isinstance(stations, str):
+                stations = _normalize_codes(stations)
+            else:
+                stations = _normalize_codes(",".join(stations))
+            state_file = state_dir / f".rate_state.{name}.json"
+            domain = cfg.get("domain") or config.domain
+            accounts.append(Account(name, domain, cfg["user"], syscode,
+                                    stations, state_file, registry, ledger(domain, cfg["user"])))
+        return accounts
+
+    return [Account("principal", config.domain, config.user, config.syscode,
+                    list(config.station_codes), config.rate_state_file, registry,
+                    ledger(config.domain, config.user))]
 
 # ─────────────────────────────────────────────────────────
 # Helpers de extracción con aliases y dataItemMap
@@ -179,143 +458,667 @@ def pick_float(obj, *keys):
             except: continue
     return 0.0
 
-# ─────────────────────────────────────────────────────────
-# PostgreSQL
-# ─────────────────────────────────────────────────────────
-def save_to_db(rows):
-    if not rows:
-        return
+def _row_from_item(item, plant_ne_code, ts_utc):
+    station_name = pick_str(item, "stationName", "name", "plantName", "stationCode") or plant_ne_code
+    power_kw    = pick_float(item, "realTimePower","realtimePower","activePower","power")
+    day_kwh     = pick_float(item, "day_power","day_on_grid_energy")
+    month_kwh   = pick_float(item, "month_power")
+    total_kwh   = pick_float(item, "total_power")
+    health      = _from_map(item, "real_health_state") or 0
+    return (plant_ne_code, ts_utc, station_name, power_kw, day_kwh, month_kwh, total_kwh, health)
 
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("PGHOST"),
-            port=os.getenv("PGPORT"),
-            dbname=os.getenv("PGDATABASE"),
-            user=os.getenv("PGUSER"),
-            password=os.getenv("PGPASSWORD"),
-            sslmode=os.getenv("PGSSLMODE", "require"),
-        )
+def _split_payload(payload, codes):
+    """Reparte la respuesta de getStationRealKpi en {código NE: item}."""
+    items = payload if isinstance(payload, list) else [payload]
+    by_code = {}
+    for item in items:
+        code = pick_str(item, "stationCode")
+        if not code and len(codes) == 1:
+            code = codes[0]
+        if code in codes and code not in by_code:
+            by_code[code] = item
+    return by_code
 
-        with conn:
-            with conn.cursor() as cur:
-                cur.executemany(
-                    """
-                    INSERT INTO raw.fs_realtime_plants
-                    (plant_code, ts_utc, plant_name, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON CONFLICT (ts_utc, plant_code) DO NOTHING
-                    """,
-                    rows,
-                )
+def _batches(codes, size):
+    size = max(1, size)
+    return [codes[i:i + size] for i in range(0, len(codes), size)]
 
-                # UPSERT último estado
-                last_row = rows[-1]
-                plant_code, ts_utc, plant_name, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health = last_row
-
-                cur.execute(
-                    """
-                    INSERT INTO raw.fs_plants_last
-                    (plant_code, updated_utc, plant_name, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                    ON CONFLICT (plant_code) DO UPDATE SET
-                      updated_utc      = EXCLUDED.updated_utc,
-                      plant_name       = EXCLUDED.plant_name,
-                      power_kw         = EXCLUDED.power_kw,
-                      day_power_kwh    = EXCLUDED.day_power_kwh,
-                      month_power_kwh  = EXCLUDED.month_power_kwh,
-                      total_power_kwh  = EXCLUDED.total_power_kwh,
-                      health           = EXCLUDED.health
-                    """,
-                    (plant_code, ts_utc, plant_name, power_kw, day_power_kwh, month_power_kwh, total_power_kwh, health)
-                )
+def _meter_row(station, grid_kw, pv_kw, ts_utc, export_positive=True):
+    if not export_positive:
+        grid_kw = -grid_kw
+    export_kw = max(grid_kw, 0.0)
+    import_kw = max(-grid_kw, 0.0)
+    load_kw = max(pv_kw - grid_kw, 0.0)
+    self_use_kw = max(pv_kw - export_kw, 0.0)
+    return (ts_utc, station, import_kw, export_kw, load_kw, self_use_kw)
 
-    except psycopg2.Error as e:
-        print(f"❌ Error al guardar en la base de datos: {e}")
-    finally:
-        if conn:
-            conn.close()
+METER_DEV_TYPES = {17, 47}   # 17 = medidor de red (kW), 47 = power sensor (W)
 
 # ─────────────────────────────────────────────────────────
-# Recolección por planta
+# Recolector
 # ─────────────────────────────────────────────────────────
-def fetch_one_plant(plant_ne_code: str):
-    global session
-    _ensure_cool_start()
-    _respect_rate_limit()
+class Collector:
+    """Todas las cuentas de `config` en un solo proceso. Las cuentas corren a la
+    vez en un event loop de asyncio: las esperas de turno del scheduler y las
+    pausas nocturnas son asyncio.sleep (cancelables), y las llamadas bloqueantes
+    (HTTP keep-alive con requests, Postgres, spool SQLite) van a un pool de hilos
+    con un hilo por cuenta. El writer, el filtro de cambios y el registro de
+    plantas se comparten entre cuentas.
 
-    session = _new_session()
-    try:
-        login()
-    except Exception as e:
-        print(f"❌ Login falló para {plant_ne_code}: {e}")
-        safe_logout()
-        return False
+    Crear el objeto no abre nada: el spool, las cuentas y el pool de hilos se
+    crean al primer uso y la base se toca recién en start()/run()."""
 
-    try:
-        time.sleep(2.0)
-        data = get_station_kpi(plant_ne_code)
-
-        if (
-            data.get("data") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
-            or data.get("failCode") == 407
-            or data.get("message") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
-        ):
-            print(f"⏳ {plant_ne_code}: rate limit → durmiendo {BACKOFF_SECONDS}s")
-            time.sleep(BACKOFF_SECONDS)
-            return False
-
-        if not data.get("success", False):
-            print(f"⚠️ {plant_ne_code}: respuesta no exitosa → {data}")
-            return False
-
-        payload = data.get("data")
-        if not payload:
-            print(f"ℹ️ {plant_ne_code}: sin datos → {data}")
-            return False
-        first = payload[0] if isinstance(payload, list) else payload
-
-        if DEBUG_PAYLOAD and plant_ne_code == STATIONS[0]:
-            try: print("DEBUG payload (recortado):", json.dumps(first, ensure_ascii=False)[:1000])
-            except: print("DEBUG payload keys:", list(first.keys()))
-
-        station_name = pick_str(first, "stationName", "name", "plantName", "stationCode") or plant_ne_code
-        power_kw    = pick_float(first, "realTimePower","realtimePower","activePower","power")
-        day_kwh     = pick_float(first, "day_power","day_on_grid_energy")
-        month_kwh   = pick_float(first, "month_power")
-        total_kwh   = pick_float(first, "total_power")
-        health      = _from_map(first, "real_health_state") or 0
+    def __init__(self, config=None, accounts=None):
+        self.config = config or Config()
+        self.registry = PlantRegistry(pooled_conn)
+        self.changes = ChangeFilter()
+        self.coordinator = None
+        if self.config.coordination:
+            self.coordinator = Coordinator(pooled_conn, self.config.replica_id,
+                                           self.config.coord_lease_seconds, self.config.coord_heartbeat_seconds)
+        self._accounts = accounts
+        self._writer = None
+        self._executor = None
+        self._loop = None
+        self._stopping = None
+        self.stopped = False
+        self.metrics_server = None
+
+    # ── Recursos perezosos ────────────────────────────────
+    @property
+    def accounts(self):
+        if self._accounts is None:
+            self._accounts = load_accounts(self.config, self.registry)
+            print("STATIONS normalizados:", {a.name: a.configured for a in self._accounts})
+        return self._accounts
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            intraday = IntradayYield(self.registry) if self.config.intraday_yield else None
+            self._writer = DbWriter(spool=Spool(self.config.spool_file), intraday=intraday)
+        return self._writer
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.accounts) + 1,
+                                                thread_name_prefix="cuenta")
+        return self._executor
+
+    def all_stations(self):
+        """Plantas que consulta esta réplica (todas, sin coordinación)."""
+        return [st for a in self.accounts for st in self.owned_stations(a)]
+
+    def seed_stations(self):
+        """Carga dim.fs_plants. Con una sola cuenta sin STATION_CODES se consultan
+        todas las plantas activas del registro."""
+        self.registry.refresh(force=True)
+        accounts = self.accounts
+        if len(accounts) == 1 and not accounts[0].configured and not Path(self.config.accounts_file).exists():
+            accounts[0].configured = self.registry.codes()
+            accounts[0].from_registry = True
+            print(f"🗂️ Plantas desde dim.fs_plants: {accounts[0].configured}")
+        if not any(a.stations for a in accounts) and not self.config.station_discovery:
+            raise SystemExit("No hay STATION_CODES en .env, cuentas en ACCOUNTS_FILE ni plantas en dim.fs_plants")
+
+    # ── PostgreSQL ────────────────────────────────────────
+    def save_to_db(self, rows, kind="plant"):
+        # Las filas se guardan primero en el spool local (.spool.sqlite3) y se
+        # drenan en bloque (execute_values) por cantidad o antigüedad; si la base
+        # está caída esperan en disco al siguiente flush, incluso a través de un
+        # reinicio. Las muestras de planta idénticas a la anterior (noche, planta
+        # apagada) se omiten salvo un latido cada DEDUP_HEARTBEAT_SECONDS.
+        if kind == "plant":
+            rows = self.changes.filter(rows)
+        if not rows:
+            return
+        self.writer.add(rows, kind=kind)
+
+    # ── Recolección (una planta o un lote de plantas por llamada) ──
+    def fetch_stations(self, account, codes, wait=True):
+        """Una llamada getStationRealKpi para `codes` (login sólo si hace falta) + una
+        escritura en bloque. Devuelve cuántas plantas quedaron guardadas. Con
+        wait=False el turno ya lo esperó el llamador (ver _turn)."""
+        api = account.api
+        label = codes[0] if len(codes) == 1 else f"[{account.name}] lote de {len(codes)} plantas"
+
+        try:
+            api.ensure_login()
+        except SchedulerStopped:
+            raise
+        except Exception as e:
+            print(f"❌ Login falló para {label}: {e}")
+            api.reset()
+            return 0
+
+        try:
+            data = get_station_kpi(api, codes, wait=wait)
+
+            if data is None:
+                print(f"⏳ {label}: sin turno libre, se intenta en el próximo ciclo")
+                return 0
+
+            if _is_rate_limited(data):
+                print(f"⏳ {label}: rate limit → el scheduler aplica el backoff")
+                return 0
 
+            if not data.get("success", False):
+                print(f"⚠️ {label}: respuesta no exitosa → {data}")
+                return 0
+
+            payload = data.get("data")
+            if not payload:
+                print(f"ℹ️ {label}: sin datos → {data}")
+                return 0
+
+            by_code = _split_payload(payload, codes)
+
+            if self.config.debug_payload and codes[0] in by_code and codes[0] == self.all_stations()[0]:
+                first = by_code[codes[0]]
+                try: print("DEBUG payload (recortado):", json.dumps(first, ensure_ascii=False)[:1000])
+                except: print("DEBUG payload keys:", list(first.keys()))
+
+            ts_now_utc = datetime.now(timezone.utc)
+            rows = [_row_from_item(by_code[c], c, ts_now_utc) for c in codes if c in by_code]
+            for c in codes:
+                if c not in by_code:
+                    print(f"ℹ️ {c}: no vino en la respuesta")
+            self.save_to_db(rows)
+            for row in rows:
+                account.last_power[row[0]] = row[3]
+                account.last_poll[row[0]] = ts_now_utc.timestamp()
+                metrics.PLANT_LAST_SAMPLE.set(ts_now_utc.timestamp(), plant_code=row[0])
+
+            for plant_ne_code, _, station_name, power_kw, day_kwh, month_kwh, total_kwh, health in rows:
+                print(f"OK {plant_ne_code}: name={station_name} P={power_kw} kW D={day_kwh} kWh M={month_kwh} kWh T={total_kwh} kWh H={health}")
+            return len(rows)
+
+        except SchedulerStopped:
+            raise
+        except requests.RequestException as e:
+            print(f"❌ Error de red en {label}: {e}")
+            api.reset()
+            return 0
+        except Exception as e:
+            print(f"❌ Error en {label}: {e}")
+            return 0
+
+    def fetch_one_plant(self, account, plant_ne_code: str, wait=True):
+        return self.fetch_stations(account, [plant_ne_code], wait=wait) > 0
+
+    # ── Alta automática de plantas (dim.fs_plants) ────────
+    def discover_stations(self, account):
+        """Lista de plantas de la cuenta (endpoint `stations`, paginado) → dim.fs_plants
+        y account.discovered. Una vez cada STATION_DISCOVERY_TTL_HOURS, con
+        post(wait=False) como los medidores: si no hay turno se reintenta luego (las
+        páginas siguientes a la primera sí esperan turno)."""
+        cfg = self.config
+        if not cfg.station_discovery or time.time() - account.stations_ts < cfg.station_discovery_ttl_hours * 3600:
+            return
+        items, page = [], 1
+        try:
+            while True:
+                data = account.api.post("stations", {"pageNo": page}, wait=page > 1)
+                if not data or not data.get("success", False):
+                    return
+                body = data.get("data") or {}
+                items.extend(body.get("list") or [])
+                if page >= int(body.get("pageCount") or 1):
+                    break
+                page += 1
+        except requests.RequestException as e:
+            print(f"❌ [{account.name}] Error de red listando plantas: {e}")
+            account.api.reset()
+            return
+        account.stations_ts = time.time()
+        codes = self.registry.record_api_stations(items)
+        new = [c for c in codes if c not in account.configured and c not in account.discovered]
+        account.discovered = codes
+        if new:
+            print(f"🆕 [{account.name}] Plantas descubiertas en la API: {new}")
+            account.meters_ts = 0.0   # volver a buscar medidores con las plantas nuevas
+
+    # ── Medidores (raw.fs_meter_realtime) ─────────────────
+    # Estas llamadas usan post(wait=False): sólo corren si hay turno libre en ese
+    # momento y nunca cuando la cuenta está en backoff, así que no retrasan ni
+    # ponen en riesgo la lectura de plantas.
+    def discover_meters(self, account):
+        """{stationCode: [[devId, devTypeId], ...]} de los medidores de la cuenta,
+        cacheado en memoria y en .meter_devices.<cuenta>.json."""
+        ttl = self.config.meter_discovery_ttl_hours * 3600
+        if account.meters is None and account.meters_file.exists():
+            try:
+                cached = json.loads(account.meters_file.read_text())
+                account.meters, account.meters_ts = cached["meters"], cached["ts"]
+            except Exception:
+                pass
+        if account.meters is not None and time.time() - account.meters_ts < ttl:
+            return account.meters
+
+        meters = {}
+        for i, batch in enumerate(_batches(account.stations, self.config.max_stations_per_call)):
+            # Sólo el primer lote depende de un turno libre; los demás esperan turno
+            # para que la búsqueda no quede a medias con más de un lote de plantas
+            data = account.api.post("getDevList", {"stationCodes": ",".join(batch)}, wait=i > 0)
+            if not data or not data.get("success", False):
+                return account.meters   # se reintenta en el próximo ciclo
+            for dev in data.get("data") or []:
+                if dev.get("devTypeId") in METER_DEV_TYPES and dev.get("stationCode") in batch:
+                    meters.setdefault(dev["stationCode"], []).append([dev["id"], dev["devTypeId"]])
+
+        account.meters, account.meters_ts = meters, time.time()
+        try:
+            account.meters_file.write_text(json.dumps({"meters": meters, "ts": account.meters_ts}))
+        except Exception:
+            pass
+        n = sum(len(v) for v in meters.values())
+        print(f"🔌 [{account.name}] {n} medidores en {len(meters)} plantas")
+        return meters
+
+    def fetch_meters(self, account):
+        """Lee todos los medidores de la cuenta con getDevRealKpi (un lote por tipo de
+        equipo, hasta MAX_DEVICES_PER_CALL equipos por llamada). Devuelve filas guardadas."""
+        if account.scheduler.in_backoff() or not account.stations or not self.leads(account):
+            return 0
+        meters = self.discover_meters(account)
+        if not meters:
+            return 0
+
+        by_type = {}
+        for station, devs in meters.items():
+            for dev_id, dev_type in devs:
+                by_type.setdefault(dev_type, []).append((str(dev_id), station))
+
+        # Un trabajo por (tipo, lote); el leído hace más tiempo va primero, así con
+        # pocos turnos libres todos los lotes se van turnando
+        jobs = [((dev_type, i), batch) for dev_type, devs in by_type.items()
+                for i, batch in enumerate(_batches(devs, self.config.max_devices_per_call))]
+        jobs.sort(key=lambda j: account.meter_read_ts.get(j[0], 0.0))
+
+        grid = {}
+        try:
+            for (dev_type, i), batch in jobs:
+                station_of = dict(batch)
+                payload = {"devIds": ",".join(d for d, _ in batch), "devTypeId": dev_type}
+                data = account.api.post("getDevRealKpi", payload, wait=False)
+                if data is None or _is_rate_limited(data):
+                    break
+                if not data.get("success", False):
+                    print(f"⚠️ [{account.name}] getDevRealKpi no exitoso → {data}")
+                    continue
+                account.meter_read_ts[(dev_type, i)] = time.time()
+                for item in data.get("data") or []:
+                    station = station_of.get(str(item.get("devId")))
+                    if station is None:
+                        continue
+                    p = pick_float(item, "active_power")
+                    if dev_type == 47:
+                        p /= 1000.0   # el power sensor reporta W
+                    grid[station] = grid.get(station, 0.0) + p
+        except requests.RequestException as e:
+            print(f"❌ [{account.name}] Error de red leyendo medidores: {e}")
+            account.api.reset()
+
+        if not grid:
+            return 0
         ts_now_utc = datetime.now(timezone.utc)
-        row = (plant_ne_code, ts_now_utc, station_name, power_kw, day_kwh, month_kwh, total_kwh, health)
-        save_to_db([row])
+        rows = [_meter_row(st, kw, account.last_power.get(st, 0.0), ts_now_utc, self.config.meter_export_positive)
+                for st, kw in grid.items()]
+        self.save_to_db(rows, kind="meter")
+        for _, st, imp, exp, load, self_use in rows:
+            print(f"OK medidor {st}: Imp={imp:.2f} kW Exp={exp:.2f} kW Carga={load:.2f} kW Auto={self_use:.2f} kW")
+        return len(rows)
 
-        print(f"OK {plant_ne_code}: name={station_name} P={power_kw} kW D={day_kwh} kWh M={month_kwh} kWh T={total_kwh} kWh H={health}")
-        _save_last_call_ts(_now_s())
-        return True
+    # ── Reparación de huecos (gap_repair.py) ──────────────
+    # Como los medidores, usa post(wait=False): sólo turnos libres y nunca en
+    # backoff. Tampoco corre con filas pendientes en el spool, porque lo que
+    # parece un hueco puede estar todavía esperando a ser escrito.
+    def repair_gaps(self, account):
+        """Busca huecos de las plantas de la cuenta y pide getKpiStationHour, un día
+        y hasta MAX_STATIONS_PER_CALL plantas por llamada. Devuelve filas recuperadas."""
+        cfg = self.config
+        if account.scheduler.in_backoff() or not account.stations or self.writer.pending() or not self.leads(account):
+            return 0
+        now = time.time()
+        retry = cfg.gap_repair_retry_hours * 3600
+        if now - account.repair_scan_ts >= cfg.gap_repair_scan_seconds:
+            end = datetime.now(timezone.utc) - timedelta(minutes=cfg.gap_repair_settle_minutes)
+            start = end - timedelta(hours=cfg.gap_repair_lookback_hours)
+            try:
+                with pooled_conn() as conn:
+                    with conn.cursor() as cur:
+                        gaps = gap_repair.find_gaps(cur, account.stations, start, end, cfg.gap_repair_min_seconds)
+            except psycopg2.Error as e:
+                print(f"⚠️ [{account.name}] No se pudieron buscar huecos: {e}")
+                return 0
+            account.repair_plan = gap_repair.plan_days(gaps, self.plant_coords, cfg.daylight_margin_minutes)
+            account.repair_tried = {k: t for k, t in account.repair_tried.items() if now - t < retry}
+            account.repair_scan_ts = now
 
-    except Exception as e:
-        print(f"❌ Error en {plant_ne_code}: {e}")
+        jobs = []
+        for day in sorted(account.repair_plan):
+            gaps_by_code = account.repair_plan[day]
+            codes = [c for c in gaps_by_code if now - account.repair_tried.get((c, day), 0.0) >= retry]
+            jobs += [(day, batch) for batch in _batches(codes, cfg.max_stations_per_call)]
+
+        recovered = 0
+        try:
+            for day, batch in jobs:
+                payload = {"stationCodes": ",".join(batch), "collectTime": gap_repair.collect_time_ms(day)}
+                data = account.api.post("getKpiStationHour", payload, wait=False)
+                if data is None or _is_rate_limited(data):
+                    break
+                for c in batch:
+                    account.repair_tried[(c, day)] = now
+                if not data.get("success", False):
+                    print(f"⚠️ [{account.name}] getKpiStationHour no exitoso → {data}")
+                    continue
+                gaps_by_code = account.repair_plan[day]
+                rows = gap_repair.rows_from_hours(data.get("data"), day, {c: gaps_by_code[c] for c in batch})
+                if rows:
+                    self.writer.add(rows, kind="repair")
+                    recovered += len(rows)
+                    metrics.GAP_ROWS_RECOVERED.inc(len(rows), account=account.name)
+                    print(f"🩹 [{account.name}] {day}: {len(rows)} puntos recuperados en "
+                          f"{len({r[0] for r in rows})} plantas (getKpiStationHour)")
+        except requests.RequestException as e:
+            print(f"❌ [{account.name}] Error de red reparando huecos: {e}")
+            account.api.reset()
+        return recovered
+
+    # ── Varias réplicas (coordination.py) ─────────────────
+    # Cada lote de MAX_STATIONS_PER_CALL plantas de una cuenta (ordenadas por
+    # código) es una clave y va a una sola réplica; las tareas de cuenta
+    # (medidores y huecos) son otra clave. El alta de plantas la hace cada
+    # réplica: es una llamada al día y así todas ven las plantas nuevas.
+    def shards(self, account):
+        """{clave: plantas} de la cuenta."""
+        codes = sorted(account.stations)
+        return {f"{account.name}:{i}": batch
+                for i, batch in enumerate(_batches(codes, self.config.max_stations_per_call))}
+
+    def owned_stations(self, account):
+        if self.coordinator is None:
+            return account.stations
+        return [c for key, batch in self.shards(account).items() if self.coordinator.owns(key) for c in batch]
+
+    def leads(self, account):
+        """True si esta réplica hace las tareas de cuenta (medidores y huecos)."""
+        return self.coordinator is None or self.coordinator.owns(f"{account.name}/cuenta")
+
+    def owned_keys(self):
+        keys = [k for a in self.accounts for k in [*self.shards(a), f"{a.name}/cuenta"]]
+        return [k for k in keys if self.coordinator.owns(k)]
+
+    def coordinate(self, report=False):
+        """Un latido: renueva el lease, relee las réplicas vivas y publica las claves propias."""
+        changed = self.coordinator.heartbeat()
+        self.coordinator.owned = self.owned_keys()
+        # Ritmo y backoff que guardaron las otras réplicas (para seconds_until)
+        for a in self.accounts:
+            a.scheduler.refresh()
+        if changed or report:
+            print(f"🤝 Réplica {self.coordinator.replica_id}: {len(self.coordinator.replicas)} réplicas vivas, "
+                  f"propias: {self.coordinator.owned}")
+
+    # ── Horario solar (solar.py: amanecer/atardecer calculados localmente) ──
+    def plant_coords(self, code):
+        cfg = self.config
+        return cfg.plant_coords.get(code) or self.registry.coords(code) or (cfg.site_lat, cfg.site_lon)
+
+    def due_stations(self, account, now=None):
+        """(plantas a consultar en este ciclo, hay alguna de día). De día entran todas;
+        de noche sólo las que no tienen muestra desde hace NIGHT_POLL_SECONDS."""
+        cfg = self.config
+        if not cfg.solar_schedule:
+            return self.owned_stations(account), True
+        now = now or datetime.now(timezone.utc)
+        due, daylight = [], False
+        for code in self.owned_stations(account):
+            lat, lon = self.plant_coords(code)
+            if solar.is_daylight(lat, lon, now, cfg.daylight_margin_minutes):
+                due.append(code)
+                daylight = True
+            elif now.timestamp() - account.last_poll.get(code, 0.0) >= cfg.night_poll_seconds:
+                due.append(code)
+        return due, daylight
+
+    def next_heartbeat_in(self, account, now=None):
+        stations = self.owned_stations(account)
+        if not stations:
+            return self.config.night_poll_seconds
+        now = (now or datetime.now(timezone.utc)).timestamp()
+        last = min(account.last_poll.get(c, 0.0) for c in stations)
+        return max(0.0, last + self.config.night_poll_seconds - now)
+
+    def daylight_boost(self, account, now=None):
+        """Factor de ritmo para las horas de sol: la cuota diaria (ritmo aprendido ×
+        24 h) menos lo que gastan los latidos nocturnos, repartida entre las horas de
+        día de la planta con el día más largo. Entre 1 y DAYLIGHT_BOOST_MAX."""
+        cfg = self.config
+        day = (now or datetime.now(timezone.utc)).date()
+        margin_h = 2 * cfg.daylight_margin_minutes / 60.0
+        stations = self.owned_stations(account)
+        day_hours = max(solar.daylight_hours(*self.plant_coords(c), day) for c in stations) + margin_h
+        day_hours = min(24.0, day_hours)
+        if day_hours <= 0 or day_hours >= 24.0:
+            return 1.0
+        if cfg.batch_mode:
+            calls_per_poll = len(_batches(stations, cfg.max_stations_per_call))
+        else:
+            calls_per_poll = len(stations)
+        night_per_hour = calls_per_poll * 3600.0 / cfg.night_poll_seconds
+        rate = account.scheduler.rate("getStationRealKpi")
+        budget = rate * 24.0 - night_per_hour * (24.0 - day_hours)
+        return max(1.0, min(cfg.daylight_boost_max, budget / (rate * day_hours)))
+
+    def _apply_solar_mode(self, account, daylight):
+        boost = self.daylight_boost(account) if daylight else 1.0
+        account.scheduler.set_boost("getStationRealKpi", boost)
+        if daylight != account.daylight:
+            if daylight:
+                print(f"☀️ [{account.name}] Día: ritmo ×{boost:.2f} para getStationRealKpi")
+            else:
+                print(f"🌙 [{account.name}] Noche: latido cada {self.config.night_poll_seconds:.0f}s por planta")
+            account.daylight = daylight
+
+    # ── Arranque y métricas ───────────────────────────────
+    def _refresh_metrics(self):
+        metrics.DB_PENDING.set(self.writer.pending())
+        metrics.DB_PENDING_AGE.set(self.writer.oldest_age())
+        for a in self.accounts:
+            for ep, info in a.scheduler.snapshot().items():
+                metrics.RATE_PER_HOUR.set(info["rate_per_hour"], account=a.name, endpoint=ep)
+                metrics.EFFECTIVE_PER_HOUR.set(info["effective_per_hour"], account=a.name, endpoint=ep)
+
+    def start(self, serve_metrics=True):
+        """Registro de plantas, deduplicación, spool pendiente y (si METRICS_PORT)
+        /metrics y /healthz."""
+        if serve_metrics and self.config.metrics_port and self.metrics_server is None:
+            self.metrics_server = metrics.start_http_server(
+                self.config.metrics_port, expected_plants=self.all_stations, refresh=self._refresh_metrics)
+        self.seed_stations()
+        if self.coordinator is not None:
+            self.coordinate(report=True)
+        n = self.changes.seed()
+        if n:
+            print(f"🧠 Deduplicación: último estado de {n} plantas cargado desde raw.fs_plants_last")
+        # Drena lo que haya quedado en el spool de una ejecución anterior
+        if self.writer.pending():
+            print(f"📦 Spool: {self.writer.pending()} filas pendientes de una ejecución anterior")
+            self.writer.flush()
+
+    # ── Engine asyncio ────────────────────────────────────
+    async def _io(self, fn, *args):
+        return await self._loop.run_in_executor(self.executor, fn, *args)
+
+    async def _sleep(self, seconds):
+        """Duerme `seconds` o hasta stop(). Devuelve True si hay que parar."""
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._stopping.wait(), timeout=max(0.0, seconds))
+        return self._stopping.is_set()
+
+    async def _turn(self, account, endpoint):
+        """Espera (sin ocupar un hilo) a que el scheduler tenga turno para
+        `endpoint`. Devuelve False si llegó stop() mientras tanto."""
+        waited = 0.0
+        while not self._stopping.is_set():
+            wait = account.scheduler.seconds_until(endpoint)
+            if wait <= 0:
+                metrics.RATE_WAIT_SECONDS.observe(waited, account=account.name, endpoint=endpoint)
+                metrics.SLEEP_SECONDS.inc(waited, account=account.name)
+                return True
+            if wait > 5:
+                print(f"RATE: [{account.name}] {endpoint} esperando {wait:.1f}s…", flush=True)
+            await self._sleep(wait)
+            waited += wait
         return False
-    finally:
-        safe_logout()
-        time.sleep(1.0)
+
+    async def _cycle(self, account):
+        """Un ciclo de la cuenta. Devuelve los segundos a esperar antes del siguiente."""
+        cfg = self.config
+        await self._io(self.discover_stations, account)
+        await self._io(self.registry.refresh)
+        if account.from_registry:
+            account.configured = self.registry.codes()
+        due, daylight = self.due_stations(account)
+        if cfg.solar_schedule:
+            self._apply_solar_mode(account, daylight)
+        if not due:
+            # Noche sin latidos pendientes: sólo medidores (si hay turno) y flush
+            if cfg.meters_enabled:
+                await self._io(self.fetch_meters, account)
+            if cfg.gap_repair:
+                await self._io(self.repair_gaps, account)
+            await self._io(self.writer.maybe_flush)
+            return min(60.0, max(1.0, self.next_heartbeat_in(account)))
+
+        t_cycle = time.perf_counter()
+        ok_count = 0
+        jobs = _batches(due, cfg.max_stations_per_call) if cfg.batch_mode else [[st] for st in due]
+        for codes in jobs:
+            if not await self._turn(account, "getStationRealKpi"):
+                return 0.0
+            ok_count += await self._io(self.fetch_stations, account, codes, False)
+        if cfg.meters_enabled:
+            await self._io(self.fetch_meters, account)
+        if cfg.gap_repair:
+            await self._io(self.repair_gaps, account)
+        metrics.CYCLE_SECONDS.observe(time.perf_counter() - t_cycle, account=account.name)
+        tag = f"[{account.name}]"
+        print(f"✅ {tag} Ciclo terminado: {ok_count}/{len(due)} plantas guardadas @ {datetime.now(timezone.utc).isoformat()}")
+        st = account.api.stats()
+        print(f"📊 {tag} API: logins={st['logins']} (re-login={st['relogins']}) llamadas de datos={st['data_calls']}")
+        for ep, info in account.scheduler.snapshot().items():
+            print(f"📊 {tag} RATE {ep}: {info['effective_per_hour']} llamadas en la última hora, "
+                  f"ritmo={info['rate_per_hour']}/h ×{info['boost']} techo={info['ceiling_per_hour']} "
+                  f"407={info['throttles']} backoff={info['backoff_remaining_s']}s")
+        await self._io(self.writer.maybe_flush)
+        db = self.writer.stats()
+        if db["buffered"]:
+            print(f"📦 DB: {db['buffered']} filas en spool pendientes de escribir")
+        return 0.0
+
+    async def _coordinate(self):
+        while not await self._sleep(self.coordinator.heartbeat_seconds):
+            await self._io(self.coordinate)
+
+    async def _run_account(self, account, cycles=None):
+        # Sin estado previo del scheduler no sabemos cuándo fue la última llamada
+        if account.scheduler.fresh and not account.cool_start_done:
+            print(f"[{account.name}] START: esperando {self.config.startup_cooldown_seconds}s (cooldown de arranque)…", flush=True)
+            if await self._sleep(self.config.startup_cooldown_seconds):
+                return
+        account.cool_start_done = True
+        n = 0
+        try:
+            while not self._stopping.is_set():
+                delay = await self._cycle(account)
+                n += 1
+                if cycles and n >= cycles:
+                    break
+                if delay and await self._sleep(delay):
+                    break
+        except SchedulerStopped:
+            pass
+
+    async def run(self, cycles=None):
+        """Recolecta con todas las cuentas a la vez hasta stop(), o `cycles`
+        ciclos por cuenta. Un error en una cuenta detiene el resto y se propaga."""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if self.stopped:
+            return
+        await self._io(self.start, cycles is None)
+        tasks = [asyncio.create_task(self._run_account(a, cycles), name=f"cuenta-{a.name}")
+                 for a in self.accounts]
+        background = [asyncio.create_task(self._coordinate())] if self.coordinator is not None else []
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self._stopping.set()
+            for t in tasks + background:
+                t.cancel()
+
+    def stop(self):
+        """Pide a run() que termine. Seguro desde otro hilo o un manejador de señal."""
+        self.stopped = True
+        for a in self._accounts or []:
+            a.scheduler.stop()
+        if self._loop is not None and not self._loop.is_closed():
+            with suppress(RuntimeError):   # el loop pudo cerrarse entre medio
+                self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def close(self):
+        """Espera las llamadas en curso, vacía el spool a Postgres y libera sesiones,
+        pool de conexiones, spool y servidor de métricas."""
+        self.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for a in self._accounts or []:
+            a.api.close()
+            if a.scheduler.ledger is not None:
+                a.scheduler.ledger.close()
+        if self._writer is not None:
+            self._writer.flush()
+            self._writer.spool.close()
+            self._writer = None
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        if self.coordinator is not None:
+            self.coordinator.release()
+        close_pool()
 
 # ─────────────────────────────────────────────────────────
-# Loop principal
+# Script
 # ─────────────────────────────────────────────────────────
-def loop():
-    while True:
-        ok_count = 0
-        for st in STATIONS:
-            time.sleep(random.uniform(0.0,0.6))
-            if fetch_one_plant(st): ok_count += 1
-        print(f"✅ Ciclo terminado: {ok_count}/{len(STATIONS)} plantas guardadas @ {datetime.now(timezone.utc).isoformat()}")
-        print("🔄 Iniciando nuevo ciclo de inmediato…")
+async def _serve(collector, cycles):
+    # SIGTERM (docker stop) = parada ordenada; SIGINT lo maneja asyncio.run
+    with suppress(NotImplementedError, RuntimeError, ValueError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, collector.stop)
+    await collector.run(cycles=cycles)
 
-if __name__ == "__main__":
-    try: loop()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recolector FusionSolar → raw.fs_realtime_plants")
+    parser.add_argument("--once", action="store_true",
+                        help="un solo ciclo por cuenta y salir (para cron)")
+    args = parser.parse_args(argv)
+
+    load_dotenv(".env")
+    collector = Collector()
+    try:
+        asyncio.run(_serve(collector, 1 if args.once else None))
+    except KeyboardInterrupt:
+        print("\n🛑 Detenido: vaciando spool…")
     except Exception as e:
         print(f"\n❌ ERROR CRÍTICO EN EL SCRIPT: {e}")
         time.sleep(3); raise
-    
+    finally:
+        collector.close()
+
+if __name__ == "__main__":
+    main()
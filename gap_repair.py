@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import solar
+
+# ─────────────────────────────────────────────────────────
+# Reparación de huecos en raw.fs_realtime_plants
+# ─────────────────────────────────────────────────────────
+# getStationRealKpi sólo da el valor de ahora: si una consulta falla (login, 407,
+# base caída) ese intervalo queda vacío. Esta etapa busca los huecos de cada
+# planta con una sola consulta por rango sobre la hypertable, junta todos los
+# huecos de todas las plantas de un mismo día local en una llamada
+# getKpiStationHour (hasta 100 plantas, el día completo por hora) y guarda los
+# puntos que caen dentro de los huecos con source = 'kpi_hour' y ON CONFLICT DO
+# NOTHING. Sólo cuentan los huecos con sol: de noche no hay nada que recuperar.
+#
+# Cada hora recuperada se guarda como un punto a la mitad de la hora con la
+# potencia media (kWh de la hora / 1 h) y el acumulado del día interpolado; el
+# contador total queda NULL (la etapa de calidad usa la integral de potencia).
+
+SOURCE = "kpi_hour"
+LOCAL_TZ = ZoneInfo("America/Bogota")
+HOUR_S = 3600.0
+
+# Los límites del rango entran como muestras ficticias para que una planta sin
+# ninguna muestra (o sin muestras al principio/final) también muestre su hueco.
+# Entre dos puntos ya recuperados (una hora) no hay hueco que reparar.
+GAPS_SQL = """
+    WITH s AS (
+        SELECT plant_code, ts_utc, source
+        FROM raw.fs_realtime_plants
+        WHERE ts_utc >= %(start)s AND ts_utc < %(end)s
+          AND plant_code = ANY(%(codes)s)
+        UNION ALL
+        SELECT c, t, NULL
+        FROM unnest(%(codes)s::text[]) AS c,
+             unnest(ARRAY[%(start)s, %(end)s]::timestamptz[]) AS t
+    ),
+    g AS (
+        SELECT plant_code, ts_utc AS gap_start, source,
+               lead(ts_utc) OVER w AS gap_end,
+               lead(source) OVER w AS next_source
+        FROM s
+        WINDOW w AS (PARTITION BY plant_code ORDER BY ts_utc)
+    )
+    SELECT plant_code, gap_start, gap_end
+    FROM g
+    WHERE gap_end - gap_start > make_interval(secs => %(min_gap)s)
+      AND NOT (%(source)s IN (source, next_source)
+               AND gap_end - gap_start <= make_interval(secs => %(hour_slack)s))
+    ORDER BY plant_code, gap_start
+"""
+
+def find_gaps(cursor, codes, start, end, min_gap_seconds):
+    """[(código, inicio, fin)] de los intervalos sin muestras más largos que
+    `min_gap_seconds` en [start, end)."""
+    if not codes:
+        return []
+    cursor.execute(GAPS_SQL, {"codes": list(codes), "start": start, "end": end,
+                              "min_gap": float(min_gap_seconds), "source": SOURCE,
+                              "hour_slack": HOUR_S + max(float(min_gap_seconds), 300.0)})
+    return cursor.fetchall()
+
+def plan_days(gaps, coords, margin_minutes=0.0):
+    """{día local: {código: [(inicio, fin), ...]}} con los huecos que tienen sol.
+    `coords(código)` → (lat, lon). Un hueco que cruza la medianoche entra en
+    cada día que toca, si en ese día le da el sol."""
+    plan = {}
+    for code, gap_start, gap_end in gaps:
+        lat, lon = coords(code)
+        day = gap_start.astimezone(LOCAL_TZ).date()
+        last = gap_end.astimezone(LOCAL_TZ).date()
+        while day <= last:
+            day_start = datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ)
+            a = max(gap_start, day_start)
+            b = min(gap_end, day_start + timedelta(days=1))
+            if solar.daylight_seconds(lat, lon, a, b, margin_minutes) > 0:
+                plan.setdefault(day, {}).setdefault(code, []).append((gap_start, gap_end))
+            day += timedelta(days=1)
+    return plan
+
+def collect_time_ms(day):
+    """Medianoche local de `day` en ms (collectTime de los endpoints de histórico)."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ).timestamp() * 1000)
+
+def _hour_kwh(item):
+    dim = item.get("dataItemMap") if isinstance(item, dict) else None
+    value = (dim or {}).get("inverter_power")
+    if value is None:
+        value = (dim or {}).get("product_power")
+    try:
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+def rows_from_hours(items, day, gaps_by_code):
+    """Filas (plant_code, ts_utc, power_kw, day_power_kwh, source) de una respuesta
+    getKpiStationHour del día local `day`, sólo las que caen dentro de un hueco."""
+    hours = {}
+    for item in items or []:
+        code = item.get("stationCode") if isinstance(item, dict) else None
+        if code not in gaps_by_code or item.get("collectTime") is None:
+            continue
+        ts = datetime.fromtimestamp(int(item["collectTime"]) / 1000.0, timezone.utc)
+        if ts.astimezone(LOCAL_TZ).date() != day:
+            continue
+        kwh = _hour_kwh(item)
+        if kwh is not None:
+            hours.setdefault(code, []).append((ts, kwh))
+
+    rows = []
+    for code, series in hours.items():
+        cum = 0.0
+        for ts, kwh in sorted(series):
+            mid = ts + timedelta(seconds=HOUR_S / 2)
+            if any(a < mid < b for a, b in gaps_by_code[code]):
+                rows.append((code, mid, round(kwh, 3), round(cum + kwh / 2.0, 3), SOURCE))
+            cum += kwh
+    return rows
@@ -0,0 +1,193 @@
+from datetime import timedelta
+import psycopg2
+import psycopg2.extras
+
+from consolidate_daily import CASA_TREJO_ID, LOCAL_TZ, local_day_range, plant_cap
+
+# ─────────────────────────────────────────────────────────
+# Rendimiento intradía en fs.plant_daily_metrics
+# ─────────────────────────────────────────────────────────
+# consolidate_daily.py escribe el rendimiento de un día recién al día siguiente.
+# Mientras tanto cada panel lo recalculaba con MAX(total_power_kwh) menos el
+# máximo de ayer sobre la hypertable. Este motor lo mantiene en el camino de
+# escritura del recolector (db_writer.write_rows). Guarda en memoria, por planta
+# y día local, el acumulado al empezar el día (máximo crudo de ayer) y los
+# máximos del día. Con cada escritura hace UPSERT de la fila parcial del día con
+# source = 'intraday_partial'. Las reglas son las de DAILY_YIELD_SQL, con el
+# mismo tope kWp × 6.5 h (consolidate_daily.plant_cap).
+#
+# Al arrancar, o cuando llega una planta-día que no está en memoria (otra réplica
+# soltó el lote, muestras atrasadas del spool), el estado se lee de la base con
+# una consulta por día. Sólo se pisan filas que siguen siendo parciales: las de
+# la consolidación y las de la API oficial mandan. La consolidación nocturna
+# toma la fila parcial y la da por cerrada (ver PARTIAL_YIELD_SQL).
+
+SOURCE = "intraday_partial"
+
+RESTORE_SQL = """
+    SELECT plant_code,
+           (ts_utc AT TIME ZONE 'America/Bogota')::date AS d,
+           MAX(total_power_kwh) AS total_max,
+           MAX(day_power_kwh)   AS day_max
+    FROM raw.fs_realtime_plants
+    WHERE ts_utc >= %(start)s AND ts_utc < %(end)s
+      AND plant_code = ANY(%(codes)s)
+    GROUP BY 1, 2
+"""
+
+# Casa Trejo parte del acumulado de la fila de ayer, como en la consolidación
+PREV_CUMULATIVE_SQL = """
+    SELECT cumulative_energy_kwh FROM fs.plant_daily_metrics
+    WHERE plant_id = %s AND date = %s
+"""
+
+UPSERT_PARTIAL_SQL = """
+    INSERT INTO fs.plant_daily_metrics AS m
+    (plant_id, plant_code, date, fv_yield_kwh, inverter_yield_kwh,
+     cumulative_energy_kwh, day_start_kwh, specific_yield_kwh_kwp, source, created_at)
+    VALUES %s
+    ON CONFLICT (plant_id, date) DO UPDATE SET
+        fv_yield_kwh = EXCLUDED.fv_yield_kwh,
+        inverter_yield_kwh = EXCLUDED.inverter_yield_kwh,
+        cumulative_energy_kwh = EXCLUDED.cumulative_energy_kwh,
+        day_start_kwh = EXCLUDED.day_start_kwh,
+        specific_yield_kwh_kwp = EXCLUDED.specific_yield_kwh_kwp,
+        updated_at = NOW()
+    WHERE m.source = 'intraday_partial'
+"""
+
+def _f(v):
+    return float(v) if v is not None else None
+
+def _max(a, b):
+    if a is None:
+        return b
+    return a if b is None else max(a, b)
+
+def day_yield(total_max, day_max, day_start, cap, casa_trejo=False):
+    """(kWh, método) de una planta-día con las reglas de DAILY_YIELD_SQL."""
+    day_max = day_max or 0.0
+    if not day_start:
+        return day_max, "raw_no_history"
+    diff = total_max - day_start
+    if 0 <= diff <= cap:
+        return diff, "math_casa_trejo" if casa_trejo else "math_calc"
+    return day_max, "raw_fallback_outlier"
+
+class DayState:
+    __slots__ = ("day_start", "total_max", "day_max", "written")
+
+    def __init__(self, day_start=None, total_max=None, day_max=None):
+        self.day_start = day_start      # acumulado al empezar el día (máximo de ayer)
+        self.total_max = total_max
+        self.day_max = day_max
+        self.written = None             # última fila parcial guardada
+
+class IntradayYield:
+    """Estado por planta y día local. `registry` es el PlantRegistry del
+    recolector (plant_id, kWp y topes). Lo usa un solo hilo a la vez: el
+    flush de DbWriter."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.days = {}          # plant_code → {día local: DayState}
+        self.upserts = 0
+
+    def _restore(self, cur, keys):
+        """Lee de la base el estado de las planta-día `keys` que no están en memoria."""
+        by_day = {}
+        for code, day in keys:
+            by_day.setdefault(day, []).append(code)
+        for day, codes in by_day.items():
+            start, end = local_day_range(day - timedelta(days=1), day)
+            cur.execute(RESTORE_SQL, {"codes": codes, "start": start, "end": end})
+            found = {(c, d): (_f(t), _f(m)) for c, d, t, m in cur.fetchall()}
+            for code in codes:
+                day_start = found.get((code, day - timedelta(days=1)), (None, None))[0]
+                if self.registry.get(code).plant_id == CASA_TREJO_ID:
+                    cur.execute(PREV_CUMULATIVE_SQL, (CASA_TREJO_ID, day - timedelta(days=1)))
+                    row = cur.fetchone()
+                    day_start = _f(row[0]) if row else None
+                self.days.setdefault(code, {})[day] = DayState(day_start, *found.get((code, day), (None, None)))
+
+    def _state(self, code, day, missing):
+        days = self.days.get(code, {})
+        if day in days:
+            return days[day]
+        prev = days.get(day - timedelta(days=1))
+        if prev is not None and prev.total_max is not None:
+            # Cambio de día con ayer en memoria: no hace falta ir a la base
+            state = days[day] = DayState(prev.total_max)
+            return state
+        missing.add((code, day))
+        return None
+
+    def apply(self, cur, rows):
+        """Suma filas de planta (plant_code, ts_utc, plant_name, power_kw, day,
+        month, total, health) y guarda la fila parcial de cada planta-día que
+        cambió. Corre en la transacción de write_rows dentro de un savepoint: si
+        falla, las muestras crudas se guardan igual. Devuelve los pares
+        (estado, fila) pendientes; quien hace el commit los pasa a written()."""
+        by_key = {}
+        for row in rows:
+            p = self.registry.get(row[0])
+            if p is None or plant_cap(p) is None:
+                continue
+            by_key.setdefault((row[0], row[1].astimezone(LOCAL_TZ).date()), []).append(row)
+        if not by_key:
+            return []
+
+        cur.execute("SAVEPOINT intraday")
+        try:
+            missing = set()
+            for code, day in sorted(by_key, key=lambda k: k[1]):
+                self._state(code, day, missing)
+            if missing:
+                self._restore(cur, missing)
+
+            upserts, states = [], []
+            for (code, day), samples in by_key.items():
+                state = self.days[code][day]
+                for row in samples:
+                    state.total_max = _max(state.total_max, _f(row[6]))
+                    state.day_max = _max(state.day_max, _f(row[4]))
+                if state.total_max is None:
+                    continue
+                p = self.registry.get(code)
+                kwh, _ = day_yield(state.total_max, state.day_max, state.day_start,
+                                   plant_cap(p), p.plant_id == CASA_TREJO_ID)
+                if kwh < 0:
+                    continue
+                row = (p.plant_id, code, day, kwh, kwh, state.total_max,
+                       state.day_start, round(kwh / (p.capacity_kw or 1), 3), SOURCE)
+                if row != state.written:
+                    upserts.append(row)
+                    states.append(state)
+            if upserts:
+                psycopg2.extras.execute_values(
+                    cur, UPSERT_PARTIAL_SQL, upserts,
+                    template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())",
+                    page_size=1000,
+                )
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT intraday")
+            print(f"⚠️ Rendimiento intradía no guardado: {e}")
+            return []
+        cur.execute("RELEASE SAVEPOINT intraday")
+        self._prune(code for code, _ in by_key)
+        return list(zip(states, upserts))
+
+    def written(self, pending):
+        """Marca como guardadas las filas de apply() una vez hecho el commit. Si
+        el commit falla no se llama y el reintento vuelve a escribirlas."""
+        for state, row in pending:
+            state.written = row
+        self.upserts += len(pending)
+
+    def _prune(self, codes):
+        """Sólo el día más reciente de cada planta y el anterior."""
+        for code in set(codes):
+            days = self.days[code]
+            newest = max(days)
+            for day in [d for d in days if d < newest - timedelta(days=1)]:
+                del days[day]
@@ -0,0 +1,216 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ─────────────────────────────────────────────────────────
+# Métricas estilo Prometheus (sin dependencias externas)
+# ─────────────────────────────────────────────────────────
+# Contadores, gauges e histogramas con etiquetas, expuestos en texto Prometheus
+# por /metrics. /healthz responde 503 cuando los datos dejan de llegar; el
+# HEALTHCHECK del Dockerfile lo usa.
+
+_registry = []
+_lock = threading.Lock()
+START_TIME = time.time()
+
+def _esc(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in pairs) + "}"
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.values = {}
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            items = list(self.values.items())
+        for key, v in items:
+            lines.append(f"{self.name}{_fmt_labels(self.label_names, key)} {_fmt_value(v)}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        k = self._key(labels)
+        with _lock:
+            self.values[k] = self.values.get(k, 0.0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = float(value)
+
+    def get(self, **labels):
+        with _lock:
+            return self.values.get(self._key(labels))
+
+    def items(self):
+        with _lock:
+            return [(dict(zip(self.label_names, k)), v) for k, v in self.values.items()]
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180, 600)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        k = self._key(labels)
+        with _lock:
+            h = self.values.get(k)
+            if h is None:
+                h = self.values[k] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h["counts"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            items = [(k, dict(h, counts=list(h["counts"]))) for k, h in self.values.items()]
+        for key, h in items:
+            acc = 0
+            for le, c in zip(self.buckets, h["counts"]):
+                acc += c
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, [('le', le)])} {acc}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, [('le', '+Inf')])} {h['count']}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {_fmt_value(h['sum'])}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {h['count']}")
+        return lines
+
+# ─────────────────────────────────────────────────────────
+# Métricas del recolector
+# ─────────────────────────────────────────────────────────
+API_SECONDS = Histogram("fusion_api_request_seconds", "Latencia de llamadas a la API Northbound", ("account", "endpoint"))
+API_CALLS = Counter("fusion_api_calls_total", "Llamadas a la API por resultado (ok, throttled, failed, expired, error)", ("account", "endpoint", "result"))
+RATE_WAIT_SECONDS = Histogram("fusion_rate_wait_seconds", "Espera impuesta por el scheduler antes de cada llamada", ("account", "endpoint"))
+SLEEP_SECONDS = Counter("fusion_sleep_seconds_total", "Segundos dormidos esperando turno de rate-limit", ("account",))
+CYCLE_SECONDS = Histogram("fusion_cycle_seconds", "Duración de un ciclo completo de una cuenta", ("account",))
+RATE_PER_HOUR = Gauge("fusion_rate_per_hour", "Ritmo actual del scheduler (llamadas/hora)", ("account", "endpoint"))
+EFFECTIVE_PER_HOUR = Gauge("fusion_effective_calls_last_hour", "Llamadas hechas en la última hora", ("account", "endpoint"))
+DB_WRITE_SECONDS = Histogram("fusion_db_write_seconds", "Latencia de una escritura en bloque a Postgres", ("kind",))
+DB_ROWS = Counter("fusion_db_rows_written_total", "Filas escritas en Postgres", ("kind",))
+DB_ERRORS = Counter("fusion_db_write_errors_total", "Escrituras en bloque fallidas", ("kind",))
+SAMPLES_SKIPPED = Counter("fusion_samples_skipped_total", "Muestras sin cambios no reinsertadas (deduplicación)", ("plant_code",))
+DB_PENDING = Gauge("fusion_db_pending_rows", "Filas en spool/buffer aún sin escribir")
+DB_PENDING_AGE = Gauge("fusion_db_pending_oldest_seconds", "Antigüedad de la fila pendiente más vieja")
+PLANT_LAST_SAMPLE = Gauge("fusion_plant_last_sample_timestamp_seconds", "Última muestra obtenida de la API por planta (epoch)", ("plant_code",))
+PLANT_LAST_WRITE = Gauge("fusion_plant_last_write_timestamp_seconds", "Última muestra escrita en Postgres por planta (epoch)", ("plant_code",))
+PLANT_SAMPLE_AGE = Gauge("fusion_plant_sample_age_seconds", "Segundos desde la última muestra de la API por planta", ("plant_code",))
+RATE_LEDGER_FALLBACKS = Counter("fusion_rate_ledger_fallbacks_total", "Turnos de rate-limit decididos sin ops.rate_ledger (copia local)", ("account",))
+GAP_ROWS_RECOVERED = Counter("fusion_gap_rows_recovered_total", "Puntos de huecos recuperados con getKpiStationHour", ("account",))
+UP_SECONDS = Gauge("fusion_uptime_seconds", "Segundos desde el arranque del proceso")
+
+def _refresh_derived():
+    now = time.time()
+    UP_SECONDS.set(now - START_TIME)
+    for labels, ts in PLANT_LAST_SAMPLE.items():
+        PLANT_SAMPLE_AGE.set(now - ts, **labels)
+
+def render():
+    _refresh_derived()
+    with _lock:
+        metrics = list(_registry)
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+def health(expected_plants=(), max_age=None):
+    """(ok, motivo). Falla si alguna planta no tiene muestra reciente o si hay filas
+    pendientes de escribir hace más de `max_age` segundos."""
+    max_age = max_age if max_age is not None else float(os.getenv("HEALTH_MAX_AGE_SECONDS", "1800"))
+    now = time.time()
+    if now - START_TIME < max_age:
+        return True, "arrancando"
+    stale = []
+    for code in expected_plants:
+        ts = PLANT_LAST_SAMPLE.get(plant_code=code)
+        if ts is None or now - ts > max_age:
+            stale.append(code)
+    if stale:
+        return False, f"sin muestras recientes: {','.join(stale)}"
+    age = DB_PENDING_AGE.get() or 0.0
+    if age > max_age:
+        return False, f"escritura a Postgres atrasada {age:.0f}s"
+    return True, "ok"
+
+# ─────────────────────────────────────────────────────────
+# Servidor HTTP
+# ─────────────────────────────────────────────────────────
+def start_http_server(port, expected_plants=(), refresh=None):
+    """Sirve /metrics y /healthz en un hilo daemon. `expected_plants` puede ser una
+    función que devuelve la lista actual de plantas; `refresh` se llama antes de
+    responder para actualizar gauges que se leen bajo demanda."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if refresh and path in ("/metrics", "/healthz"):
+                try:
+                    refresh()
+                except Exception:
+                    pass
+            if path == "/metrics":
+                body, status = render().encode(), 200
+                ctype = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/healthz":
+                plants = expected_plants() if callable(expected_plants) else expected_plants
+                ok, reason = health(plants)
+                body, status = (reason + "\n").encode(), 200 if ok else 503
+                ctype = "text/plain; charset=utf-8"
+            else:
+                body, status, ctype = b"not found\n", 404, "text/plain"
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Métricas en http://0.0.0.0:{port}/metrics (salud en /healthz)")
+    return server
@@ -0,0 +1,466 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import traceback
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import psycopg2
+from dotenv import load_dotenv
+
+from db_writer import _conn_params
+
+# ─────────────────────────────────────────────────────────
+# Migración de las hypertables crudas a columnas compactas
+# ─────────────────────────────────────────────────────────
+# Despliegues creados con la versión anterior de db_init.sql guardan cada métrica
+# como numeric (tamaño variable) y repiten plant_name en cada muestra. Este script
+# las pasa al esquema actual de db_init.sql (real / double precision / smallint,
+# sin plant_name, compresión ordenada por ts_utc DESC) sin detener el recolector:
+#
+#   1. informe "antes": tamaño de chunks y tiempos de dos lecturas típicas
+#   2. nombres de raw.fs_plants_last → dim.fs_plants (donde falten)
+#   3. copia en línea a <tabla>_compact, un tramo de --step-hours por
+#      transacción (se puede cortar y volver a correr: retoma donde quedó).
+#      Después, una segunda pasada en línea recopia la ventana de filas
+#      atrasadas desde que empezó la copia (ver late_window)
+#   4. cambio de nombres en una transacción corta: bloquea las escrituras,
+#      copia las filas atrasadas y las nuevas que llegaron durante la segunda
+#      pasada y renombra. Las tablas viejas quedan
+#      como <tabla>_numeric y los agregados continuos viejos como
+#      agg.*_legacy, con el histórico anterior a la ventana cruda (la
+#      retención de 180 días los vacía solos; --drop-old lo hace ya)
+#   5. agregados continuos nuevos sobre la tabla nueva, políticas, compresión
+#      de los chunks de más de 7 días e informe "después"
+#
+# Mientras dura el paso 4 el recolector no puede escribir: sus filas esperan en
+# el spool local y entran en el siguiente flush.
+
+LOCAL_WINDOW_DAYS = 30             # ventana de la lectura "todas las plantas"
+LATE_MARGIN = timedelta(days=1)    # holgura sobre la ventana de filas atrasadas
+COPY_STARTED = "migrate_compact: copia iniciada "   # comentario de <tabla>_compact
+
+# Columnas compactas (en el orden de db_init.sql) e índice de cada tabla
+TABLES = {
+    "raw.fs_realtime_plants": {
+        "columns": [
+            ("ts_utc", "timestamptz NOT NULL"),
+            ("plant_code", "text NOT NULL"),
+            ("power_kw", "real"),
+            ("day_power_kwh", "real"),
+            ("month_power_kwh", "double precision"),
+            ("total_power_kwh", "double precision"),
+            ("health", "smallint"),
+            ("source", "text"),
+        ],
+        "index": "idx_fs_realtime_plants",
+        "metric": "power_kw",
+    },
+    "raw.fs_meter_realtime": {
+        "columns": [
+            ("ts_utc", "timestamptz NOT NULL"),
+            ("plant_code", "text NOT NULL"),
+            ("import_kw", "real"),
+            ("export_kw", "real"),
+            ("load_kw", "real"),
+            ("self_use_kw", "real"),
+        ],
+        "index": "idx_fs_meter_realtime",
+        "metric": "import_kw",
+    },
+}
+
+NAMES_TO_DIM_SQL = """
+    INSERT INTO dim.fs_plants AS p (plant_code, plant_name)
+    SELECT plant_code, plant_name
+    FROM raw.fs_plants_last
+    WHERE plant_name IS NOT NULL AND plant_name <> plant_code
+    ON CONFLICT (plant_code) DO UPDATE SET
+      plant_name  = EXCLUDED.plant_name,
+      updated_utc = now()
+    WHERE p.plant_name IS NULL
+"""
+
+# Igual que la sección "Agregados continuos" de db_init.sql
+CAGGS = [
+    ("agg.fs_plants_hourly", """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS agg.fs_plants_hourly
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+        SELECT plant_code,
+               time_bucket(INTERVAL '1 hour', ts_utc) AS bucket,
+               AVG(power_kw)                  AS power_kw_avg,
+               MAX(power_kw)                  AS power_kw_max,
+               last(total_power_kwh, ts_utc)  AS total_power_kwh_last,
+               MAX(total_power_kwh)           AS total_power_kwh_max,
+               MAX(day_power_kwh)             AS day_power_kwh_max,
+               COUNT(*)                       AS samples
+        FROM raw.fs_realtime_plants
+        GROUP BY plant_code, bucket
+        WITH NO DATA""", "3 days", "1 hour", "30 minutes"),
+    ("agg.fs_plants_daily", """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS agg.fs_plants_daily
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+        SELECT plant_code,
+               time_bucket(INTERVAL '1 day', bucket, 'America/Bogota') AS day,
+               SUM(power_kw_avg * samples) / NULLIF(SUM(samples), 0)    AS power_kw_avg,
+               MAX(power_kw_max)                                         AS power_kw_max,
+               last(total_power_kwh_last, bucket)                        AS total_power_kwh_last,
+               MAX(total_power_kwh_max)                                  AS total_power_kwh_max,
+               MAX(day_power_kwh_max)                                    AS day_power_kwh_max,
+               SUM(samples)                                              AS samples
+        FROM agg.fs_plants_hourly
+        GROUP BY plant_code, day
+        WITH NO DATA""", "7 days", "1 day", "1 hour"),
+]
+
+def connect():
+    return psycopg2.connect(**_conn_params())
+
+def _split(table):
+    schema, name = table.split(".")
+    return schema, name
+
+def column_types(cur, table):
+    schema, name = _split(table)
+    cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+    """, (schema, name))
+    return dict(cur.fetchall())
+
+def is_compact(cur, table):
+    types = column_types(cur, table)
+    return types.get(TABLES[table]["metric"]) == "real" and "plant_name" not in types
+
+def _exists(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cur.fetchone()[0]
+
+# ─────────────────────────────────────────────────────────
+# Informe de tamaño y tiempos de lectura
+# ─────────────────────────────────────────────────────────
+def _best_ms(cur, sql, params, runs=3):
+    best = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        cur.execute(sql, params)
+        cur.fetchall()
+        ms = (time.perf_counter() - t0) * 1000.0
+        best = ms if best is None else min(best, ms)
+    return round(best, 1)
+
+def measure(cur, table):
+    """Chunks, bytes (total y comprimidos), filas aproximadas y el mejor de 3
+    tiempos para dos lecturas: una planta 7 días y todas las plantas 30 días."""
+    metric = TABLES[table]["metric"]
+    cur.execute("SELECT count(*), COALESCE(sum(total_bytes), 0) FROM chunks_detailed_size(%s)", (table,))
+    chunks, total_bytes = cur.fetchone()
+    cur.execute("""
+        SELECT COALESCE(sum(before_compression_total_bytes), 0), COALESCE(sum(after_compression_total_bytes), 0)
+        FROM hypertable_compression_stats(%s)
+    """, (table,))
+    before_c, after_c = cur.fetchone()
+    cur.execute("SELECT approximate_row_count(%s)", (table,))
+    rows = cur.fetchone()[0]
+    cur.execute(f"SELECT plant_code FROM {table} ORDER BY ts_utc DESC LIMIT 1")
+    one = cur.fetchone()
+    one_plant = _best_ms(cur, f"""
+        SELECT count(*), max({metric}) FROM {table}
+        WHERE plant_code = %s AND ts_utc >= now() - INTERVAL '7 days'
+    """, (one[0] if one else "",))
+    all_plants = _best_ms(cur, f"""
+        SELECT plant_code, max({metric}), count(*) FROM {table}
+        WHERE ts_utc >= now() - make_interval(days => %s)
+        GROUP BY plant_code
+    """, (LOCAL_WINDOW_DAYS,))
+    return {"chunks": chunks, "bytes": int(total_bytes), "rows": int(rows),
+            "compressed_from": int(before_c), "compressed_to": int(after_c),
+            "scan_one_plant_7d_ms": one_plant, f"scan_all_plants_{LOCAL_WINDOW_DAYS}d_ms": all_plants}
+
+def _mb(n):
+    return f"{n / 1024 / 1024:,.1f} MB"
+
+def print_report(label, report):
+    print(f"\n📏 {label}")
+    for table, r in report.items():
+        avg = r["bytes"] / r["chunks"] if r["chunks"] else 0
+        print(f"   {table}: {r['chunks']} chunks, {_mb(r['bytes'])} (promedio {_mb(avg)}/chunk), "
+              f"~{r['rows']:,} filas")
+        if r["compressed_from"]:
+            print(f"      comprimido: {_mb(r['compressed_from'])} → {_mb(r['compressed_to'])}")
+        print(f"      lectura 1 planta 7 días: {r['scan_one_plant_7d_ms']} ms | "
+              f"todas {LOCAL_WINDOW_DAYS} días: {r[f'scan_all_plants_{LOCAL_WINDOW_DAYS}d_ms']} ms")
+
+def print_comparison(before, after):
+    print("\n📊 Antes → después")
+    for table in after:
+        b, a = before.get(table), after[table]
+        if not b:
+            continue
+        for key in ("bytes", "scan_one_plant_7d_ms", f"scan_all_plants_{LOCAL_WINDOW_DAYS}d_ms"):
+            ratio = f"×{a[key] / b[key]:.2f}" if b[key] else "-"
+            print(f"   {table} {key}: {b[key]:,} → {a[key]:,} ({ratio})")
+
+# ─────────────────────────────────────────────────────────
+# Pasos de la migración
+# ─────────────────────────────────────────────────────────
+def create_compact(cur, table):
+    spec = TABLES[table]
+    new = f"{table}_compact"
+    cols = ",\n  ".join(f"{c} {t}" for c, t in spec["columns"])
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {new} (\n  {cols},\n  PRIMARY KEY (ts_utc, plant_code)\n)")
+    cur.execute("SELECT create_hypertable(%s, 'ts_utc', if_not_exists => TRUE, "
+                "chunk_time_interval => INTERVAL '1 day')", (new,))
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {spec['index']}_compact ON {new} (plant_code, ts_utc DESC)")
+    if copy_started(cur, table) is None:
+        # Las filas atrasadas se buscan desde aquí (copy_late), también al retomar
+        cur.execute(f"COMMENT ON TABLE {new} IS %s", (COPY_STARTED + datetime.now(timezone.utc).isoformat(),))
+    cur.execute(f"""ALTER TABLE {new} SET (
+        timescaledb.compress,
+        timescaledb.compress_segmentby = 'plant_code',
+        timescaledb.compress_orderby   = 'ts_utc DESC')""")
+
+def _copy_sql(cur, table):
+    """INSERT … SELECT de las columnas que existen en ambas tablas."""
+    old_cols = column_types(cur, table)
+    cols = ", ".join(c for c, _ in TABLES[table]["columns"] if c in old_cols)
+    return f"""
+        INSERT INTO {table}_compact ({cols})
+        SELECT {cols} FROM {table}
+        WHERE ts_utc >= %s AND ts_utc < %s
+        ON CONFLICT (ts_utc, plant_code) DO NOTHING
+    """
+
+def late_window(spool_hours=None):
+    """Hasta cuánto antes de ser insertada puede caer una fila del recolector:
+    la reparación de huecos escribe hasta GAP_REPAIR_LOOKBACK_HOURS atrás y el
+    spool reenvía muestras tan viejas como su fila más antigua. Si el spool no
+    está en esta máquina hay que pasar --spool-hours."""
+    lookback = float(os.getenv("GAP_REPAIR_LOOKBACK_HOURS", "48"))
+    if spool_hours is None:
+        spool_hours = 0.0
+        path = os.getenv("SPOOL_FILE") or Path(os.getenv("RATE_STATE_FILE", ".rate_state.json")).parent / ".spool.sqlite3"
+        if Path(path).exists():
+            with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as db:
+                oldest = db.execute("SELECT min(created_s) FROM spool").fetchone()[0]
+            spool_hours = max(0.0, (time.time() - oldest) / 3600.0) if oldest else 0.0
+        else:
+            print(f"   ⚠️ Spool {path} no encontrado: si el recolector corre en otra máquina usar --spool-hours")
+    window = timedelta(hours=lookback + spool_hours) + LATE_MARGIN
+    print(f"   ⏪ Ventana de filas atrasadas: {window} (huecos {lookback:.0f}h + spool {spool_hours:.1f}h + holgura)")
+    return window
+
+def copy_started(cur, table):
+    """Cuándo empezó la primera copia a <tabla>_compact (anotado al crearla)."""
+    cur.execute("SELECT obj_description(%s::regclass, 'pg_class')", (f"{table}_compact",))
+    note = cur.fetchone()[0] or ""
+    if note.startswith(COPY_STARTED):
+        return datetime.fromisoformat(note[len(COPY_STARTED):])
+    return None
+
+def _copy_range(conn, table, sql, a, end, step, label):
+    """Copia [a, end) por tramos de `step`, un COMMIT por tramo. Devuelve filas."""
+    copied = 0
+    while a < end:
+        b = min(a + step, end)
+        with conn.cursor() as cur:
+            cur.execute(sql, (a, b))
+            copied += cur.rowcount
+        conn.commit()
+        a = b
+        print(f"   {table}: {label} hasta {a:%Y-%m-%d %H:%M} UTC ({copied:,} filas)", end="\r", flush=True)
+    return copied
+
+def copy_online(conn, table, step):
+    """Copia por tramos de `step` hasta ahora, un COMMIT por tramo. Devuelve el
+    instante hasta el que copió."""
+    with conn.cursor() as cur:
+        sql = _copy_sql(cur, table)
+        cur.execute(f"SELECT max(ts_utc) FROM {table}_compact")
+        start = cur.fetchone()[0]
+        if start is not None:
+            start -= step              # el último tramo pudo quedar a medias
+        else:
+            cur.execute(f"SELECT min(ts_utc) FROM {table}")
+            start = cur.fetchone()[0]
+    conn.commit()
+    now = datetime.now(timezone.utc)
+    if start is None:
+        return now
+    t0 = time.perf_counter()
+    copied = _copy_range(conn, table, sql, start, now, step, "copiado")
+    print(f"\n   ✅ {table}: {copied:,} filas en {time.perf_counter() - t0:.0f}s")
+    return now
+
+def copy_late(conn, table, step, window):
+    """Segunda pasada en línea: recopia (ON CONFLICT DO NOTHING) desde `window`
+    antes del inicio de la primera copia. Recoge las filas que el recolector
+    insertó atrasadas en tramos ya copiados. Devuelve el instante en que empezó."""
+    with conn.cursor() as cur:
+        sql = _copy_sql(cur, table)
+        started = copy_started(cur, table)
+        if started is None:
+            # <tabla>_compact sin anotación: se recopia todo
+            cur.execute(f"SELECT min(ts_utc) FROM {table}")
+            started = cur.fetchone()[0]
+    conn.commit()
+    now = datetime.now(timezone.utc)
+    late = _copy_range(conn, table, sql, (started or now) - window, now, step, "filas atrasadas")
+    print(f"\n   ✅ {table}: {late:,} filas atrasadas recogidas en línea")
+    return now
+
+def swap(conn, since, late_until):
+    """Transacción corta: bloquea las escrituras, copia lo atrasado
+    ([since, late_until)) y lo nuevo (desde late_until) y renombra tablas,
+    índices y agregados."""
+    with conn.cursor() as cur:
+        tables = list(TABLES)
+        cur.execute(f"LOCK TABLE {', '.join(tables)} IN SHARE ROW EXCLUSIVE MODE")
+        for table in tables:
+            sql = _copy_sql(cur, table)
+            cur.execute(sql, (since, late_until))
+            late = cur.rowcount
+            cur.execute(sql, (late_until, datetime.now(timezone.utc) + timedelta(days=1)))
+            print(f"   {table}: {late} filas atrasadas recogidas y {cur.rowcount} nuevas durante la copia")
+
+        # Los agregados viejos quedan congelados con el histórico que ya no está en raw
+        for cagg, *_ in reversed(CAGGS):
+            if _exists(cur, cagg):
+                cur.execute("SELECT remove_continuous_aggregate_policy(%s, if_exists => TRUE)", (cagg,))
+                cur.execute(f"ALTER MATERIALIZED VIEW {cagg} RENAME TO {_split(cagg)[1]}_legacy")
+
+        for table in tables:
+            schema, name = _split(table)
+            index = TABLES[table]["index"]
+            cur.execute(f"ALTER TABLE {table} RENAME TO {name}_numeric")
+            cur.execute(f"ALTER INDEX IF EXISTS {schema}.{index} RENAME TO {index}_numeric")
+            cur.execute(f"ALTER INDEX IF EXISTS {schema}.{name}_pkey RENAME TO {name}_numeric_pkey")
+            cur.execute(f"ALTER TABLE {table}_compact RENAME TO {name}")
+            cur.execute(f"ALTER INDEX {schema}.{index}_compact RENAME TO {index}")
+            cur.execute(f"ALTER INDEX IF EXISTS {schema}.{name}_compact_pkey RENAME TO {name}_pkey")
+    conn.commit()
+
+def finish(conn):
+    """Políticas, agregados nuevos (con refresco de la ventana cruda) y compresión
+    de los chunks viejos. Corre en autocommit: refresh_continuous_aggregate no
+    acepta una transacción abierta."""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for table in TABLES:
+            cur.execute("SELECT add_compression_policy(%s, INTERVAL '7 days', if_not_exists => TRUE)", (table,))
+            cur.execute("SELECT add_retention_policy(%s, INTERVAL '180 days', if_not_exists => TRUE)", (table,))
+
+        cur.execute("SELECT min(ts_utc) FROM raw.fs_realtime_plants")
+        first = cur.fetchone()[0]
+        for cagg, ddl, start_offset, end_offset, every in CAGGS:
+            cur.execute(ddl)
+            cur.execute("""SELECT add_continuous_aggregate_policy(%s,
+                             start_offset => %s::interval, end_offset => %s::interval,
+                             schedule_interval => %s::interval, if_not_exists => TRUE)""",
+                        (cagg, start_offset, end_offset, every))
+            if first is not None:
+                print(f"   🔄 {cagg}: refrescando desde {first:%Y-%m-%d}…")
+                cur.execute("CALL refresh_continuous_aggregate(%s, %s, NULL)", (cagg, first))
+        cur.execute("ALTER MATERIALIZED VIEW agg.fs_plants_hourly SET (timescaledb.compress = true)")
+        cur.execute("SELECT add_compression_policy('agg.fs_plants_hourly', compress_after => INTERVAL '30 days', "
+                    "if_not_exists => TRUE)")
+
+        for table in TABLES:
+            cur.execute("""SELECT count(compress_chunk(c, if_not_compressed => TRUE))
+                           FROM show_chunks(%s, older_than => INTERVAL '7 days') AS c""", (table,))
+            print(f"   🗜️ {table}: {cur.fetchone()[0]} chunks comprimidos")
+
+def drop_old(conn):
+    """Borra los chunks de las tablas <tabla>_numeric. Los agregados *_legacy
+    conservan lo ya materializado (igual que con la retención)."""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for table in TABLES:
+            old = f"{table}_numeric"
+            if _exists(cur, old):
+                cur.execute("SELECT count(*) FROM drop_chunks(%s, older_than => now() + INTERVAL '1 day')", (old,))
+                print(f"   🧹 {old}: {cur.fetchone()[0]} chunks borrados")
+
+# ─────────────────────────────────────────────────────────
+# Script
+# ─────────────────────────────────────────────────────────
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migra raw.fs_realtime_plants y raw.fs_meter_realtime a columnas compactas")
+    parser.add_argument("--report-only", action="store_true", help="sólo el informe de tamaño y tiempos")
+    parser.add_argument("--step-hours", type=float, default=24.0, help="tramo de cada transacción de la copia")
+    parser.add_argument("--drop-old", action="store_true",
+                        help="al terminar, borrar los chunks de las tablas *_numeric")
+    parser.add_argument("--report-file", default=None, help="guardar el informe antes/después en JSON")
+    parser.add_argument("--spool-hours", type=float, default=None,
+                        help="antigüedad máxima del spool del recolector (por defecto se lee de SPOOL_FILE)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_dotenv(".env")
+    print(f"\n{'='*60}")
+    print("MIGRACIÓN A COLUMNAS COMPACTAS")
+    print(f"{'='*60}")
+    result = {}
+    try:
+        with closing(connect()) as conn:
+            with conn.cursor() as cur:
+                result["before"] = {t: measure(cur, t) for t in TABLES}
+            conn.commit()
+            print_report("Antes", result["before"])
+
+            with conn.cursor() as cur:
+                pending = [t for t in TABLES if not is_compact(cur, t)]
+            if args.report_only or not pending:
+                if not pending:
+                    print("\n✅ Las tablas ya tienen columnas compactas")
+                    if args.drop_old:
+                        drop_old(conn)
+                return
+
+            with conn.cursor() as cur:
+                cur.execute(NAMES_TO_DIM_SQL)
+                print(f"\n🗂️ {cur.rowcount} nombres de planta pasados a dim.fs_plants")
+                for table in TABLES:
+                    create_compact(cur, table)
+            conn.commit()
+
+            print("\n🚚 Copia en línea (el recolector sigue escribiendo en las tablas viejas)")
+            step = timedelta(hours=args.step_hours)
+            window = late_window(args.spool_hours)
+            for t in TABLES:
+                copy_online(conn, t, step)
+
+            # Lo que llegó atrasado (spool, huecos reparados) a tramos ya copiados
+            print("\n⏪ Filas atrasadas")
+            late_until = min(copy_late(conn, t, step, window) for t in TABLES)
+
+            print("\n🔀 Cambio de tablas")
+            swap(conn, late_until - window, late_until)
+            finish(conn)
+            if args.drop_old:
+                drop_old(conn)
+
+            with conn.cursor() as cur:
+                result["after"] = {t: measure(cur, t) for t in TABLES}
+            print_report("Después", result["after"])
+            print_comparison(result["before"], result["after"])
+    except Exception as e:
+        print(f"❌ Error Crítico: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        if args.report_file and result:
+            with open(args.report_file, "w") as f:
+                json.dump(result, f, indent=2)
+            print(f"\n📝 Informe guardado en {args.report_file}")
+
+    print(f"\n{'='*60}")
+    print("✅ Migración completada")
+    print(f"{'='*60}\n")
+
+if __name__ == "__main__":
+    main()
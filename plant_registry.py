@@ -0,0 +1,166 @@
+import os
+import time
+import threading
+from collections import namedtuple
+import psycopg2
+import psycopg2.extras
+
+# ─────────────────────────────────────────────────────────
+# Registro de plantas (dim.fs_plants)
+# ─────────────────────────────────────────────────────────
+# Única fuente de códigos NE, plant_id, kWp, topes y coordenadas para el
+# recolector, la consolidación y la sincronización oficial. Se cachea en memoria
+# (búsquedas O(1) por código o id) y se relee cada PLANT_REGISTRY_TTL_SECONDS;
+# si la base no responde se sigue con la última copia. Las plantas nuevas que
+# aparecen en la lista de plantas de la API se insertan solas.
+
+Plant = namedtuple("Plant", "plant_code plant_id plant_name capacity_kw max_daily_kwh latitude longitude active")
+
+SELECT_PLANTS_SQL = """
+    SELECT plant_code, plant_id, plant_name, capacity_kw, max_daily_kwh,
+           latitude, longitude, active
+    FROM dim.fs_plants
+    WHERE plant_id IS NOT NULL
+"""
+
+# Lo cargado a mano manda: la API sólo completa columnas vacías
+UPSERT_PLANTS_SQL = """
+    INSERT INTO dim.fs_plants AS p (plant_code, plant_name, capacity_kw, latitude, longitude)
+    VALUES %s
+    ON CONFLICT (plant_code) DO UPDATE SET
+      plant_name  = COALESCE(p.plant_name,  EXCLUDED.plant_name),
+      capacity_kw = COALESCE(p.capacity_kw, EXCLUDED.capacity_kw),
+      latitude    = COALESCE(p.latitude,    EXCLUDED.latitude),
+      longitude   = COALESCE(p.longitude,   EXCLUDED.longitude),
+      updated_utc = now()
+    WHERE (p.plant_name  IS NULL AND EXCLUDED.plant_name  IS NOT NULL)
+       OR (p.capacity_kw IS NULL AND EXCLUDED.capacity_kw IS NOT NULL)
+       OR (p.latitude    IS NULL AND EXCLUDED.latitude    IS NOT NULL)
+       OR (p.longitude   IS NULL AND EXCLUDED.longitude   IS NOT NULL)
+    RETURNING plant_code, (xmax = 0) AS inserted
+"""
+
+def _float(v):
+    try:
+        return float(v) if v not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+def plant_from_api(item):
+    """(código, nombre, kWp, lat, lon) de un item de la lista de plantas.
+    `stations` trae plantCode/plantName/capacity en kWp y coordenadas;
+    el getStationList antiguo trae stationCode/stationName/capacity en MW."""
+    if item.get("plantCode"):
+        return (item["plantCode"], item.get("plantName"), _float(item.get("capacity")),
+                _float(item.get("latitude")), _float(item.get("longitude")))
+    if item.get("stationCode"):
+        mw = _float(item.get("capacity"))
+        return (item["stationCode"], item.get("stationName"),
+                mw * 1000.0 if mw is not None else None, None, None)
+    return None
+
+class PlantRegistry:
+    """`connect()` debe devolver un context manager que entregue una conexión
+    (p. ej. db_writer.pooled_conn). Los métodos que aceptan `cur` usan ese
+    cursor en lugar de abrir conexión propia."""
+
+    def __init__(self, connect, ttl_seconds=None):
+        self.connect = connect
+        self.ttl = ttl_seconds if ttl_seconds is not None else float(os.getenv("PLANT_REGISTRY_TTL_SECONDS", "600"))
+        self.lock = threading.Lock()
+        self.by_code = {}
+        self.by_id = {}
+        self.loaded_at = 0.0
+
+    # ── Carga ─────────────────────────────────────────────
+    def _load(self, cur):
+        cur.execute(SELECT_PLANTS_SQL)
+        plants = [Plant(code, pid, name,
+                        float(cap) if cap is not None else None,
+                        float(mx) if mx is not None else None,
+                        lat, lon, active)
+                  for code, pid, name, cap, mx, lat, lon, active in cur.fetchall()]
+        with self.lock:
+            self.by_code = {p.plant_code: p for p in plants}
+            self.by_id = {p.plant_id: p for p in plants}
+            self.loaded_at = time.time()
+        return len(plants)
+
+    def refresh(self, cur=None, force=False):
+        """Relee dim.fs_plants si venció el TTL (o si `force`). Devuelve True si
+        hay registro utilizable."""
+        if not force and self.loaded_at and time.time() - self.loaded_at < self.ttl:
+            return True
+        try:
+            if cur is not None:
+                self._load(cur)
+            else:
+                with self.connect() as conn:
+                    with conn.cursor() as c:
+                        self._load(c)
+        except psycopg2.Error as e:
+            if cur is not None:
+                raise
+            print(f"⚠️ Registro de plantas: no se pudo leer dim.fs_plants ({e}); se usa la copia en memoria")
+            with self.lock:
+                self.loaded_at = time.time()   # no reintentar en cada llamada
+            return bool(self.by_code)
+        return True
+
+    # ── Consultas (en memoria) ────────────────────────────
+    def get(self, code):
+        return self.by_code.get(code)
+
+    def get_id(self, plant_id):
+        return self.by_id.get(plant_id)
+
+    def plants(self, active_only=True):
+        return sorted((p for p in self.by_code.values() if p.active or not active_only),
+                      key=lambda p: p.plant_id)
+
+    def codes(self, active_only=True):
+        return [p.plant_code for p in self.plants(active_only)]
+
+    def is_active(self, code):
+        """Las plantas que el registro no conoce se consideran activas."""
+        p = self.by_code.get(code)
+        return p is None or p.active
+
+    def coords(self, code):
+        p = self.by_code.get(code)
+        if p is None or p.latitude is None or p.longitude is None:
+            return None
+        return p.latitude, p.longitude
+
+    def plant_map(self, active_only=False):
+        """{código NE: plant_id}"""
+        return {p.plant_code: p.plant_id for p in self.plants(active_only)}
+
+    def kwp_map(self, active_only=False):
+        """{plant_id: kWp}"""
+        return {p.plant_id: p.capacity_kw for p in self.plants(active_only) if p.capacity_kw}
+
+    # ── Alta desde la API ─────────────────────────────────
+    def record_api_stations(self, items):
+        """Inserta/completa en dim.fs_plants las plantas de una respuesta de lista
+        de plantas y recarga el registro. Devuelve los códigos recibidos."""
+        rows = {}
+        for item in items or []:
+            plant = plant_from_api(item) if isinstance(item, dict) else None
+            if plant:
+                rows[plant[0]] = plant
+        if not rows:
+            return []
+        try:
+            with self.connect() as conn:
+                with conn.cursor() as cur:
+                    result = psycopg2.extras.execute_values(
+                        cur, UPSERT_PLANTS_SQL, list(rows.values()), fetch=True)
+                    conn.commit()
+                    for code, inserted in result:
+                        if inserted:
+                            print(f"🆕 Planta nueva en dim.fs_plants: {code} ({rows[code][1]})")
+                    self._load(cur)
+        except psycopg2.Error as e:
+            print(f"⚠️ Registro de plantas: no se pudo actualizar dim.fs_plants ({e})")
+        return list(rows)
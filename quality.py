@@ -0,0 +1,140 @@
+import os
+from collections import namedtuple
+from datetime import timedelta
+import numpy as np
+
+# ─────────────────────────────────────────────────────────
+# Calidad de datos crudos (vectorizado con NumPy)
+# ─────────────────────────────────────────────────────────
+# Carga raw.fs_realtime_plants de todo un rango y todas las plantas como arrays
+# planos (una fila por planta con array_agg) y en una sola pasada:
+#   - picos: total_power_kwh salta más de lo físicamente posible y vuelve
+#   - reinicios del contador: el acumulado cae a menos de la mitad
+#   - no monótono: pequeñas bajadas del acumulado (se toma el máximo corrido)
+#   - huecos: intervalos con producción más largos que QUALITY_GAP_SECONDS
+# La energía del día es la suma de incrementos válidos del contador; donde el
+# contador no sirve (pico, reinicio, sin dato, salto imposible) se usa la
+# integral trapezoidal de power_kw, que interpola linealmente sobre el hueco.
+
+GAP_SECONDS         = float(os.getenv("QUALITY_GAP_SECONDS", "1200"))
+SPIKE_FACTOR        = float(os.getenv("QUALITY_SPIKE_FACTOR", "1.5"))    # × kWp × horas del intervalo
+SPIKE_TOLERANCE_KWH = float(os.getenv("QUALITY_SPIKE_TOLERANCE_KWH", "1.0"))
+RESET_RATIO         = 0.5      # el acumulado cae por debajo de esta fracción del anterior
+PRODUCING_KW        = 0.05     # umbral de "hay producción" en power_kw
+
+DayQuality = namedtuple("DayQuality", "energy_kwh counter_kwh power_kwh score gaps spikes resets dips")
+
+# Un día antes del rango para tener el último acumulado de la noche anterior;
+# day_idx = -1 marca esas muestras (sólo dan contexto)
+SAMPLES_SQL = """
+    SELECT plant_code,
+           array_agg(EXTRACT(EPOCH FROM ts_utc)::float8 ORDER BY ts_utc),
+           array_agg(((ts_utc AT TIME ZONE 'America/Bogota')::date - %(first)s) ORDER BY ts_utc),
+           array_agg(COALESCE(power_kw, 0)::float8 ORDER BY ts_utc),
+           array_agg(total_power_kwh::float8 ORDER BY ts_utc)
+    FROM raw.fs_realtime_plants
+    WHERE ts_utc >= %(start)s AND ts_utc < %(end)s
+      AND plant_code = ANY(%(codes)s)
+    GROUP BY plant_code
+"""
+
+def load_samples(cursor, codes, first_day, start, end):
+    """{código: (ts, day_idx, power_kw, total_kwh)} como arrays float64/int."""
+    cursor.execute(SAMPLES_SQL, {"first": first_day, "start": start, "end": end, "codes": list(codes)})
+    out = {}
+    for code, ts, day, power, total in cursor.fetchall():
+        out[code] = (np.asarray(ts, dtype=float), np.asarray(day, dtype=np.int64),
+                     np.asarray(power, dtype=float), np.asarray(total, dtype=float))
+    return out
+
+def _ffill(x, starts):
+    """Rellena NaN con el último valor válido, sin cruzar el inicio de cada planta."""
+    idx = np.where(~np.isnan(x) | starts, np.arange(len(x)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return x[idx]
+
+def assess(samples, kwp, first_day, n_days):
+    """Calidad y energía por planta-día. `samples` como load_samples, `kwp`
+    {código: kWp}. Devuelve {(código, fecha): DayQuality}."""
+    codes = [c for c in samples if len(samples[c][0]) > 1]
+    if not codes:
+        return {}
+    ts = np.concatenate([samples[c][0] for c in codes])
+    day = np.concatenate([samples[c][1] for c in codes])
+    p = np.concatenate([samples[c][2] for c in codes])
+    tot = np.concatenate([samples[c][3] for c in codes])
+    plant = np.concatenate([np.full(len(samples[c][0]), i) for i, c in enumerate(codes)])
+    cap_kw = np.array([kwp.get(c) or np.inf for c in codes])[plant]
+
+    starts = np.r_[True, plant[1:] != plant[:-1]]
+    same = ~starts[1:]                       # intervalo i → i+1 dentro de la misma planta
+    dth = np.diff(ts) / 3600.0
+    max_step = cap_kw[1:] * dth * SPIKE_FACTOR + SPIKE_TOLERANCE_KWH
+
+    # 1) Picos aislados: sube más de lo posible y el siguiente vuelve a bajar
+    step_in = np.r_[np.nan, np.diff(tot)]
+    step_out = np.r_[np.diff(tot), np.nan]
+    jump_in = np.r_[False, same] & (step_in > np.r_[np.inf, max_step])
+    drop_out = np.r_[same, False] & (step_out < -SPIKE_TOLERANCE_KWH)
+    spike = jump_in & drop_out
+    clean = np.where(spike, np.nan, tot)
+    filled = _ffill(clean, starts)
+
+    # 2) Reinicios del contador: cortan segmentos
+    prev = np.r_[np.nan, filled[:-1]]
+    reset = np.r_[False, same] & (filled < RESET_RATIO * prev)
+    seg = np.cumsum(starts | reset)
+
+    # 3) Máximo corrido por segmento (las bajadas no restan energía); el offset
+    #    por segmento evita un bucle en Python
+    big = np.nanmax(np.abs(filled)) + 1.0 if np.isfinite(filled).any() else 1.0
+    mono = np.fmax.accumulate(filled + seg * big) - seg * big
+    mono[np.isnan(filled)] = np.nan      # sin acumulado previo en la planta
+    dips = np.r_[False, same] & ~reset & (filled < np.r_[np.nan, mono[:-1]] - SPIKE_TOLERANCE_KWH)
+
+    # 4) Energía por intervalo: contador si es válido, integral de potencia si no
+    d_counter = np.diff(mono)
+    e_power = (p[:-1] + p[1:]) / 2.0 * dth
+    bad = (np.isnan(d_counter) | reset[1:] | (d_counter > max_step) | (d_counter < 0)
+           | spike[1:] | spike[:-1])
+    energy = np.where(bad, e_power, d_counter)
+    producing = (p[:-1] > PRODUCING_KW) | (p[1:] > PRODUCING_KW)
+    gap = producing & (dth * 3600.0 > GAP_SECONDS)
+
+    # 5) Agregado por planta-día (el intervalo cuenta para el día de su muestra final)
+    m = same & (day[1:] >= 0) & (day[1:] < n_days)
+    key = plant[1:][m] * n_days + day[1:][m]
+    size = len(codes) * n_days
+    def total(w):
+        return np.bincount(key, weights=w[m].astype(float), minlength=size)
+    e_total = total(energy)
+    e_counter = total(np.where(bad, 0.0, d_counter))
+    e_pow = total(e_power)
+    span = total(np.where(producing, dth, 0.0))
+    gap_h = total(np.where(gap, dth, 0.0))
+    n_prod = total(producing)
+    n_bad = total(producing & bad)
+    counts = {name: total(arr) for name, arr in
+              (("gaps", gap), ("spikes", spike[1:]), ("resets", reset[1:]), ("dips", dips[1:]))}
+    present = np.bincount(key, minlength=size) > 0
+
+    # Puntaje 0..1: cobertura de las horas con producción × fracción de
+    # intervalos con contador válido
+    with np.errstate(invalid="ignore", divide="ignore"):
+        coverage = np.where(span > 0, 1.0 - gap_h / span, 1.0)
+        valid = np.where(n_prod > 0, 1.0 - n_bad / n_prod, 1.0)
+    score = np.clip(coverage * valid, 0.0, 1.0)
+
+    out = {}
+    for k in np.flatnonzero(present):
+        i, d = divmod(int(k), n_days)
+        out[(codes[i], first_day + timedelta(days=d))] = DayQuality(
+            round(float(e_total[k]), 3), round(float(e_counter[k]), 3), round(float(e_pow[k]), 3),
+            round(float(score[k]), 3), *(int(counts[c][k]) for c in ("gaps", "spikes", "resets", "dips")))
+    return out
+
+def assess_range(cursor, codes, kwp, first_day, last_day, start, end):
+    """load_samples + assess para [first_day, last_day]; `start`/`end` es el rango
+    UTC (debe empezar un día antes de first_day para tener contexto)."""
+    samples = load_samples(cursor, codes, first_day, start, end)
+    return assess(samples, kwp, first_day, (last_day - first_day).days + 1)
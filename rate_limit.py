@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+# ─────────────────────────────────────────────────────────
+# Scheduler adaptativo (token bucket por endpoint)
+# ─────────────────────────────────────────────────────────
+# Cada endpoint tiene su propio ritmo en llamadas/hora. Tras RATE_PROBE_AFTER
+# éxitos seguidos se prueba un ritmo un poco mayor; un 407
+# (ACCESS_FREQUENCY_IS_TOO_HIGH) recorta el ritmo a la mitad, recuerda ese techo
+# y abre un backoff exponencial con jitter. El estado se guarda en disco para no
+# volver a quemar la cuota tras un reinicio.
+#
+# `set_boost` multiplica temporalmente el ritmo de un endpoint (p. ej. de día,
+# cuando la cuota que no se usa de noche se reparte en las horas de sol). El
+# factor no se persiste y un 407 lo sigue recortando igual que al ritmo base.
+#
+# `stop` despierta a quien esté esperando turno en `acquire` (que entonces lanza
+# SchedulerStopped); así un apagado no queda colgado detrás de un backoff.
+#
+# Con `ledger` (coordination.RateLedger) el estado no vive en un archivo local
+# sino en Postgres: cada operación que toma un turno o ajusta el ritmo
+# (try_acquire, acquire, on_success, on_throttle) bloquea la fila del endpoint,
+# parte del estado guardado por cualquier réplica y lo vuelve a guardar, así
+# varias réplicas con la misma cuenta comparten un solo ritmo y un solo backoff.
+# Las consultas (seconds_until, rate, snapshot) sólo leen la copia local, que
+# refresh() relee sin bloquear filas; in_backoff() la relee antes de decidir.
+
+class SchedulerStopped(Exception):
+    pass
+
+def _env_float(name, default):
+    return float(os.getenv(name, str(default)))
+
+class _Bucket:
+    def __init__(self, rate_per_hour):
+        self.rate_per_hour = rate_per_hour
+        self.tokens = 1.0
+        self.last_refill = time.time()
+        self.ceiling = None          # ritmo al que llegó el último 407
+        self.streak = 0              # éxitos seguidos desde el último ajuste
+        self.successes = 0
+        self.throttles = 0
+        self.backoff_level = 0
+        self.backoff_until = 0.0
+        self.last_call = 0.0
+        self.recent = deque()        # marcas de tiempo de la última hora
+        self.boost = 1.0             # multiplicador temporal (no se persiste)
+
+    @property
+    def current_per_hour(self):
+        return self.rate_per_hour * self.boost
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(1.0, self.tokens + elapsed * self.current_per_hour / 3600.0)
+        self.last_refill = now
+
+    def to_json(self):
+        return {
+            "rate_per_hour": self.rate_per_hour,
+            "tokens": self.tokens,
+            "last_refill": self.last_refill,
+            "ceiling": self.ceiling,
+            "backoff_level": self.backoff_level,
+            "backoff_until": self.backoff_until,
+            "last_call": self.last_call,
+        }
+
+    def update(self, d):
+        """Toma el estado persistido `d`; boost, racha y contadores son locales."""
+        self.rate_per_hour = float(d["rate_per_hour"])
+        self.tokens = float(d.get("tokens", 0.0))
+        self.last_refill = float(d.get("last_refill", time.time()))
+        self.ceiling = d.get("ceiling")
+        self.backoff_level = int(d.get("backoff_level", 0))
+        self.backoff_until = float(d.get("backoff_until", 0.0))
+        self.last_call = float(d.get("last_call", 0.0))
+
+    @classmethod
+    def from_json(cls, d):
+        b = cls(float(d["rate_per_hour"]))
+        b.update(d)
+        return b
+
+class RateScheduler:
+    def __init__(self, state_file=None, initial_per_hour=None, ledger=None):
+        self.state_file = Path(state_file) if state_file else None
+        self.ledger = ledger
+        self.initial_per_hour = initial_per_hour or 3600.0 / _env_float("PER_PLANT_DELAY_SECONDS", 180)
+        self.min_per_hour = _env_float("RATE_MIN_PER_HOUR", 4)
+        self.max_per_hour = _env_float("RATE_MAX_PER_HOUR", 120)
+        self.probe_after = int(os.getenv("RATE_PROBE_AFTER", "10"))
+        self.probe_step = _env_float("RATE_PROBE_STEP", 0.10)
+        self.decrease = _env_float("RATE_DECREASE", 0.5)
+        self.backoff_base = _env_float("BACKOFF_SECONDS", 480)
+        self.backoff_max = _env_float("BACKOFF_MAX_SECONDS", 3600)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.fresh = True
+        self.stopped = threading.Event()
+        self._load()
+
+    # ── Persistencia ──────────────────────────────────────
+    def _load(self):
+        if self.ledger is not None:
+            data = self.ledger.load() or {}
+            self.buckets = {ep: _Bucket.from_json(d) for ep, d in data.items()}
+            self.fresh = not self.buckets
+            return
+        if not self.state_file or not self.state_file.exists():
+            return
+        try:
+            data = json.loads(self.state_file.read_text())
+            self.buckets = {ep: _Bucket.from_json(d) for ep, d in data.items()}
+            self.fresh = False
+        except Exception as e:
+            print(f"⚠️ Estado de rate-limit ilegible ({e}); se empieza de cero")
+
+    def _save(self):
+        if not self.state_file or self.ledger is not None:
+            return
+        try:
+            tmp = self.state_file.with_suffix(".tmp")
+            tmp.write_text(json.dumps({ep: b.to_json() for ep, b in self.buckets.items()}))
+            tmp.replace(self.state_file)
+        except Exception:
+            pass
+
+    def _bucket(self, endpoint):
+        b = self.buckets.get(endpoint)
+        if b is None:
+            b = self.buckets[endpoint] = _Bucket(self.initial_per_hour)
+        return b
+
+    @contextmanager
+    def _synced(self, endpoint):
+        """Bucket de `endpoint` bajo self.lock y, con ledger, bajo el bloqueo de su
+        fila: se recarga antes del bloque y se guarda después. La ida y vuelta a
+        la base pasa fuera de self.lock: las consultas locales no la esperan."""
+        if self.ledger is None:
+            with self.lock:
+                yield self._bucket(endpoint)
+            return
+        with self.ledger.locked(endpoint) as row:
+            with self.lock:
+                b = self._bucket(endpoint)
+                if row.state:
+                    b.update(row.state)
+                yield b
+                row.state = b.to_json()
+
+    def refresh(self):
+        """Con ledger: relee el estado que guardaron todas las réplicas (sin
+        bloquear filas). Si la base no responde queda la copia local."""
+        if self.ledger is None:
+            return
+        data = self.ledger.load()
+        if data is None:
+            return
+        with self.lock:
+            for ep, d in data.items():
+                self._bucket(ep).update(d)
+
+    # ── Adquisición de turnos ─────────────────────────────
+    def _wait_needed(self, b, now):
+        b.refill(now)
+        if now < b.backoff_until:
+            return b.backoff_until - now
+        if b.tokens >= 1.0 - 1e-6:
+            return 0.0
+        return (1.0 - b.tokens) * 3600.0 / b.current_per_hour
+
+    def _consume(self, b, now):
+        b.tokens = max(0.0, b.tokens - 1.0)
+        b.last_call = now
+        b.recent.append(now)
+        self._save()
+
+    def try_acquire(self, endpoint):
+        """Toma un turno sólo si está disponible ya (no bloquea)."""
+        with self._synced(endpoint) as b:
+            now = time.time()
+            if self._wait_needed(b, now) > 0:
+                return False
+            self._consume(b, now)
+            return True
+
+    def acquire(self, endpoint):
+        """Bloquea hasta que haya turno para `endpoint`. Devuelve los segundos esperados."""
+        waited = 0.0
+        while True:
+            with self._synced(endpoint) as b:
+                now = time.time()
+                wait = self._wait_needed(b, now)
+                if wait <= 0:
+                    self._consume(b, now)
+                    return waited
+                reason = "backoff" if now < b.backoff_until else f"{b.current_per_hour:.1f} llamadas/h"
+            if wait > 5:
+                print(f"RATE: {endpoint} esperando {wait:.1f}s ({reason})…", flush=True)
+            if self.stopped.wait(wait):
+                raise SchedulerStopped(endpoint)
+            waited += wait
+
+    def stop(self):
+        self.stopped.set()
+
+    def in_backoff(self):
+        """True si algún endpoint de la cuenta está en backoff por un 407 (con
+        ledger, también uno que abrió otra réplica)."""
+        self.refresh()
+        now = time.time()
+        with self.lock:
+            return any(b.backoff_until > now for b in self.buckets.values())
+
+    def seconds_until(self, endpoint):
+        """Espera estimada con la copia local (sin ir a la base); el turno real
+        lo decide try_acquire/acquire."""
+        with self.lock:
+            return self._wait_needed(self._bucket(endpoint), time.time())
+
+    def rate(self, endpoint):
+        """Ritmo base aprendido para `endpoint` (llamadas/hora, sin boost)."""
+        with self.lock:
+            return self._bucket(endpoint).rate_per_hour
+
+    def set_boost(self, endpoint, factor):
+        with self.lock:
+            b = self._bucket(endpoint)
+            b.refill(time.time())   # lo acumulado hasta ahora se cuenta al ritmo anterior
+            b.boost = max(0.01, float(factor))
+
+    # ── Retroalimentación ─────────────────────────────────
+    def on_success(self, endpoint):
+        with self._synced(endpoint) as b:
+            b.successes += 1
+            b.streak += 1
+            b.backoff_level = 0
+            # Cerca del techo conocido se sondea mucho más despacio
+            needed = self.probe_after
+            if b.ceiling and b.rate_per_hour >= 0.9 * b.ceiling:
+                needed *= 5
+            if b.streak >= needed:
+                b.streak = 0
+                new_rate = min(self.max_per_hour, b.rate_per_hour * (1.0 + self.probe_step))
+                if b.ceiling and b.rate_per_hour < 0.9 * b.ceiling:
+                    new_rate = min(new_rate, 0.9 * b.ceiling)
+                if new_rate > b.rate_per_hour:
+                    print(f"RATE: {endpoint} sube a {new_rate:.1f} llamadas/h")
+                b.rate_per_hour = new_rate
+            self._save()
+
+    def on_throttle(self, endpoint):
+        """Un 407: recorta el ritmo y abre un backoff exponencial con jitter."""
+        with self._synced(endpoint) as b:
+            b.throttles += 1
+            b.streak = 0
+            b.ceiling = b.rate_per_hour
+            b.rate_per_hour = max(self.min_per_hour, b.rate_per_hour * self.decrease)
+            backoff = min(self.backoff_max, self.backoff_base * (2 ** b.backoff_level))
+            backoff *= random.uniform(0.8, 1.2)
+            b.backoff_level += 1
+            b.backoff_until = time.time() + backoff
+            b.tokens = 0.0
+            self._save()
+            print(f"⏳ RATE: {endpoint} 407 → ritmo {b.rate_per_hour:.1f} llamadas/h, backoff {backoff:.0f}s")
+            return backoff
+
+    # ── Observabilidad ────────────────────────────────────
+    def snapshot(self):
+        now = time.time()
+        out = {}
+        with self.lock:
+            for ep, b in self.buckets.items():
+                while b.recent and now - b.recent[0] > 3600:
+                    b.recent.popleft()
+                out[ep] = {
+                    "rate_per_hour": round(b.rate_per_hour, 2),
+                    "boost": round(b.boost, 2),
+                    "effective_per_hour": len(b.recent),
+                    "ceiling_per_hour": round(b.ceiling, 2) if b.ceiling else None,
+                    "successes": b.successes,
+                    "throttles": b.throttles,
+                    "backoff_remaining_s": round(max(0.0, b.backoff_until - now), 1),
+                }
+        return out
@@ -0,0 +1,302 @@
+import os
+import json
+import select
+import signal
+import threading
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+from db_writer import _conn_params, notify_channel
+
+# ─────────────────────────────────────────────────────────
+# API de lectura del estado actual (sin consultas por visitante)
+# ─────────────────────────────────────────────────────────
+# Mantiene en memoria raw.fs_plants_last y, por planta, las últimas
+# READ_RING_SAMPLES potencias. Al arrancar (y al reconectar) las lee una vez de
+# Postgres; después sólo escucha el pg_notify que db_writer.write_rows manda en
+# la misma transacción que el UPSERT. Los paneles leen de memoria:
+#
+#   GET /plants          todas las plantas ({"version", "plants"}), con ETag
+#   GET /plants/NE=123   una planta + "recent": [[ts_utc, power_kw], ...]
+#   GET /stream          Server-Sent Events: "snapshot" al conectar y "update"
+#                        con las plantas que cambiaron
+#   GET /healthz         503 si no hay conexión LISTEN
+#
+# Cientos de visitantes no agregan ninguna consulta: el JSON de /plants se arma
+# una vez por versión y cada "update" se codifica una vez para todos.
+
+FIELDS = ("plant_code", "updated_utc", "plant_name", "power_kw", "day_power_kwh",
+          "month_power_kwh", "total_power_kwh", "health")
+
+SNAPSHOT_SQL = f"SELECT {', '.join(FIELDS)} FROM raw.fs_plants_last"
+
+RECENT_SQL = """
+    SELECT plant_code, ts_utc, power_kw
+    FROM raw.fs_realtime_plants
+    WHERE ts_utc > now() - make_interval(secs => %s) AND power_kw IS NOT NULL
+    ORDER BY plant_code, ts_utc
+"""
+
+def _iso(v):
+    return v.isoformat() if isinstance(v, datetime) else v
+
+def _num(v):
+    return float(v) if v is not None and not isinstance(v, str) else v
+
+def plant_from_row(row):
+    """Fila (en el orden de FIELDS, de la base o del payload JSON) → dict."""
+    p = dict(zip(FIELDS, row))
+    p["updated_utc"] = _iso(p["updated_utc"])
+    for k in ("power_kw", "day_power_kwh", "month_power_kwh", "total_power_kwh"):
+        p[k] = _num(p[k])
+    p["health"] = int(p["health"]) if p["health"] not in (None, "") else None
+    return p
+
+def _ts(p):
+    return datetime.fromisoformat(p["updated_utc"])
+
+class LatestCache:
+    """Snapshot de fs_plants_last + anillo de potencias por planta. Cada cambio sube
+    `version` y despierta a los clientes de /stream."""
+
+    def __init__(self, ring_samples=None, max_events=None):
+        self.ring_samples = ring_samples or int(os.getenv("READ_RING_SAMPLES", "240"))
+        self.plants = {}            # plant_code → dict
+        self.recent = {}            # plant_code → deque([(ts_utc, power_kw), ...]) con datetime
+        self.version = 0
+        self.events = deque(maxlen=max_events or int(os.getenv("READ_MAX_EVENTS", "1000")))
+        self.cond = threading.Condition()
+        self._body = (None, b"")    # (versión, JSON de /plants)
+
+    def _ring(self, code):
+        r = self.recent.get(code)
+        if r is None:
+            r = self.recent[code] = deque(maxlen=self.ring_samples)
+        return r
+
+    def load(self, rows, recent_rows):
+        """Reemplaza todo (arranque o reconexión) con lo leído de la base."""
+        with self.cond:
+            self.plants = {r[0]: plant_from_row(r) for r in rows}
+            self.recent = {}
+            for code, ts, kw in recent_rows:
+                self._ring(code).append((ts, _num(kw)))
+            self.version += 1
+            self.events.clear()     # los clientes de /stream reciben un snapshot nuevo
+            self.cond.notify_all()
+
+    def apply(self, rows):
+        """Filas de un pg_notify. Como el UPSERT, sólo cuenta una fila más nueva que
+        la guardada. Devuelve cuántas plantas cambiaron."""
+        changed = []
+        with self.cond:
+            for row in rows:
+                p = plant_from_row(row)
+                prev = self.plants.get(p["plant_code"])
+                if prev is not None and _ts(prev) > _ts(p):
+                    continue
+                self.plants[p["plant_code"]] = p
+                ring, ts = self._ring(p["plant_code"]), _ts(p)
+                if p["power_kw"] is not None and (not ring or ring[-1][0] < ts):
+                    ring.append((ts, p["power_kw"]))
+                changed.append(p)
+            if changed:
+                self.version += 1
+                self.events.append((self.version, _sse("update", changed)))
+                self.cond.notify_all()
+        return len(changed)
+
+    def body(self):
+        """(versión, JSON de /plants), armado una sola vez por versión."""
+        with self.cond:
+            version, body = self._body
+            if version != self.version:
+                plants = sorted(self.plants.values(), key=lambda p: p["plant_code"])
+                body = json.dumps({"version": self.version, "plants": plants}, ensure_ascii=False).encode()
+                self._body = (self.version, body)
+            return self._body
+
+    def plant(self, code):
+        with self.cond:
+            p = self.plants.get(code)
+            if p is None:
+                return None
+            return dict(p, recent=[[_iso(ts), kw] for ts, kw in self.recent.get(code, ())])
+
+    def wait_events(self, since, timeout):
+        """Eventos SSE posteriores a `since` (espera hasta `timeout` s). Si el
+        cliente quedó fuera de la cola devuelve None: hay que mandarle un snapshot."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.version > since, timeout=timeout)
+            if self.version == since:
+                return since, []
+            if not self.events or self.events[0][0] > since + 1:
+                return self.version, None
+            return self.version, [e for v, e in self.events if v > since]
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+# ─────────────────────────────────────────────────────────
+# LISTEN (hilo propio, con reconexión)
+# ─────────────────────────────────────────────────────────
+class Listener:
+    def __init__(self, cache, channel=None, recent_minutes=None):
+        self.cache = cache
+        self.channel = channel or notify_channel()
+        self.recent_minutes = recent_minutes if recent_minutes is not None else float(os.getenv("READ_RECENT_MINUTES", "240"))
+        self.connected = False
+        self.stopped = threading.Event()
+        self.notifies = 0
+
+    def _prime(self, conn):
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            # LISTEN antes de leer: lo que se escriba mientras tanto llega como aviso
+            cur.execute(f'LISTEN "{self.channel}"')
+            cur.execute(SNAPSHOT_SQL)
+            rows = cur.fetchall()
+            cur.execute(RECENT_SQL, (self.recent_minutes * 60.0,))
+            recent = cur.fetchall()
+        self.cache.load(rows, recent)
+        print(f"👂 LISTEN {self.channel}: {len(rows)} plantas en memoria")
+
+    def run(self):
+        delay = 1.0
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**_conn_params())
+                self._prime(conn)
+                self.connected, delay = True, 1.0
+                while not self.stopped.is_set():
+                    if select.select([conn], [], [], 5.0)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self._handle(conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                print(f"⚠️ LISTEN {self.channel}: {e}; reintento en {delay:.0f}s")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    conn.close()
+            self.stopped.wait(delay)
+            delay = min(60.0, delay * 2)
+
+    def _handle(self, payload):
+        try:
+            rows = json.loads(payload)
+        except ValueError:
+            print(f"⚠️ Aviso ilegible en {self.channel}: {payload[:80]!r}")
+            return
+        self.notifies += 1
+        self.cache.apply(rows)
+
+    def start(self):
+        threading.Thread(target=self.run, name="listen", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+# ─────────────────────────────────────────────────────────
+# Servidor HTTP
+# ─────────────────────────────────────────────────────────
+def make_server(port, cache, listener, keepalive_seconds=None):
+    keepalive = keepalive_seconds or float(os.getenv("READ_SSE_KEEPALIVE_SECONDS", "15"))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, ctype="application/json; charset=utf-8", headers=()):
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            for k, v in headers:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = unquote(self.path.split("?", 1)[0]).rstrip("/")
+            if path == "/plants":
+                version, body = cache.body()
+                etag = f'"{version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self._send(200, body, headers=[("ETag", etag), ("Cache-Control", "no-cache")])
+            elif path.startswith("/plants/"):
+                p = cache.plant(path[len("/plants/"):])
+                if p is None:
+                    self._send(404, b'{"error": "planta desconocida"}')
+                else:
+                    self._send(200, json.dumps(p, ensure_ascii=False).encode())
+            elif path == "/stream":
+                self._stream()
+            elif path == "/healthz":
+                ok = listener.connected
+                self._send(200 if ok else 503, b"ok\n" if ok else b"sin LISTEN\n", "text/plain; charset=utf-8")
+            else:
+                self._send(404, b"not found\n", "text/plain")
+
+        def _stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            version, events = 0, None
+            try:
+                while not listener.stopped.is_set():
+                    if events is None:
+                        version, body = cache.body()
+                        self.wfile.write(b"event: snapshot\ndata: " + body + b"\n\n")
+                    elif events:
+                        self.wfile.write(b"".join(events))
+                    else:
+                        self.wfile.write(b": ping\n\n")
+                    self.wfile.flush()
+                    version, events = cache.wait_events(version, keepalive)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("0.0.0.0", port), Handler)
+
+def main():
+    load_dotenv(".env")
+    port = int(os.getenv("READ_API_PORT", "8110"))
+    cache = LatestCache()
+    listener = Listener(cache).start()
+    server = make_server(port, cache, listener)
+
+    def shutdown(*_):
+        listener.stop()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    print(f"📡 API de lectura en http://0.0.0.0:{port}/plants (SSE en /stream)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
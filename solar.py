@@ -0,0 +1,68 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+# ─────────────────────────────────────────────────────────
+# Posición solar (algoritmo de la NOAA, sin red)
+# ─────────────────────────────────────────────────────────
+# Precisión de ~1-2 minutos en latitudes bajas, suficiente para decidir cuándo
+# vale la pena consultar la API.
+
+ZENITH_DEG = 90.833   # refracción atmosférica + radio del disco solar
+
+def sun_times(lat, lon, day):
+    """(amanecer, atardecer) en UTC para la fecha `day` (UTC) en lat/lon (grados,
+    oeste negativo). Devuelve (None, None) en noche polar y el día completo en
+    día polar."""
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    n = day.timetuple().tm_yday
+    g = 2 * math.pi / 365 * (n - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(g) - 0.032077 * math.sin(g)
+                       - 0.014615 * math.cos(2 * g) - 0.040849 * math.sin(2 * g))
+    decl = (0.006918 - 0.399912 * math.cos(g) + 0.070257 * math.sin(g)
+            - 0.006758 * math.cos(2 * g) + 0.000907 * math.sin(2 * g)
+            - 0.002697 * math.cos(3 * g) + 0.00148 * math.sin(3 * g))
+    phi = math.radians(lat)
+    cos_ha = (math.cos(math.radians(ZENITH_DEG)) / (math.cos(phi) * math.cos(decl))
+              - math.tan(phi) * math.tan(decl))
+    if cos_ha > 1:
+        return None, None
+    if cos_ha < -1:
+        return start, start + timedelta(days=1)
+    ha = math.degrees(math.acos(cos_ha))
+    sunrise = start + timedelta(minutes=720 - 4 * (lon + ha) - eqtime)
+    sunset = start + timedelta(minutes=720 - 4 * (lon - ha) - eqtime)
+    return sunrise, sunset
+
+def is_daylight(lat, lon, when, margin_minutes=0.0):
+    """True si `when` (datetime con zona) cae entre amanecer y atardecer,
+    ampliados `margin_minutes` a cada lado."""
+    when = when.astimezone(timezone.utc)
+    margin = timedelta(minutes=margin_minutes)
+    # Se revisan los días vecinos porque en longitudes lejanas de Greenwich el
+    # atardecer puede caer en la fecha UTC siguiente.
+    for offset in (-1, 0, 1):
+        rise, sset = sun_times(lat, lon, (when + timedelta(days=offset)).date())
+        if rise is not None and rise - margin <= when <= sset + margin:
+            return True
+    return False
+
+def daylight_hours(lat, lon, day):
+    rise, sset = sun_times(lat, lon, day)
+    if rise is None:
+        return 0.0
+    return (sset - rise).total_seconds() / 3600.0
+
+def daylight_seconds(lat, lon, start, end, margin_minutes=0.0):
+    """Segundos de [start, end) (datetimes con zona) que caen de día, con el
+    amanecer y el atardecer ampliados `margin_minutes`."""
+    start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+    margin = timedelta(minutes=margin_minutes)
+    total = 0.0
+    day = (start - timedelta(days=1)).date()
+    while day <= (end + timedelta(days=1)).date():
+        rise, sset = sun_times(lat, lon, day)
+        if rise is not None:
+            overlap = (min(end, sset + margin) - max(start, rise - margin)).total_seconds()
+            total += max(0.0, overlap)
+        day += timedelta(days=1)
+    return min(total, max(0.0, (end - start).total_seconds()))
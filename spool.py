@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+# ─────────────────────────────────────────────────────────
+# Spool local (cola de escritura anticipada en SQLite WAL)
+# ─────────────────────────────────────────────────────────
+# Cada fila recolectada se guarda primero aquí. El drenado la copia a Postgres y
+# sólo después de un COMMIT exitoso borra las filas hasta ese id: si el proceso
+# muere en medio, la fila se reenvía y el ON CONFLICT (ts_utc, plant_code) la
+# descarta como duplicado.
+
+def _encode(row):
+    return json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in row])
+
+# Posición de ts_utc en cada tipo de fila
+_TS_INDEX = {"plant": 1, "meter": 0, "repair": 1}
+
+def _decode(payload, kind):
+    row = json.loads(payload)
+    i = _TS_INDEX[kind]
+    row[i] = datetime.fromisoformat(row[i])
+    return tuple(row)
+
+class Spool:
+    def __init__(self, path, max_rows=None):
+        self.path = str(path)
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv("SPOOL_MAX_ROWS", "500000"))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+              id         INTEGER PRIMARY KEY AUTOINCREMENT,
+              kind       TEXT    NOT NULL,
+              created_s  REAL    NOT NULL,
+              payload    TEXT    NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS spool_kind_id ON spool (kind, id)")
+        self.dropped = 0
+
+    def append(self, rows, kind="plant"):
+        if not rows:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO spool (kind, created_s, payload) VALUES (?,?,?)",
+                [(kind, now, _encode(r)) for r in rows],
+            )
+            self.db.execute("COMMIT")
+            self._trim()
+
+    def _trim(self):
+        # Disco acotado: si se supera max_rows se descartan las filas más antiguas
+        n = self.count_locked()
+        overflow = n - self.max_rows
+        if overflow > 0:
+            self.db.execute(
+                "DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)",
+                (overflow,),
+            )
+            self.dropped += overflow
+            print(f"⚠️ Spool lleno: descartadas {overflow} filas antiguas")
+
+    def count_locked(self):
+        return self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def count(self):
+        with self.lock:
+            return self.count_locked()
+
+    def oldest_age(self):
+        with self.lock:
+            r = self.db.execute("SELECT MIN(created_s) FROM spool").fetchone()[0]
+        return 0.0 if r is None else time.time() - r
+
+    def peek(self, limit, kind="plant"):
+        """Las `limit` filas más antiguas de `kind`: (último id, [filas])."""
+        with self.lock:
+            cur = self.db.execute(
+                "SELECT id, payload FROM spool WHERE kind = ? ORDER BY id LIMIT ?",
+                (kind, limit),
+            )
+            items = cur.fetchall()
+        if not items:
+            return None, []
+        return items[-1][0], [_decode(p, kind) for _, p in items]
+
+    def ack(self, last_id, kind="plant"):
+        """Confirma (borra) todo lo de `kind` hasta `last_id` inclusive."""
+        with self.lock:
+            self.db.execute("DELETE FROM spool WHERE kind = ? AND id <= ?", (kind, last_id))
+
+    def close(self):
+        with self.lock:
+            try:
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.db.close()
+            except sqlite3.Error:
+                pass
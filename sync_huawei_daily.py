@@ -1,125 +1,245 @@
-def sync_data():
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import requests
+import psycopg2.extras
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+
+from consolidate_daily import LOCAL_TZ, get_db_connection, registry
+
+load_dotenv(".env")
+
+# --- CONFIGURACIÓN ---
+DOMAIN   = os.getenv("FUSION_DOMAIN")
+USER     = os.getenv("FS_USER")
+SYSCODE  = os.getenv("FS_SYSCODE")
+# FUSION_DOMAIN puede traer esquema (http://host:puerto, p. ej. el servidor de bench/)
+BASE_URL = (DOMAIN if "://" in (DOMAIN or "") else f"https://{DOMAIN}").rstrip("/") + "/thirdData"
+
+# getKpiStationDay devuelve el mes completo de la fecha pedida; entre llamadas
+# se respeta un intervalo mínimo y ante un 407 se espera BACKOFF_SECONDS.
+SYNC_CALL_INTERVAL_SECONDS = float(os.getenv("SYNC_CALL_INTERVAL_SECONDS", "60"))
+BACKOFF_SECONDS            = int(os.getenv("BACKOFF_SECONDS", "480"))
+MAX_RETRIES_407            = int(os.getenv("SYNC_MAX_RETRIES_407", "3"))
+MAX_STATIONS_PER_CALL      = int(os.getenv("MAX_STATIONS_PER_CALL", "100"))
+
+def login():
+    url = f"{BASE_URL}/login"
+    r = requests.post(url, json={"userName": USER, "systemCode": SYSCODE}, timeout=15)
+    r.raise_for_status()
+    token = (
+        r.headers.get("XSRF-TOKEN")
+        or r.headers.get("xsrf-token")
+        or r.cookies.get("XSRF-TOKEN")
+        or r.cookies.get("xsrf-token")
+    )
+    if not token:
+        m = re.search(r"XSRF-TOKEN=([^;]+)", r.headers.get("Set-Cookie", ""))
+        if m:
+            token = m.group(1)
+    if not token:
+        print(f"❌ Login sin XSRF-TOKEN: {r.text[:300]}")
+        sys.exit(1)
+    print("✅ Login OK")
+    return token
+
+def _is_rate_limited(data):
+    return (
+        data.get("failCode") == 407
+        or data.get("data") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
+        or data.get("message") == "ACCESS_FREQUENCY_IS_TOO_HIGH"
+    )
+
+def _collect_time_ms(day):
+    return int(datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ).timestamp()) * 1000
+
+def _item_date(item):
+    ms = item.get("collectTime")
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(int(ms) / 1000, tz=LOCAL_TZ).date()
+
+def _month_starts(date_from, date_to):
+    d = date_from.replace(day=1)
+    while d <= date_to:
+        yield d
+        d = (d + timedelta(days=32)).replace(day=1)
+
+_last_call = [0.0]
+
+def fetch_station_days(headers, station_codes, month_day):
+    """Una llamada getKpiStationDay (mes completo de `month_day`), respetando el
+    intervalo entre llamadas y reintentando tras un 407."""
+    url = f"{BASE_URL}/getKpiStationDay"
+    payload = {"stationCodes": station_codes, "collectTime": _collect_time_ms(month_day)}
+    for attempt in range(MAX_RETRIES_407 + 1):
+        wait = SYNC_CALL_INTERVAL_SECONDS - (time.monotonic() - _last_call[0])
+        if _last_call[0] and wait > 0:
+            print(f"RATE: esperando {wait:.0f}s…", flush=True)
+            time.sleep(wait)
+        _last_call[0] = time.monotonic()
+        resp = requests.post(url, json=payload, headers=headers, timeout=15)
+        api_data = resp.json()
+        if not _is_rate_limited(api_data):
+            return api_data
+        print(f"⏳ Rate limit (intento {attempt + 1}) → durmiendo {BACKOFF_SECONDS}s")
+        time.sleep(BACKOFF_SECONDS)
+    return api_data
+
+def parse_item(item):
+    # IMPORTANTE: Ajustar según estructura real
+    data_map = item.get('dataItemMap', {})
+
+    # Si los datos están en dataItemMap:
+    if data_map:
+        yield_kwh = float(data_map.get('inverter_power', 0) or 0)
+        consumption = float(data_map.get('use_power', 0) or 0)
+        export_kwh = float(data_map.get('on_grid_power', 0) or 0)
+        import_kwh = float(data_map.get('buy_power', 0) or 0)
+        self_use = float(data_map.get('self_use_power', 0) or 0)
+    # Si los datos están directos:
+    else:
+        yield_kwh = float(item.get('inverter_power') or item.get('daily_energy') or 0)
+        consumption = float(item.get('use_power') or 0)
+        export_kwh = float(item.get('on_grid_power') or 0)
+        import_kwh = float(item.get('buy_power') or 0)
+        self_use = float(item.get('self_use_power') or 0)
+    return yield_kwh, consumption, export_kwh, import_kwh, self_use
+
+# Un solo UPSERT multi-fila; (xmax = 0) distingue INSERT de UPDATE sin un SELECT previo
+UPSERT_OFFICIAL_SQL = """
+    INSERT INTO fs.plant_daily_metrics
+    (plant_id, plant_code, date, fv_yield_kwh, consumption_kwh,
+     exported_energy_kwh, imported_energy_kwh, self_consumption_kwh,
+     specific_yield_kwh_kwp, source, created_at)
+    VALUES %s
+    ON CONFLICT (plant_id, date) DO UPDATE SET
+        fv_yield_kwh = EXCLUDED.fv_yield_kwh,
+        consumption_kwh = EXCLUDED.consumption_kwh,
+        exported_energy_kwh = EXCLUDED.exported_energy_kwh,
+        imported_energy_kwh = EXCLUDED.imported_energy_kwh,
+        self_consumption_kwh = EXCLUDED.self_consumption_kwh,
+        specific_yield_kwh_kwp = EXCLUDED.specific_yield_kwh_kwp,
+        source = 'api_official_update',
+        updated_at = NOW()
+    RETURNING plant_id, date, (xmax = 0) AS inserted
+"""
+
+def sync_data(date_from=None, date_to=None):
+    # Por defecto: sólo ayer
+    yesterday = datetime.now().date() - timedelta(days=1)
+    date_from = date_from or date_to or yesterday
+    date_to = date_to or date_from
+    n_days = (date_to - date_from).days + 1
+
     print(f"\n{'='*60}")
     print(f"SINCRONIZACIÓN API OFICIAL: {datetime.now()}")
     print(f"{'='*60}\n")
-    
+
     token = login()
     headers = {"XSRF-TOKEN": token}
-    
-    target_date = datetime.now().date() - timedelta(days=1)
-    collect_time = int(datetime(target_date.year, target_date.month, target_date.day).timestamp()) * 1000
-    
-    print(f"📅 Fecha objetivo: {target_date}")
-    
-    station_codes = ",".join(PLANT_MAP.keys())
-    url = f"{BASE_URL}/getKpiStationDay"
-    payload = {"stationCodes": station_codes, "collectTime": collect_time}
-    
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=15)
-        api_data = resp.json()
-    except Exception as e:
-        print(f"❌ Error consultando API: {e}")
-        sys.exit(1)
-    
-    if not api_data.get('success'):
-        print(f"❌ Error API Huawei: {api_data}")
+
+    if n_days == 1:
+        print(f"📅 Fecha objetivo: {date_from}")
+    else:
+        print(f"📅 Rango: {date_from} → {date_to} ({n_days} días)")
+
+    # Plantas activas de dim.fs_plants
+    if not registry.refresh(force=True) or not registry.codes():
+        print("❌ dim.fs_plants vacío o inaccesible")
         sys.exit(1)
-    
-    raw_list = api_data.get('data', [])
-    
-    if not raw_list:
+    codes = registry.codes()
+    rows = {}
+    calls = 0
+
+    for month_day in _month_starts(date_from, date_to):
+        for i in range(0, len(codes), MAX_STATIONS_PER_CALL):
+            station_codes = ",".join(codes[i:i + MAX_STATIONS_PER_CALL])
+            try:
+                api_data = fetch_station_days(headers, station_codes, max(month_day, date_from))
+                calls += 1
+            except Exception as e:
+                print(f"❌ Error consultando API: {e}")
+                sys.exit(1)
+
+            if not api_data.get('success'):
+                print(f"❌ Error API Huawei: {api_data}")
+                sys.exit(1)
+
+            raw_list = api_data.get('data', []) or []
+            if calls == 1 and raw_list:
+                # DEBUGGING: Ver estructura completa del primer item
+                print("\n🔍 PRIMER ITEM COMPLETO:")
+                print(json.dumps(raw_list[0], indent=2, ensure_ascii=False))
+                print("-" * 60)
+
+            for item in raw_list:
+                p_code = item.get('stationCode')
+                plant = registry.get(p_code)
+                if not plant:
+                    print(f"⚠️ plant_code desconocido: {p_code}")
+                    continue
+                plant_id = plant.plant_id
+
+                day = _item_date(item) or (date_from if n_days == 1 else None)
+                if day is None or not (date_from <= day <= date_to):
+                    continue
+
+                yield_kwh, consumption, export_kwh, import_kwh, self_use = parse_item(item)
+                kwp = plant.capacity_kw or 1
+                spec = round(yield_kwh / kwp, 3) if kwp > 0 else None
+                rows[(plant_id, day)] = (plant_id, p_code, day, yield_kwh, consumption,
+                                         export_kwh, import_kwh, self_use, spec)
+
+    if not rows:
         print("⚠️ API retornó lista vacía")
         sys.exit(1)
-    
-    # DEBUGGING: Ver estructura completa del primer item
-    print("\n🔍 PRIMER ITEM COMPLETO:")
-    print(json.dumps(raw_list[0], indent=2, ensure_ascii=False))
-    print("-" * 60)
-    
+
     conn = get_db_connection()
     cursor = conn.cursor()
-    
+
+    # UPSERT
+    values = sorted(rows.values(), key=lambda r: (r[2], r[0]))
+    result = psycopg2.extras.execute_values(
+        cursor, UPSERT_OFFICIAL_SQL, values,
+        template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, 'api_official', NOW())",
+        page_size=1000, fetch=True,
+    )
+    inserted_flags = {(plant_id, day): inserted for plant_id, day, inserted in result}
+
     inserted = 0
     updated = 0
-    
-    for item in raw_list:
-        p_code = item.get('stationCode')
-        plant_id = PLANT_MAP.get(p_code)
-        
-        if not plant_id:
-            print(f"⚠️ plant_code desconocido: {p_code}")
-            continue
-        
-        # IMPORTANTE: Ajustar según estructura real
-        # Opción A: Datos directos en el item
-        data_map = item.get('dataItemMap', {})
-        
-        # Si los datos están en dataItemMap:
-        if data_map:
-            yield_kwh = float(data_map.get('inverter_power', 0) or 0)
-            consumption = float(data_map.get('use_power', 0) or 0)
-            export_kwh = float(data_map.get('on_grid_power', 0) or 0)
-            import_kwh = float(data_map.get('buy_power', 0) or 0)
-            self_use = float(data_map.get('self_use_power', 0) or 0)
-        # Si los datos están directos:
+    for plant_id, p_code, day, yield_kwh, consumption, export_kwh, import_kwh, self_use, spec in values:
+        is_new = inserted_flags.get((plant_id, day), False)
+        if n_days <= 7:
+            status = "✅ INSERT" if is_new else "🔄 UPDATE"
+            print(f"{status} {day} ID={plant_id} | Gen={yield_kwh:.2f} Cons={consumption:.2f} Exp={export_kwh:.2f} Imp={import_kwh:.2f} Self={self_use:.2f}")
+        if is_new:
+            inserted += 1
         else:
-            yield_kwh = float(item.get('inverter_power') or item.get('daily_energy') or 0)
-            consumption = float(item.get('use_power') or 0)
-            export_kwh = float(item.get('on_grid_power') or 0)
-            import_kwh = float(item.get('buy_power') or 0)
-            self_use = float(item.get('self_use_power') or 0)
-        
-        kwp = PLANT_KWP.get(plant_id, 1)
-        spec = round(yield_kwh / kwp, 3) if kwp > 0 else None
-        
-        # Verificar existencia
-        cursor.execute("""
-            SELECT 1 FROM fs.plant_daily_metrics 
-            WHERE plant_id = %s AND date = %s
-        """, (plant_id, target_date))
-        exists = cursor.fetchone()
-        
-        # UPSERT
-        cursor.execute("""
-            INSERT INTO fs.plant_daily_metrics 
-            (plant_id, plant_code, date, fv_yield_kwh, consumption_kwh, 
-             exported_energy_kwh, imported_energy_kwh, self_consumption_kwh, 
-             specific_yield_kwh_kwp, source, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'api_official', NOW())
-            ON CONFLICT (plant_id, date) DO UPDATE SET
-                fv_yield_kwh = EXCLUDED.fv_yield_kwh,
-                consumption_kwh = EXCLUDED.consumption_kwh,
-                exported_energy_kwh = EXCLUDED.exported_energy_kwh,
-                imported_energy_kwh = EXCLUDED.imported_energy_kwh,
-                self_consumption_kwh = EXCLUDED.self_consumption_kwh,
-                specific_yield_kwh_kwp = EXCLUDED.specific_yield_kwh_kwp,
-                source = 'api_official_update',
-                updated_at = NOW()
-        """, (plant_id, p_code, target_date, yield_kwh, consumption, 
-              export_kwh, import_kwh, self_use, spec))
-        
-        status = "🔄 UPDATE" if exists else "✅ INSERT"
-        print(f"{status} ID={plant_id} | Gen={yield_kwh:.2f} Cons={consumption:.2f} Exp={export_kwh:.2f} Imp={import_kwh:.2f} Self={self_use:.2f}")
-        
-        if exists:
             updated += 1
-        else:
-            inserted += 1
-    
+
     conn.commit()
     conn.close()
-    
+
     print(f"\n{'='*60}")
-    print(f"✅ COMPLETADO: {inserted} nuevos | {updated} actualizados")
+    print(f"✅ COMPLETADO: {inserted} nuevos | {updated} actualizados | {calls} llamadas API")
     print(f"{'='*60}\n")
-```
-
----
 
-## 🎯 ACCIÓN INMEDIATA
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sincroniza getKpiStationDay en fs.plant_daily_metrics")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, default=None,
+                        help="primer día (YYYY-MM-DD); por defecto ayer")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=None,
+                        help="último día (YYYY-MM-DD); por defecto igual a --from")
+    args = parser.parse_args(argv)
+    if args.date_from and args.date_to and args.date_to < args.date_from:
+        parser.error("--to debe ser igual o posterior a --from")
+    sync_data(args.date_from, args.date_to)
 
-**Ejecuta el script AHORA** y pégame la salida completa, especialmente la parte de:
-```
-🔍 PRIMER ITEM COMPLETO:
-{...}
+if __name__ == "__main__":
+    main()
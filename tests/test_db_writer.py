@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+
+import db_writer
+from db_writer import DbWriter
+from spool import Spool
+
+ROWS = [[datetime(2026, 10, 17, 15, 0, tzinfo=timezone.utc), "NE=1", 1.0, 0.0, 2.0, 1.0],
+        [datetime(2026, 10, 17, 15, 5, tzinfo=timezone.utc), "NE=1", 1.5, 0.0, 2.5, 1.5]]
+
+@pytest.fixture
+def written(monkeypatch):
+    """Sustituye el escritor de filas de medidor por una lista en memoria."""
+    out = []
+    monkeypatch.setitem(db_writer.WRITERS, "meter", lambda rows: out.extend(rows))
+    return out
+
+@pytest.fixture(params=["buffer", "spool"])
+def writer(request, tmp_path):
+    spool = Spool(tmp_path / "spool.sqlite3") if request.param == "spool" else None
+    return DbWriter(flush_rows=1000, flush_seconds=3600, spool=spool)
+
+def test_flush_writes_pending_rows(writer, written):
+    writer.add(ROWS, kind="meter")
+    assert writer.pending() == 2
+    assert writer.flush() == 2
+    assert [list(r) for r in written] == ROWS
+    assert writer.pending() == 0
+    assert writer.flush() == 0
+
+def test_flush_keeps_rows_and_backs_off_on_error(writer, monkeypatch):
+    def fail(rows):
+        raise psycopg2.OperationalError("sin conexión")
+    monkeypatch.setitem(db_writer.WRITERS, "meter", fail)
+    writer.add(ROWS, kind="meter")
+    assert writer.flush() == 0
+    assert writer.pending() == 2
+    assert writer.errors == 1
+    assert writer.retry_delay == writer.retry_min
+    assert not writer.due()